@@ -0,0 +1,248 @@
+// Copyright 2025 The NoPeek Authors. All rights reserved.
+// Licensed under the Apache License, Version 2.0 that can be found in the
+// LICENSE file in the root directory of this source tree.
+
+# batch.py — detect and obfuscate whole directories or manifests in one run, resumable
+import argparse, asyncio, json, os, sys, time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Dict, List, Tuple
+
+import cv2
+import numpy as np
+
+from compositor import SUPPORTED, TYPES
+from detections import Detections, load_detections
+from inpaint import ENGINES
+from metrics import span
+from storage import atomic_write
+from workers import WorkerPool, run_local
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff")
+DEFAULT_JOBS = ("face=blur", "plate=blur")
+
+
+# =========================
+# Inputs and output layout
+# =========================
+def list_inputs(input_dir: str = "", manifest: str = "", recursive: bool = False) -> List[str]:
+    """Image paths from a directory (sorted) or a manifest (one path per line, # comments)."""
+    if manifest:
+        with open(manifest, "r", encoding="utf-8") as f:
+            return [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+    paths = []
+    for root, dirs, files in os.walk(input_dir):
+        dirs.sort()
+        paths += [os.path.join(root, n) for n in sorted(files) if n.lower().endswith(IMAGE_EXTS)]
+        if not recursive:
+            break
+    return paths
+
+def output_stems(paths: List[str]) -> List[str]:
+    """
+    Name for each input in results/ and jsons/: its path below the common directory,
+    without extension, "/" -> "__". A flat directory gives the bare file stem, as in example.sh.
+    """
+    if not paths:
+        return []
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(p)) for p in paths])
+    return [os.path.splitext(os.path.relpath(os.path.abspath(p), root))[0].replace(os.sep, "__") for p in paths]
+
+def json_path(jsons_dir: str, t: str, stem: str) -> str:
+    return os.path.join(jsons_dir, f"{t}_{stem}.json")
+
+def result_path(results_dir: str, t: str, mode: str, stem: str) -> str:
+    # blur_face_x.jpg, sticker_face_x.jpg, blur_plate_x.jpg, blur_doc_x.jpg, ...
+    return os.path.join(results_dir, f"{mode}_{'doc' if t == 'document' else t}_{stem}.jpg")
+
+def parse_jobs(items: List[str]) -> List[Tuple[str, str]]:
+    jobs = []
+    for item in items:
+        t, _, mode = item.partition("=")
+        job = (t.strip(), mode.strip())
+        if job not in SUPPORTED:
+            raise ValueError(f"Unsupported job {item!r}; choose from "
+                             + ", ".join(f"{a}={b}" for a, b in sorted(SUPPORTED)))
+        if job not in jobs:
+            jobs.append(job)
+    return jobs
+
+
+# =========================
+# Pipeline
+# =========================
+class Batch:
+    """
+    One image flows decode -> detect (per type, skipped when its JSON exists) -> one
+    composite per job -> encode, all from a single decode. At most `prefetch` images are
+    in flight. Compute runs in the worker pool (workers > 0, models loaded once per
+    worker) or in one in-process thread (models loaded once); decode, encode and file
+    writes overlap with it on an I/O thread pool. Every file is written atomically, so
+    an interrupted run resumes by skipping images whose outputs all exist.
+    """
+
+    def __init__(self, jobs: List[Tuple[str, str]], results_dir: str = "results", jsons_dir: str = "jsons", *,
+                 composite: bool = False, workers: int = 0, prefetch: int = 0, force: bool = False,
+                 gate: bool = True, quality: int = 95, inpaint_engine: str = "auto"):
+        self.jobs = jobs
+        self.types = [t for t in TYPES if any(j[0] == t for j in jobs)]
+        # composite output: first mode given per type
+        self.modes = {t: next(m for jt, m in jobs if jt == t) for t in self.types}
+        self.results_dir, self.jsons_dir = results_dir, jsons_dir
+        self.composite, self.force, self.gate, self.quality = composite, force, gate, quality
+        self.inpaint_engine = inpaint_engine
+        self.pool = WorkerPool(workers)
+        self.prefetch = prefetch or 2 * max(1, workers)
+        self._compute = ThreadPoolExecutor(max_workers=1, thread_name_prefix="batch-compute")
+        self._io = ThreadPoolExecutor(max_workers=2, thread_name_prefix="batch-io")
+
+    def outputs(self, stem: str) -> List[str]:
+        paths = [json_path(self.jsons_dir, t, stem) for t in self.types]
+        paths += [result_path(self.results_dir, t, m, stem) for t, m in self.jobs]
+        if self.composite:
+            paths.append(os.path.join(self.results_dir, f"composite_{stem}.jpg"))
+        return paths
+
+    def done(self, stem: str) -> bool:
+        return not self.force and all(os.path.exists(p) for p in self.outputs(stem))
+
+    async def _op(self, op: str, img: np.ndarray, **kwargs) -> Any:
+        if self.pool.enabled:
+            return await self.pool.run(op, img, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self._compute, partial(run_local, op, img, **kwargs))
+
+    async def _io_call(self, fn, *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._io, fn, *args)
+
+    async def _detections(self, img: np.ndarray, t: str, stem: str) -> List[Dict]:
+        path = json_path(self.jsons_dir, t, stem)
+        if not self.force and os.path.exists(path):
+            dets = await self._io_call(load_detections, path)
+        else:
+            dets = (await self._op(f"detect_{t}s", img, gate=self.gate))["dets"]
+            data = json.dumps(Detections.from_list(dets).to_list(), ensure_ascii=False, separators=(",", ":"))
+            await self._io_call(atomic_write, path, data.encode("utf-8"))
+        return [{**d, "type": t} for d in dets]
+
+    async def _write_image(self, path: str, img: np.ndarray) -> None:
+        def write():
+            with span("image.encode"):
+                ok, buf = cv2.imencode(os.path.splitext(path)[1], img, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            if not ok:
+                raise RuntimeError(f"Failed to encode {path}")
+            atomic_write(path, buf.tobytes())
+        await self._io_call(write)
+
+    async def process(self, path: str, stem: str) -> None:
+        def decode():
+            with span("image.decode"):
+                return cv2.imread(path, cv2.IMREAD_COLOR)
+        img = await self._io_call(decode)
+        if img is None:
+            raise FileNotFoundError(f"Unreadable image: {path}")
+
+        dets = {t: await self._detections(img, t, stem) for t in self.types}
+        writes = []
+        for t, mode in self.jobs:
+            out = result_path(self.results_dir, t, mode, stem)
+            if self.force or not os.path.exists(out):
+                res = await self._op("composite", img, dets=dets[t], modes={t: mode}, seed=stem,
+                                     inpaint_engine=self.inpaint_engine)
+                writes.append(self._write_image(out, res))
+        if self.composite:
+            out = os.path.join(self.results_dir, f"composite_{stem}.jpg")
+            if self.force or not os.path.exists(out):
+                all_dets = [d for t in self.types for d in dets[t]]
+                res = await self._op("composite", img, dets=all_dets, modes=self.modes, seed=stem,
+                                     inpaint_engine=self.inpaint_engine)
+                writes.append(self._write_image(out, res))
+        await asyncio.gather(*writes)
+
+    async def run(self, paths: List[str], stems: List[str]) -> Dict[str, Any]:
+        os.makedirs(self.results_dir, exist_ok=True)
+        os.makedirs(self.jsons_dir, exist_ok=True)
+        todo = [(p, s) for p, s in zip(paths, stems) if not self.done(s)]
+        print(f"{len(paths)} images, {len(paths) - len(todo)} already done, {len(todo)} to process")
+
+        sem = asyncio.Semaphore(self.prefetch)
+        failed: List[Tuple[str, str]] = []
+        finished = 0
+        t0 = time.perf_counter()
+
+        async def one(path: str, stem: str) -> None:
+            nonlocal finished
+            try:
+                await self.process(path, stem)
+            except Exception as e:
+                failed.append((path, f"{type(e).__name__}: {e}"))
+                print(f"FAILED {path}: {type(e).__name__}: {e}", file=sys.stderr)
+            finally:
+                finished += 1
+                sem.release()
+                if finished % 10 == 0 or finished == len(todo):
+                    dt = time.perf_counter() - t0
+                    print(f"[{finished}/{len(todo)}] {finished / dt:.2f} images/s")
+
+        self.pool.start()
+        try:
+            tasks = []
+            for path, stem in todo:
+                await sem.acquire()       # bounded prefetch: the next decode waits for a free slot
+                tasks.append(asyncio.create_task(one(path, stem)))
+            await asyncio.gather(*tasks)
+        finally:
+            self.pool.close()
+            self._compute.shutdown()
+            self._io.shutdown()
+        return {"images": len(paths), "processed": len(todo) - len(failed), "skipped": len(paths) - len(todo),
+                "failed": failed, "seconds": round(time.perf_counter() - t0, 3)}
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Detect and obfuscate a directory or manifest of images in one process; "
+                                             "rerun the same command to resume.")
+    src = ap.add_mutually_exclusive_group(required=True)
+    src.add_argument("-i", "--input", help="Input directory")
+    src.add_argument("--manifest", help="Text file with one image path per line")
+    ap.add_argument("-r", "--recursive", action="store_true", help="Walk subdirectories of --input")
+    ap.add_argument("-m", "--job", action="append", default=[],
+                    help="type=mode output per image, repeatable (default: face=blur plate=blur), "
+                         "e.g. -m face=sticker -m document=blur -m face=inpaint")
+    ap.add_argument("--composite", action="store_true",
+                    help="Also write composite_<name>.jpg with every type (first mode given per type)")
+    ap.add_argument("--results", default="results", help="Output image directory")
+    ap.add_argument("--jsons", default="jsons", help="Detection JSON directory")
+    ap.add_argument("-w", "--workers", type=int, default=0,
+                    help="Worker processes (0 = run models in this process)")
+    ap.add_argument("--prefetch", type=int, default=0, help="Images in flight (default: 2 x max(1, workers))")
+    ap.add_argument("--no-gate", action="store_true", help="Always run the plate / document detectors")
+    ap.add_argument("--inpaint-engine", default="auto", choices=list(ENGINES),
+                    help="Backend for inpaint jobs (cpu runs without a GPU; see inpaint.py --engine)")
+    ap.add_argument("--force", action="store_true", help="Recompute outputs and detections that already exist")
+    ap.add_argument("--report", default="", help="Write a JSON summary (counts, failures, seconds) here")
+    args = ap.parse_args()
+
+    try:
+        jobs = parse_jobs(args.job or list(DEFAULT_JOBS))
+    except ValueError as e:
+        ap.error(str(e))
+    paths = list_inputs(args.input or "", args.manifest or "", args.recursive)
+    stems = output_stems(paths)
+    if len(set(stems)) != len(stems):
+        ap.error("Inputs map to duplicate output names; use distinct file names")
+
+    batch = Batch(jobs, args.results, args.jsons, composite=args.composite, workers=args.workers,
+                  prefetch=args.prefetch, force=args.force, gate=not args.no_gate, inpaint_engine=args.inpaint_engine)
+    summary = asyncio.run(batch.run(paths, stems))
+
+    print(f"Done. {summary['processed']} processed, {summary['skipped']} skipped, "
+          f"{len(summary['failed'])} failed in {summary['seconds']:.1f}s")
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+    if summary["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+// Copyright 2025 The NoPeek Authors. All rights reserved.
+// Licensed under the Apache License, Version 2.0 that can be found in the
+// LICENSE file in the root directory of this source tree.
+
+# bench.py — reproducible benchmark for the detect → obfuscate → encode pipeline
+import argparse, gc, glob, json, math, os, platform, resource, subprocess, sys, threading, time
+from typing import Callable, Dict, List, Tuple
+
+import cv2
+import numpy as np
+
+import detect
+from blur import blur_faces, blur_plates
+from blur_doc import blur_documents, detect_documents
+from encode import EncodeOptions, encode_image
+from inpaint import inpaint_faces, inpaint_plates
+from sticker import place_face_stickers, place_plate_stickers
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STICKERS_DIR = os.path.join(HERE, "stickers")
+PLATE_STICKER = os.path.join(STICKERS_DIR, "vecteezy_plate.png")
+
+DEFAULT_MP = "1,4,12,24,48"
+DEFAULT_BOXES = "0,1,10,100"
+
+
+# =========================
+# Inputs
+# =========================
+def synthetic_image(megapixels: float, seed: int = 0) -> np.ndarray:
+    """
+    4:3 BGR image of roughly `megapixels` MP: smooth colour structure plus fine noise,
+    so blurs and the JPEG encoder see photo-like content rather than flat colour.
+    """
+    w = int(round(math.sqrt(megapixels * 1e6 * 4 / 3)))
+    h = int(round(w * 3 / 4))
+    rng = np.random.default_rng(seed)
+    coarse = rng.integers(0, 240, size=(h // 16 + 1, w // 16 + 1, 3), dtype=np.uint8)
+    img = cv2.resize(coarse, (w, h), interpolation=cv2.INTER_CUBIC)
+    np.add(img, rng.integers(0, 16, size=(h, w, 1), dtype=np.uint8), out=img)
+    return img
+
+def synthetic_dets(n: int, w: int, h: int, seed: int = 0) -> List[Dict]:
+    return [{
+        "bbox_xyxy": [x1 / w, y1 / h, x2 / w, y2 / h],
+        "confidence": 0.9,
+        "attributes": {"gender": "male" if i % 2 else "female"},
+    } for i, (x1, y1, x2, y2) in enumerate(detect.synthetic_boxes(n, w, h, seed=seed))]
+
+def _load_fixture(json_path: str) -> List[Dict]:
+    # The checked-in fixtures carry the license header; skip it before parsing.
+    with open(json_path, "r", encoding="utf-8") as f:
+        text = "".join(line for line in f if not line.startswith("//"))
+    data = json.loads(text)
+    return [d for d in data if isinstance(d, dict) and "bbox_xyxy" in d]
+
+
+# =========================
+# Operations under test
+# =========================
+# name -> (fn(bgr, dets), takes_boxes). Detector ops get their box count from the stub.
+def _detect_faces(bgr, dets): return detect.detect_faces(bgr)
+def _detect_plates(bgr, dets): return detect.detect_plates(bgr)
+def _detect_documents(bgr, dets): return detect_documents(bgr)
+def _blur_faces(bgr, dets): return blur_faces(bgr, dets)
+def _blur_plates(bgr, dets): return blur_plates(bgr, dets)
+def _face_stickers(bgr, dets): return place_face_stickers(bgr, dets, stickers_dir=STICKERS_DIR, expand_pct=0.25)
+def _plate_stickers(bgr, dets): return place_plate_stickers(bgr, dets, sticker_path=PLATE_STICKER, expand_pct=0.15)
+def _blur_docs(bgr, dets): return blur_documents(bgr, dets)
+def _pixelate_docs(bgr, dets): return blur_documents(bgr, dets, method="pixelate")
+def _encode_jpeg(bgr, dets): return encode_image(bgr, EncodeOptions(fmt="jpeg", quality=92))
+def _inpaint_faces_cpu(bgr, dets): return inpaint_faces(bgr, dets, engine="cpu")
+def _inpaint_plates_cpu(bgr, dets): return inpaint_plates(bgr, dets, engine="cpu")
+def _inpaint_faces_flux(bgr, dets): return inpaint_faces(bgr, dets, engine="flux_depth")
+def _inpaint_plates_flux(bgr, dets): return inpaint_plates(bgr, dets, engine="flux_fill")
+
+OPS: Dict[str, Tuple[Callable, bool]] = {
+    "detect_faces": (_detect_faces, True),
+    "detect_plates": (_detect_plates, True),
+    "detect_documents": (_detect_documents, False),
+    "blur_faces": (_blur_faces, True),
+    "blur_plates": (_blur_plates, True),
+    "place_face_stickers": (_face_stickers, True),
+    "place_plate_stickers": (_plate_stickers, True),
+    "blur_documents": (_blur_docs, True),
+    "pixelate_documents": (_pixelate_docs, True),
+    "encode_jpeg": (_encode_jpeg, False),
+    "inpaint_faces_cpu": (_inpaint_faces_cpu, True),
+    "inpaint_plates_cpu": (_inpaint_plates_cpu, True),
+    "inpaint_faces_flux": (_inpaint_faces_flux, True),
+    "inpaint_plates_flux": (_inpaint_plates_flux, True),
+}
+_DETECT_OPS = {"detect_faces", "detect_plates"}
+# FLUX loads its pipeline per call and needs CUDA: only run when named in --ops, e.g.
+# --ops inpaint_faces_cpu,inpaint_faces_flux --mp 1,4 --boxes 1 to compare the two engines.
+_GPU_OPS = {"inpaint_faces_flux", "inpaint_plates_flux"}
+DEFAULT_OPS = [o for o in OPS if o not in _GPU_OPS]
+_FIXTURE_OPS = {"face": ("blur_faces", "place_face_stickers", "inpaint_faces_cpu", "inpaint_faces_flux"),
+                "plate": ("blur_plates", "place_plate_stickers", "inpaint_plates_cpu", "inpaint_plates_flux")}
+
+
+# =========================
+# Measurement
+# =========================
+_PAGE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+def _rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE
+    except OSError:
+        # ru_maxrss is KiB on Linux, bytes on macOS; it is a lifetime peak either way.
+        r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return r if sys.platform == "darwin" else r * 1024
+
+class _PeakRss:
+    """Samples RSS on a background thread; ru_maxrss can't be reset between cases."""
+
+    def __init__(self, interval: float = 0.002):
+        self.interval = interval
+        self.peak = _rss_bytes()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, _rss_bytes())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, _rss_bytes())
+
+def _run_case(name: str, fn: Callable, bgr: np.ndarray, dets: List[Dict],
+              repeat: int, warmup: int, **info) -> Dict:
+    case = {"name": name, **info}
+    try:
+        for _ in range(warmup):
+            fn(bgr, dets)
+        gc.collect()
+        times = []
+        with _PeakRss() as rss:
+            for _ in range(repeat):
+                t0 = time.perf_counter()
+                fn(bgr, dets)
+                times.append(time.perf_counter() - t0)
+    except Exception as e:
+        case["error"] = f"{type(e).__name__}: {e}"
+        print(f"  {name:<44} ERROR {case['error']}")
+        return case
+
+    t = np.asarray(times) * 1000.0
+    mp = bgr.shape[0] * bgr.shape[1] / 1e6
+    p50 = float(np.percentile(t, 50))
+    case.update({
+        "runs": repeat,
+        "p50_ms": round(p50, 3),
+        "p95_ms": round(float(np.percentile(t, 95)), 3),
+        "mean_ms": round(float(t.mean()), 3),
+        "images_per_s": round(1000.0 / max(p50, 1e-9), 3),
+        "mp_per_s": round(mp * 1000.0 / max(p50, 1e-9), 3),
+        "peak_rss_mb": round(rss.peak / 2**20, 1),
+    })
+    print(f"  {name:<44} p50 {case['p50_ms']:>10.1f} ms  p95 {case['p95_ms']:>10.1f} ms  "
+          f"{case['mp_per_s']:>8.1f} MP/s  rss {case['peak_rss_mb']:>8.1f} MB")
+    return case
+
+
+# =========================
+# Suites
+# =========================
+def run_synthetic(ops: List[str], mps: List[float], box_counts: List[int], repeat: int, warmup: int,
+                  stub: bool, seed: int) -> List[Dict]:
+    cases = []
+    for mp in mps:
+        bgr = synthetic_image(mp, seed=seed)
+        H, W = bgr.shape[:2]
+        print(f"[{mp:g} MP] {W}x{H}")
+        for op in ops:
+            fn, takes_boxes = OPS[op]
+            # Real detectors decide their own box count; only the stub honours the axis.
+            counts = box_counts if takes_boxes and (stub or op not in _DETECT_OPS) else [None]
+            for n in counts:
+                if op in _DETECT_OPS and stub:
+                    detect.use_stub_detectors(n)
+                dets = synthetic_dets(n or 0, W, H, seed=seed)
+                name = f"{op}/{mp:g}mp" + (f"/{n}boxes" if n is not None else "")
+                cases.append(_run_case(name, fn, bgr, dets, repeat, warmup,
+                                       suite="synthetic", op=op, megapixels=mp, boxes=n))
+        del bgr
+        gc.collect()
+    return cases
+
+def run_fixtures(ops: List[str], repeat: int, warmup: int) -> List[Dict]:
+    """The checked-in detections in jsons/ applied to their source images in imgs/."""
+    cases = []
+    print("[fixtures]")
+    for json_path in sorted(glob.glob(os.path.join(HERE, "jsons", "*.json"))):
+        kind, _, stem = os.path.splitext(os.path.basename(json_path))[0].partition("_")
+        img_path = os.path.join(HERE, "imgs", stem + ".jpg")
+        bgr = cv2.imread(img_path)
+        if bgr is None or kind not in _FIXTURE_OPS:
+            continue
+        dets = _load_fixture(json_path)
+        for op in _FIXTURE_OPS[kind]:
+            if op not in ops:
+                continue
+            cases.append(_run_case(f"fixture/{op}/{stem}", OPS[op][0], bgr, dets, repeat, warmup,
+                                   suite="fixture", op=op, megapixels=round(bgr.shape[0] * bgr.shape[1] / 1e6, 2),
+                                   boxes=len(dets)))
+    return cases
+
+
+# =========================
+# Baseline comparison
+# =========================
+def compare(results: Dict, baseline: Dict, threshold: float, noise_ms: float) -> List[Dict]:
+    """
+    Cases whose p50 latency or peak RSS grew by more than `threshold` (fraction) over the
+    baseline. Latency changes smaller than noise_ms are ignored regardless of ratio.
+    """
+    base = {c["name"]: c for c in baseline.get("cases", []) if "error" not in c}
+    regressions = []
+    for c in results["cases"]:
+        b = base.get(c["name"])
+        if b is None or "error" in c:
+            continue
+        for key, floor in (("p50_ms", noise_ms), ("peak_rss_mb", 0.0)):
+            old, new = b.get(key), c.get(key)
+            if not old or new is None or new - old <= floor:
+                continue
+            if new / old > 1.0 + threshold:
+                regressions.append({"name": c["name"], "metric": key, "baseline": old, "current": new,
+                                    "ratio": round(new / old, 3)})
+    return regressions
+
+def _meta(args) -> Dict:
+    try:
+        rev = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             cwd=HERE).stdout.strip()
+    except Exception:
+        rev = ""
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git_rev": rev,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "cv2_threads": cv2.getNumThreads(),
+        "detectors": "stub" if args.stub_detectors else "real",
+        "repeat": args.repeat,
+        "warmup": args.warmup,
+        "seed": args.seed,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark detectors, obfuscators and the encoder on synthetic and fixture images.")
+    ap.add_argument("-o", "--output", default="results/bench.json", help="Results JSON path")
+    ap.add_argument("--ops", default=",".join(DEFAULT_OPS),
+                    help=f"Comma-separated subset of: {', '.join(OPS)} (default: all but {', '.join(sorted(_GPU_OPS))})")
+    ap.add_argument("--mp", default=DEFAULT_MP, help="Comma-separated synthetic image sizes in megapixels")
+    ap.add_argument("--boxes", default=DEFAULT_BOXES, help="Comma-separated detection counts")
+    ap.add_argument("-r", "--repeat", type=int, default=5, help="Timed runs per case")
+    ap.add_argument("--warmup", type=int, default=1, help="Untimed runs per case")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--threads", type=int, default=0, help="cv2.setNumThreads (0 = OpenCV default)")
+    ap.add_argument("--real-detectors", dest="stub_detectors", action="store_false",
+                    help="Load the real face/plate models instead of the weight-free stub")
+    ap.add_argument("--no-fixtures", action="store_true", help="Skip the jsons/ fixture suite")
+    ap.add_argument("--compare", default="", help="Baseline results JSON; exit 1 on regressions")
+    ap.add_argument("--threshold", type=float, default=0.15, help="Allowed slowdown / RSS growth as a fraction")
+    ap.add_argument("--noise-ms", type=float, default=0.5, help="Ignore p50 changes smaller than this")
+    args = ap.parse_args()
+
+    ops = [o.strip() for o in args.ops.split(",") if o.strip()]
+    unknown = [o for o in ops if o not in OPS]
+    if unknown:
+        ap.error(f"unknown ops: {', '.join(unknown)}")
+    if args.threads > 0:
+        cv2.setNumThreads(args.threads)
+    if args.stub_detectors:
+        detect.use_stub_detectors(0)
+
+    # Load the baseline up front so a bad path fails before a long run, not after.
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    mps = [float(v) for v in args.mp.split(",") if v.strip()]
+    box_counts = [int(v) for v in args.boxes.split(",") if v.strip()]
+
+    cases = run_synthetic(ops, mps, box_counts, args.repeat, args.warmup, args.stub_detectors, args.seed)
+    if not args.no_fixtures:
+        cases += run_fixtures(ops, args.repeat, args.warmup)
+
+    results = {"meta": _meta(args), "cases": cases}
+    if baseline is not None:
+        results["regressions"] = compare(results, baseline, args.threshold, args.noise_ms)
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Done. Wrote {len(cases)} cases to {args.output}")
+
+    if baseline is not None:
+        regs = results["regressions"]
+        for r in regs:
+            print(f"REGRESSION {r['name']} {r['metric']}: {r['baseline']} -> {r['current']} (x{r['ratio']})")
+        if regs:
+            sys.exit(1)
+        print(f"No regressions against {args.compare} (threshold {args.threshold:.0%}).")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,8 +2,12 @@
 // Licensed under the Apache License, Version 2.0 that can be found in the
 // LICENSE file in the root directory of this source tree.
 
-import argparse, os, cv2, numpy as np, json
-from typing import List, Dict, Tuple
+import argparse, os, cv2, numpy as np
+from typing import List, Dict, Optional, Tuple
+
+from detections import load_detections
+from masks import stamp_ellipse
+from metrics import span
 
 
 def _odd(n: int) -> int:
@@ -14,98 +18,129 @@ def _denorm_xyxy(b, W: int, H: int) -> Tuple[int, int, int, int]:
     x2 = int(round(float(b[2]) * W)); y2 = int(round(float(b[3]) * H))
     return x1, y1, x2, y2
 
-def _assert_in_bounds(x1, y1, x2, y2, W, H, what):
-    if x1 < 0 or y1 < 0 or x2 > W or y2 > H:
-        raise ValueError(f"{what} exceeds image bounds {W}x{H}: {(x1, y1, x2, y2)}")
-    if x2 <= x1 or y2 <= y1:
-        raise ValueError(f"Invalid {what} geometry: {(x1, y1, x2, y2)}")
-
-def _expand_bbox(x1, y1, x2, y2, W, H, pct=0.18, what="expanded bbox"):
+def _expand_bbox(x1, y1, x2, y2, pct=0.18):
+    # Not clipped: a face cut by the frame edge keeps its true size and centre, and the
+    # mask stamped from it is clipped instead, so the visible part is always covered.
     bw, bh = x2 - x1, y2 - y1
     dx = int(round(bw * pct)); dy = int(round(bh * pct))
-    ex1, ey1, ex2, ey2 = x1 - dx, y1 - dy, x2 + dx, y2 + dy
-    _assert_in_bounds(ex1, ey1, ex2, ey2, W, H, what)
-    return ex1, ey1, ex2, ey2
+    return x1 - dx, y1 - dy, x2 + dx, y2 + dy
 
-def _ellipse_mask_from_bbox(h: int, w: int, box, grow=0.08, feather=111) -> np.ndarray:
+def _stamp_face_ellipse(dst: np.ndarray, box, grow=0.08, feather=111) -> None:
+    """Max a feathered ellipse around box into dst (see masks.py), clipped to the frame."""
     x1, y1, x2, y2 = box
+    if x2 <= x1 or y2 <= y1:
+        raise ValueError(f"Invalid face bbox geometry: {(x1, y1, x2, y2)}")
     bw, bh = x2 - x1, y2 - y1
     cx, cy = x1 + bw // 2, y1 + bh // 2
     rx, ry = int(bw * (0.5 + grow)), int(bh * (0.55 + grow))
-    _assert_in_bounds(cx - rx, cy - ry, cx + rx, cy + ry, w, h, "ellipse")
-    m = np.zeros((h, w), np.uint8)
-    cv2.ellipse(m, (cx, cy), (rx, ry), 0, 0, 360, 255, -1)
-    if feather > 0:
-        k = _odd(feather)
-        m = cv2.GaussianBlur(m, (k, k), 0)
-    return m
-
-def _ring_stats(gray: np.ndarray, mask: np.ndarray, ring: int = 14):
+    stamp_ellipse(dst, (cx, cy), (rx, ry), feather)
+
+def output_buffer(bgr: np.ndarray, out: Optional[np.ndarray] = None, inplace: bool = False) -> np.ndarray:
+    """
+    Destination image for an obfuscator: bgr itself when inplace, else `out` (same shape and
+    dtype; filled from bgr unless it is bgr), else a copy of bgr.
+    """
+    if inplace or out is bgr:
+        return bgr
+    if out is None:
+        return bgr.copy()
+    if out.shape != bgr.shape or out.dtype != bgr.dtype:
+        raise ValueError(f"out must be {bgr.shape} {bgr.dtype}, got {out.shape} {out.dtype}")
+    np.copyto(out, bgr)
+    return out
+
+def _ring_stats(gray: np.ndarray, mask: np.ndarray, ring: int = 14, exclude: Optional[np.ndarray] = None):
+    """Mean/std of gray in a ring-px band around mask, outside `exclude` (default: mask itself)."""
     dil = cv2.dilate(mask, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (ring*2+1, ring*2+1)))
-    ring_mask = cv2.subtract(dil, mask)
+    ring_mask = cv2.subtract(dil, mask if exclude is None else exclude)
     cnt = int(np.count_nonzero(ring_mask))
     if cnt == 0:
         return 0.0, 1.0
-    vals = gray[ring_mask > 0].astype(np.float32)
-    mu, sd = float(vals.mean()), float(vals.std() + 1e-6)
-    return mu, sd
-
-def _match_luma(src_bgr: np.ndarray, dst_bgr: np.ndarray, mask: np.ndarray) -> np.ndarray:
-    """Match luminance inside mask to the ambient luminance around it (reduces ‘pasted’ look)."""
-    yuv_src = cv2.cvtColor(src_bgr, cv2.COLOR_BGR2YCrCb).astype(np.float32)
-    yuv_dst = cv2.cvtColor(dst_bgr, cv2.COLOR_BGR2YCrCb).astype(np.float32)
-
-    src_y = yuv_src[..., 0]; dst_y = yuv_dst[..., 0]
-    mu_amb, sd_amb = _ring_stats(src_y.astype(np.uint8), mask, ring=14)
-
-    inside = mask > 0
-    if np.count_nonzero(inside) > 0:
-        mu_in = float(dst_y[inside].mean())
-        sd_in = float(dst_y[inside].std() + 1e-6)
-        dst_y[inside] = (dst_y[inside] - mu_in) * (sd_amb / sd_in) + mu_amb
-
-    yuv_dst[..., 0] = np.clip(dst_y, 0, 255)
-    out = cv2.cvtColor(yuv_dst.astype(np.uint8), cv2.COLOR_YCrCb2BGR)
+    mu, sd = cv2.meanStdDev(gray, mask=ring_mask)
+    return float(mu[0, 0]), float(sd[0, 0] + 1e-6)
+
+def _match_luma(src_bgr: np.ndarray, dst_bgr: np.ndarray, mask: np.ndarray, ring: int = 14) -> np.ndarray:
+    """
+    Match luminance inside mask to the ambient luminance around it (reduces ‘pasted’ look).
+    Each connected region of the mask (one face, or faces that touch) is matched to its own
+    ring, so faces in different lighting are corrected independently. All work happens in
+    the region's bounding box grown by the ring; only pixels inside the mask change.
+    dst_bgr is modified in place and returned.
+    """
+    out = dst_bgr
+    H, W = mask.shape[:2]
+    contours, _ = cv2.findContours((mask > 0).astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    for c in contours:
+        cx, cy, cw, ch = cv2.boundingRect(c)
+        x1, y1 = max(0, cx - ring - 1), max(0, cy - ring - 1)
+        x2, y2 = min(W, cx + cw + ring + 1), min(H, cy + ch + ring + 1)
+
+        # This region's mask in ROI coordinates; other regions stay out of its ring via `exclude`.
+        all_roi = mask[y1:y2, x1:x2]
+        region = np.zeros_like(all_roi)
+        cv2.drawContours(region, [c], -1, 255, -1, offset=(-x1, -y1))
+        comp = cv2.bitwise_and(all_roi, region)
+
+        src_y = cv2.cvtColor(src_bgr[y1:y2, x1:x2], cv2.COLOR_BGR2YCrCb)[..., 0]
+        mu_amb, sd_amb = _ring_stats(src_y, comp, ring=ring, exclude=all_roi)
+
+        # y' = (y - mu_in) * sd_amb / sd_in + mu_amb, saturated to uint8, on this ROI only
+        yuv_dst = cv2.cvtColor(dst_bgr[y1:y2, x1:x2], cv2.COLOR_BGR2YCrCb)
+        dst_y = yuv_dst[..., 0].copy()
+        mu_in, sd_in = cv2.meanStdDev(dst_y, mask=comp)
+        gain = sd_amb / float(sd_in[0, 0] + 1e-6)
+        yuv_dst[..., 0] = cv2.addWeighted(dst_y, gain, dst_y, 0.0, mu_amb - float(mu_in[0, 0]) * gain)
+
+        matched = cv2.cvtColor(yuv_dst, cv2.COLOR_YCrCb2BGR)
+        np.copyto(out[y1:y2, x1:x2], matched, where=(comp > 0)[..., None])
     return out
 
 def _two_zone_masks(union_mask: np.ndarray, halo_px: int) -> Tuple[np.ndarray, np.ndarray]:
-    """Return (inner_mask, halo_mask) where halo is a soft ring outside the inner region."""
+    """
+    Return (inner_mask, halo_mask) where halo is a soft ring outside the inner region.
+    Blur -> dilate -> blur reaches at most 3 kernel radii past the union, so the work is
+    done on the union's bounding box grown by 4 radii; outside it both masks are 0.
+    """
     if halo_px < 3:
         halo_px = 3
     k = _odd(halo_px * 2 + 1)
-    base = cv2.GaussianBlur(union_mask, (k, k), 0)
+    H, W = union_mask.shape[:2]
+    inner = np.zeros_like(union_mask)
+    halo = np.zeros_like(union_mask)
+    bx, by, bw, bh = cv2.boundingRect(union_mask)
+    if bw == 0 or bh == 0:
+        return inner, halo
+    p = 4 * (k // 2) + 1
+    x1, y1, x2, y2 = max(0, bx - p), max(0, by - p), min(W, bx + bw + p), min(H, by + bh + p)
+
+    roi = union_mask[y1:y2, x1:x2]
+    base = cv2.GaussianBlur(roi, (k, k), 0)
     dil = cv2.dilate(base, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (k, k)))
     halo_soft = cv2.GaussianBlur(dil, (k, k), 0)
     halo_soft = np.maximum(halo_soft, base)
-    inner = base
-    halo = np.clip(halo_soft.astype(np.int16) - inner.astype(np.int16), 0, 255).astype(np.uint8)
+    inner[y1:y2, x1:x2] = base
+    halo[y1:y2, x1:x2] = cv2.subtract(halo_soft, base)
     return inner, halo
 
 def _gaussian(img: np.ndarray, k: int) -> np.ndarray:
     return cv2.GaussianBlur(img, (_odd(k), _odd(k)), 0, borderType=cv2.BORDER_REPLICATE)
 
 
-def blur_faces(bgr: np.ndarray, dets: List[Dict]) -> np.ndarray:
+def face_blur_masks(H: int, W: int, dets: List[Dict]) -> Tuple[np.ndarray, np.ndarray, int, int]:
     """
-    Very-strong two-zone blur for faces.
-    Call with: out = blur_faces(image_bgr, face_detections)
-      - image_bgr: HxWx3 BGR uint8
-      - face_detections: list of dicts with key "bbox_xyxy" in normalized [0..1] xyxy
-    All strengths/shapes are fixed within this function.
+    Build the blur geometry for blur_faces: (inner_mask, halo_mask, k_inner, k_halo).
+    Depends only on the frame size and the boxes, so callers that re-apply the same
+    boxes (e.g. tracked boxes in video.py) can compute it once and pass it back in.
     """
-    if not dets:
-        return bgr
-    H, W = bgr.shape[:2]
-    out = bgr.copy()
-
     # Build a union mask of all faces (elliptical, expanded, wide feather)
     union = np.zeros((H, W), np.uint8)
     max_min_dim = 0
     for d in dets:
         x1, y1, x2, y2 = _denorm_xyxy(d["bbox_xyxy"], W, H)
-        x1, y1, x2, y2 = _expand_bbox(x1, y1, x2, y2, W, H, pct=0.18, what="face bbox")
+        x1, y1, x2, y2 = _expand_bbox(x1, y1, x2, y2, pct=0.18)
         max_min_dim = max(max_min_dim, min(x2 - x1, y2 - y1))
-        union = np.maximum(union, _ellipse_mask_from_bbox(H, W, (x1, y1, x2, y2), grow=0.08, feather=111))
+        _stamp_face_ellipse(union, (x1, y1, x2, y2), grow=0.08, feather=111)
 
     # Fixed strengths and halo reach (derived from bbox size)
     k_inner = int(np.clip(max_min_dim * 0.65, 61, 181))  # was 0.55 → stronger inner blur
@@ -113,41 +148,73 @@ def blur_faces(bgr: np.ndarray, dets: List[Dict]) -> np.ndarray:
     halo_px = int(np.clip(max_min_dim * 0.32, 32, 140))  # was 0.26 → wider halo reach
 
     inner_mask, halo_mask = _two_zone_masks(union, halo_px)
+    return inner_mask, halo_mask, k_inner, k_halo
 
-    # Create blurred variants (double-pass inside for extra strength)
-    inner_blur = _gaussian(out, k_inner)
+
+def blur_faces(bgr: np.ndarray, dets: List[Dict],
+               masks: Optional[Tuple[np.ndarray, np.ndarray, int, int]] = None,
+               *, out: Optional[np.ndarray] = None, inplace: bool = False) -> np.ndarray:
+    """
+    Very-strong two-zone blur for faces.
+    Call with: out = blur_faces(image_bgr, face_detections)
+      - image_bgr: HxWx3 BGR uint8
+      - face_detections: list of dicts with key "bbox_xyxy" in normalized [0..1] xyxy
+      - masks: optional precomputed face_blur_masks(H, W, face_detections)
+      - out / inplace: write into `out`, or into image_bgr itself, instead of a copy
+    All strengths/shapes are fixed within this function.
+    """
+    if not dets:
+        return bgr if out is None else output_buffer(bgr, out)
+    H, W = bgr.shape[:2]
+
+    if masks is None:
+        masks = face_blur_masks(H, W, dets)
+    inner_mask, halo_mask, k_inner, k_halo = masks
+
+    # Create blurred variants (double-pass inside for extra strength); bgr is only read
+    inner_blur = _gaussian(bgr, k_inner)
     inner_blur = _gaussian(inner_blur, k_inner)
-    halo_blur  = _gaussian(out, k_halo)
+    halo_blur  = _gaussian(bgr, k_halo)
 
-    # Luma-match each region to ambient ring around union
-    inner_matched = _match_luma(out, inner_blur, inner_mask)
-    halo_matched  = _match_luma(out, halo_blur, halo_mask)
+    # Luma-match each region to ambient ring around union (writes into the blurred copies)
+    inner_matched = _match_luma(bgr, inner_blur, inner_mask)
+    halo_matched  = _match_luma(bgr, halo_blur, halo_mask)
 
-    # Blend: almost opaque inside, noticeable outside
-    a_in   = (inner_mask.astype(np.float32) / 255.0)[..., None] * 1.00  # was 0.98
-    a_halo = (halo_mask.astype(np.float32)  / 255.0)[..., None] * 0.60  # was 0.50
+    # Blend: almost opaque inside, noticeable outside. Outside the masks' bounding box both
+    # weights are 0, so only that box is blended and written.
+    x, y, w, h = cv2.boundingRect(cv2.max(inner_mask, halo_mask))
+    ys, xs = slice(y, y + h), slice(x, x + w)
+    a_in   = (inner_mask[ys, xs].astype(np.float32) / 255.0)[..., None] * 1.00  # was 0.98
+    a_halo = (halo_mask[ys, xs].astype(np.float32)  / 255.0)[..., None] * 0.60  # was 0.50
 
-    tmp = (a_in * inner_matched + (1.0 - a_in) * out).astype(np.uint8)
-    res = (a_halo * halo_matched + (1.0 - a_halo) * tmp).astype(np.uint8)
-    return res
+    base = bgr[ys, xs]
+    tmp = (a_in * inner_matched[ys, xs] + (1.0 - a_in) * base).astype(np.uint8)
+    res = (a_halo * halo_matched[ys, xs] + (1.0 - a_halo) * tmp).astype(np.uint8)
+
+    out = output_buffer(bgr, out, inplace)
+    out[ys, xs] = res
+    return out
 
 
 
-def blur_plates(bgr: np.ndarray, dets: List[Dict]) -> np.ndarray:
+def blur_plates(bgr: np.ndarray, dets: List[Dict], *,
+                out: Optional[np.ndarray] = None, inplace: bool = False) -> np.ndarray:
     """
     Strong rectangular blur over each plate bbox using triple-pass Gaussian
     + downsample/upsample pixelation. No halo/luma-match. In-place safe.
       - image_bgr: HxWx3 BGR uint8
       - plate_detections: list of dicts with key "bbox_xyxy" in normalized [0..1] xyxy
+      - out / inplace: write into `out`, or into image_bgr itself, instead of a copy
     """
     if not dets:
-        return bgr
-    out = bgr.copy()
+        return bgr if out is None else output_buffer(bgr, out)
+    out = output_buffer(bgr, out, inplace)
     H, W = out.shape[:2]
 
     for d in dets:
         x1, y1, x2, y2 = _denorm_xyxy(d["bbox_xyxy"], W, H)
-        _assert_in_bounds(x1, y1, x2, y2, W, H, "plate bbox")
+        # a plate cut by the frame edge is blurred up to the edge
+        x1, y1, x2, y2 = max(0, x1), max(0, y1), min(W, x2), min(H, y2)
 
         bw, bh = x2 - x1, y2 - y1
         if bw <= 1 or bh <= 1:
@@ -180,28 +247,6 @@ def blur_plates(bgr: np.ndarray, dets: List[Dict]) -> np.ndarray:
     return out
 
 
-def _load_detections(json_path: str) -> List[Dict]:
-    """
-    Load detections from a JSON file.
-    Expected format: a list of dicts, each with 'bbox_xyxy' (normalized xyxy).
-    Other keys like 'confidence' or 'attributes' are ignored by this script.
-    """
-    with open(json_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    if not isinstance(data, list):
-        raise ValueError("Detections JSON must be a list of objects.")
-    # Minimal validation
-    out = []
-    for d in data:
-        if "bbox_xyxy" not in d:
-            continue
-        bb = d["bbox_xyxy"]
-        if not (isinstance(bb, (list, tuple)) and len(bb) == 4):
-            continue
-        out.append({"bbox_xyxy": bb})
-    return out
-
-
 def main():
     ap = argparse.ArgumentParser(description="Blur faces OR plates using precomputed detections from JSON.")
     ap.add_argument("-i", "--input", required=True, help="Input image path")
@@ -210,25 +255,25 @@ def main():
     ap.add_argument("-t", "--target", choices=["face", "plate"], default="face")
     args = ap.parse_args()
 
-    bgr = cv2.imread(args.input)
+    with span("image.decode"):
+        bgr = cv2.imread(args.input)
     if bgr is None:
         raise FileNotFoundError(args.input)
 
-    dets = _load_detections(args.json)
+    dets = load_detections(args.json)
 
-    if args.target == "face":
-        out = blur_faces(bgr, dets)
-        suffix = "_face_blur.jpg"
-        if not dets:
-            print("No face boxes in JSON — output will equal input.")
-    else:
-        out = blur_plates(bgr, dets)
-        suffix = "_plate_blur.jpg"
-        if not dets:
-            print("No plate boxes in JSON — output will equal input.")
+    with span(f"obfuscate.blur_{args.target}"):
+        if args.target == "face":
+            out = blur_faces(bgr, dets)
+        else:
+            out = blur_plates(bgr, dets)
+    suffix = f"_{args.target}_blur.jpg"
+    if not dets:
+        print(f"No {args.target} boxes in JSON — output will equal input.")
 
     out_path = args.output or os.path.splitext(args.input)[0] + suffix
-    cv2.imwrite(out_path, out)
+    with span("image.encode"):
+        cv2.imwrite(out_path, out)
     print(f"Done. Wrote: {out_path}")
 
 
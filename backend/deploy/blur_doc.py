@@ -3,19 +3,20 @@
 // LICENSE file in the root directory of this source tree.
 
 # doc_detect.py — robust document-in-photo detector with full-frame rejection + blur output
-import argparse, json, math, os
+import argparse, math, os
 from dataclasses import dataclass
 from typing import List, Tuple, Optional
 
 import cv2
 import numpy as np
 
-_HAS_PADDLE = False
-try:
-    from paddleocr import PaddleOCR  # pip install paddleocr
-    _HAS_PADDLE = True
-except Exception:
-    _HAS_PADDLE = False
+from blur import output_buffer
+from detections import save_detections
+from lazy import module_available
+from metrics import span
+
+# Checked without importing; PaddleOCR itself loads on the first OCR proposal.
+_HAS_PADDLE = module_available("paddleocr")  # pip install paddleocr
 
 
 # =========================
@@ -226,9 +227,10 @@ def _proposals_lines(small: np.ndarray, full_W: int, full_H: int, inv_scale: flo
                             minLineLength=max(20, min(Ws, Hs)//5), maxLineGap=20)
     if lines is None or len(lines) < 2:
         return []
-    segs = [l[0] for l in lines]
-    xs = np.r_[ [s[0] for s in segs], [s[2] for s in segs] ]
-    ys = np.r_[ [s[1] for s in segs], [s[3] for s in segs] ]
+    # (N,1,4) or (N,4) depending on the OpenCV build
+    segs = np.asarray(lines).reshape(-1, 4)
+    xs = np.r_[segs[:, 0], segs[:, 2]]
+    ys = np.r_[segs[:, 1], segs[:, 3]]
     x1, y1, x2, y2 = int(np.min(xs)), int(np.min(ys)), int(np.max(xs)), int(np.max(ys))
 
     X1 = _clip(int(round(x1 * inv_scale)), 0, full_W-1)
@@ -285,9 +287,14 @@ def _dedup_high_iou(boxes: List[Box], iou_thr: float = 0.70) -> List[Box]:
 # ==========================================
 _OCR = None
 def _ensure_ocr():
-    global _OCR
+    global _OCR, _HAS_PADDLE
     if not _HAS_PADDLE: return None
     if _OCR is None:
+        try:
+            from paddleocr import PaddleOCR
+        except Exception:
+            _HAS_PADDLE = False
+            return None
         _OCR = PaddleOCR(det_model_dir=None, use_angle_cls=False, lang='en', show_log=False)
     return _OCR
 
@@ -315,6 +322,25 @@ def _proposals_paddleocr(bgr: np.ndarray) -> List[Box]:
     return [Box(x1, y1, x2, y2, float(min(1.0, conf)), "paddleocr")]
 
 
+# ========================
+# Scene gate
+# ========================
+def document_gate_score(bgr: np.ndarray, max_side: int = 800) -> float:
+    """
+    Best proposal confidence from a single 800 px pass (illumination normalized at that
+    size only). 0.0 means no document-like region; the full detect_documents runs three
+    scales up to 1600 px plus normalization at full resolution, about 10x the cost.
+    """
+    if bgr is None or bgr.size == 0:
+        return 0.0
+    H, W = bgr.shape[:2]
+    small, s = _resize_limit(bgr, max_side=max_side)
+    small = _illum_normalize(small)
+    inv = 1.0 / s
+    props = _proposals_contour(small, W, H, inv) + _proposals_textish(small, W, H, inv) + _proposals_lines(small, W, H, inv)
+    return max((p.conf for p in props if not _reject_fullframe_like(p.x1, p.y1, p.x2, p.y2, W, H)), default=0.0)
+
+
 # ========================
 # Multi-scale main detect
 # ========================
@@ -397,42 +423,102 @@ def _draw_preview(bgr: np.ndarray, dets: List[dict]) -> np.ndarray:
 
 
 # =========================
-# Blur all detected regions
+# Obfuscate detected regions
 # =========================
-def _blur_documents(bgr: np.ndarray, dets: List[dict],
-                    sigma: float = 25.0,
-                    feather_px_ratio: float = 0.01) -> np.ndarray:
+DOC_METHODS = ("blur", "pixelate")
+
+def _doc_rects(dets: List[dict], W: int, H: int) -> List[Tuple[int, int, int, int]]:
+    rects = []
+    for d in dets:
+        x1n, y1n, x2n, y2n = d["bbox_xyxy"]
+        x1 = _clip(int(round(x1n * W)), 0, W); y1 = _clip(int(round(y1n * H)), 0, H)
+        x2 = _clip(int(round(x2n * W)), 0, W); y2 = _clip(int(round(y2n * H)), 0, H)
+        if x2 - x1 > 1 and y2 - y1 > 1:
+            rects.append((x1, y1, x2, y2))
+    return rects
+
+def _merge_rects(rects: List[Tuple[int, int, int, int]]) -> List[Tuple[int, int, int, int]]:
+    """Merge overlapping rectangles until none overlap, so shared pixels are processed once."""
+    rects = list(rects)
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(rects)):
+            for j in range(i + 1, len(rects)):
+                a, b = rects[i], rects[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    rects[i] = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                    del rects[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return rects
+
+def _strong_blur(roi: np.ndarray, sigma: float) -> np.ndarray:
+    # A Gaussian of sigma s on a copy downscaled by f equals one of sigma s/f at full size,
+    # at roughly 1/f^2 the cost; f is capped so the small copy keeps ~4 px per sigma.
+    f = max(1, int(sigma // 4))
+    h, w = roi.shape[:2]
+    if f > 1 and min(h, w) // f >= 8:
+        small = cv2.resize(roi, (max(1, w // f), max(1, h // f)), interpolation=cv2.INTER_AREA)
+        small = cv2.GaussianBlur(small, (0, 0), sigmaX=sigma / f, sigmaY=sigma / f, borderType=cv2.BORDER_REPLICATE)
+        return cv2.resize(small, (w, h), interpolation=cv2.INTER_LINEAR)
+    return cv2.GaussianBlur(roi, (0, 0), sigmaX=sigma, sigmaY=sigma, borderType=cv2.BORDER_REPLICATE)
+
+def _pixelate(roi: np.ndarray, cell: int) -> np.ndarray:
+    h, w = roi.shape[:2]
+    small = cv2.resize(roi, (max(1, w // cell), max(1, h // cell)), interpolation=cv2.INTER_AREA)
+    return cv2.resize(small, (w, h), interpolation=cv2.INTER_NEAREST)
+
+def blur_documents(bgr: np.ndarray, dets: List[dict], *,
+                   strength: Optional[float] = None,
+                   method: str = "blur",
+                   feather_px_ratio: float = 0.01,
+                   out: Optional[np.ndarray] = None,
+                   inplace: bool = False) -> np.ndarray:
     """
-    Blur all detected boxes with soft edges.
-    - sigma: Gaussian sigma for blur strength (0,0) kernel with sigmaX/Y
+    Obfuscate all detected document boxes with soft edges, touching only their neighbourhood.
+    - strength: Gaussian sigma for "blur" (default 25), mosaic cell size in px for "pixelate"
+      (default 1/80 of the longer side, at least 8)
+    - method: "blur" or "pixelate" (cheaper on large regions and keeps text unreadable)
     - feather_px_ratio: feather width relative to max(H,W)
+    Boxes are padded by the feather band, overlapping pads are merged, and each merged
+    ROI is obfuscated and composited on its own; pixels outside them are never read.
+    - out / inplace: write into `out`, or into bgr itself, instead of a copy
     """
+    if method not in DOC_METHODS:
+        raise ValueError(f"method must be one of {DOC_METHODS}")
     H, W = bgr.shape[:2]
-    if not dets:
-        return bgr.copy()
+    out = output_buffer(bgr, out, inplace)
+    rects = _doc_rects(dets, W, H)
+    if not rects:
+        return out
+    if strength is None:
+        strength = 25.0 if method == "blur" else max(8, max(H, W) // 80)
 
-    # 1) A globally blurred version (so overlapping boxes blend naturally)
-    blurred = cv2.GaussianBlur(bgr, (0, 0), sigmaX=sigma, sigmaY=sigma)
-
-    # 2) Build a soft mask from all boxes
-    mask = np.zeros((H, W), np.uint8)
-    for d in dets:
-        x1n, y1n, x2n, y2n = d["bbox_xyxy"]
-        x1 = _clip(int(round(x1n * W)), 0, W-1); y1 = _clip(int(round(y1n * H)), 0, H-1)
-        x2 = _clip(int(round(x2n * W)), 0, W-1); y2 = _clip(int(round(y2n * H)), 0, H-1)
-        if x2 <= x1 or y2 <= y1:
-            continue
-        cv2.rectangle(mask, (x1, y1), (x2, y2), 255, -1)
-
-    # Feather mask edges for nicer transitions
     feather = max(3, int(round(feather_px_ratio * max(H, W))))
     if feather % 2 == 0:
         feather += 1
-    soft_mask = cv2.GaussianBlur(mask, (feather, feather), 0)
-
-    # 3) Composite: out = soft_mask * blurred + (1-soft_mask) * original
-    soft = (soft_mask.astype(np.float32) / 255.0)[..., None]  # HxWx1
-    out = (soft * blurred.astype(np.float32) + (1.0 - soft) * bgr.astype(np.float32)).astype(np.uint8)
+    pad = feather // 2 + 1
+    padded = [(max(0, x1 - pad), max(0, y1 - pad), min(W, x2 + pad), min(H, y2 + pad)) for x1, y1, x2, y2 in rects]
+
+    for rx1, ry1, rx2, ry2 in _merge_rects(padded):
+        roi = out[ry1:ry2, rx1:rx2]
+        if method == "blur":
+            obf = _strong_blur(roi, strength)
+        else:
+            obf = _pixelate(roi, max(2, int(round(strength))))
+
+        # Hard mask of the boxes inside this ROI, softened only across the feather band.
+        mask = np.zeros(roi.shape[:2], np.uint8)
+        for x1, y1, x2, y2 in rects:
+            if x1 < rx2 and rx1 < x2 and y1 < ry2 and ry1 < y2:
+                cv2.rectangle(mask, (x1 - rx1, y1 - ry1), (x2 - rx1 - 1, y2 - ry1 - 1), 255, -1)
+        soft = cv2.GaussianBlur(mask, (feather, feather), 0)
+
+        w = soft.astype(np.float32) * (1.0 / 255.0)
+        roi[:] = cv2.blendLinear(obf, roi, w, 1.0 - w)
     return out
 
 
@@ -450,13 +536,17 @@ def main():
     ap.add_argument("-o", "--output", required=False, default="")
     ap.add_argument("-k", "--topk", type=int, default=3)
     ap.add_argument("-j", "--json", required=False, default="")  # 添加 JSON 输出参数
+    ap.add_argument("--method", choices=DOC_METHODS, default="blur", help="How -o obfuscates the documents")
+    ap.add_argument("--strength", type=float, default=None, help="Blur sigma / pixelate cell size for -o")
     args = ap.parse_args()
 
-    bgr = _imread_any(args.input)
+    with span("image.decode"):
+        bgr = _imread_any(args.input)
     if bgr is None:
         raise FileNotFoundError(args.input)
 
-    dets = detect_documents(bgr, max_outputs=args.topk)
+    with span("detect.document"):
+        dets = detect_documents(bgr, max_outputs=args.topk)
 
     # 如果有指定 JSON 输出路径，使用它
     if args.json:
@@ -466,11 +556,15 @@ def main():
         base = os.path.splitext(os.path.basename(args.input))[0]
         json_path = os.path.join(in_dir, base + "_doc.json")
 
-    # 保存 JSON
-    with open(json_path, "w", encoding="utf-8") as f:
-        json.dump(dets, f, indent=2)
+    # 保存检测结果（.npz 为二进制格式，其他后缀为 JSON）
+    save_detections(json_path, dets)
+
+    if args.output:
+        with span(f"obfuscate.{args.method}_document"):
+            out = blur_documents(bgr, dets, strength=args.strength, method=args.method)
+        with span("image.encode"):
+            cv2.imwrite(args.output, out)
 
-    # 其余代码保持不变...
     # 只打印 JSON 路径，以便调用者知道在哪里可以找到它
     print(json_path)
 
@@ -0,0 +1,114 @@
+// Copyright 2025 The NoPeek Authors. All rights reserved.
+// Licensed under the Apache License, Version 2.0 that can be found in the
+// LICENSE file in the root directory of this source tree.
+
+# cache.py — result cache for obfuscated outputs: in-memory LRU bounded by bytes, backed by the upload store
+import asyncio, hashlib, json, threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import metrics
+from storage import UploadStore, atomic_write
+
+# Bump an entry whenever that algorithm's output changes, so stale results stop matching.
+ALGORITHM_VERSIONS: Dict[str, str] = {
+    "blur": "2",
+    "sticker": "2",
+    "cartoon": "1",
+}
+
+
+def detections_hash(dets: List[Dict]) -> str:
+    """Hash of what the obfuscators consume: box geometry (rounded) and attributes."""
+    canon = [{"b": [round(float(v), 5) for v in d["bbox_xyxy"]], "a": d.get("attributes", {})} for d in dets]
+    return hashlib.blake2b(json.dumps(canon, sort_keys=True).encode("utf-8"), digest_size=12).hexdigest()
+
+def result_key(*parts) -> str:
+    return hashlib.blake2b("\x1f".join(str(p) for p in parts).encode("utf-8"), digest_size=16).hexdigest()
+
+
+class ResultCache:
+    """
+    (bytes, mime) entries by key. The memory tier evicts least recently used entries
+    once it holds more than max_memory_bytes; the disk tier lives in the upload store's
+    objects/ namespace, so its TTL and size budget apply. Thread-safe.
+    """
+
+    def __init__(self, store: Optional[UploadStore] = None, max_memory_bytes: int = 256 << 20):
+        self.store = store
+        self.max_memory_bytes = max_memory_bytes
+        self._mem: "OrderedDict[str, Tuple[bytes, str]]" = OrderedDict()
+        self._mem_bytes = 0
+        self._lock = threading.Lock()
+
+    def _disk_path(self, key: str) -> str:
+        return self.store.object_path(key, ".result")
+
+    def _remember(self, key: str, data: bytes, mime: str) -> None:
+        if len(data) > self.max_memory_bytes:
+            return
+        with self._lock:
+            old = self._mem.pop(key, None)
+            if old is not None:
+                self._mem_bytes -= len(old[0])
+            self._mem[key] = (data, mime)
+            self._mem_bytes += len(data)
+            while self._mem_bytes > self.max_memory_bytes:
+                _, (evicted, _) = self._mem.popitem(last=False)
+                self._mem_bytes -= len(evicted)
+
+    def _get_memory(self, key: str) -> Optional[Tuple[bytes, str]]:
+        with self._lock:
+            hit = self._mem.get(key)
+            if hit is not None:
+                self._mem.move_to_end(key)
+        if hit is not None:
+            metrics.inc("nopeek_result_cache_total", result="memory")
+        return hit
+
+    def _get_disk(self, key: str) -> Optional[Tuple[bytes, str]]:
+        if self.store is not None:
+            path = self._disk_path(key)
+            try:
+                with open(path, "rb") as f:
+                    blob = f.read()
+            except FileNotFoundError:
+                blob = b""
+            if blob:
+                mime, _, data = blob.partition(b"\n")
+                self.store.touch(path)
+                self._remember(key, data, mime.decode("ascii"))
+                metrics.inc("nopeek_result_cache_total", result="disk")
+                return data, mime.decode("ascii")
+
+        metrics.inc("nopeek_result_cache_total", result="miss")
+        return None
+
+    def _write_disk(self, key: str, data: bytes, mime: str) -> None:
+        if self.store is not None:
+            # One file: "<mime>\n<bytes>".
+            atomic_write(self._disk_path(key), mime.encode("ascii") + b"\n" + data)
+
+    def get(self, key: str) -> Optional[Tuple[bytes, str]]:
+        hit = self._get_memory(key)
+        return hit if hit is not None else self._get_disk(key)
+
+    def put(self, key: str, data: bytes, mime: str) -> None:
+        self._remember(key, data, mime)
+        self._write_disk(key, data, mime)
+
+    async def get_async(self, key: str) -> Optional[Tuple[bytes, str]]:
+        """get() for event-loop callers: memory hits are answered inline, the disk tier in the default executor."""
+        hit = self._get_memory(key)
+        if hit is not None:
+            return hit
+        return await asyncio.get_running_loop().run_in_executor(None, self._get_disk, key)
+
+    async def put_async(self, key: str, data: bytes, mime: str) -> None:
+        """put() for event-loop callers: the memory tier is updated inline, the file written in the default executor."""
+        self._remember(key, data, mime)
+        if self.store is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self._write_disk, key, data, mime)
+
+    def memory_bytes(self) -> int:
+        return self._mem_bytes
@@ -0,0 +1,185 @@
+// Copyright 2025 The NoPeek Authors. All rights reserved.
+// Licensed under the Apache License, Version 2.0 that can be found in the
+// LICENSE file in the root directory of this source tree.
+
+# compositor.py — apply every obfuscation of a request to one decoded image in a single pass
+import argparse, os
+from typing import Callable, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from blur import blur_faces, blur_plates, face_blur_masks, output_buffer
+from blur_doc import blur_documents
+from detections import load_detections
+from metrics import span
+from sticker import place_face_stickers, place_plate_stickers
+
+TYPES = ("document", "plate", "face")          # also the paint order: faces end up on top
+MODES = ("blur", "sticker", "pixelate", "inpaint")
+DEFAULT_MODES: Dict[str, str] = {"face": "blur", "plate": "blur", "document": "blur"}
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+STICKERS_DIR = os.path.join(HERE, "stickers")
+PLATE_STICKER = os.path.join(STICKERS_DIR, "vecteezy_plate.png")
+
+
+# =========================
+# Pixelation
+# =========================
+def _box_rects(H: int, W: int, dets: List[Dict]) -> List[Tuple[int, int, int, int]]:
+    rects = []
+    for d in dets:
+        x1n, y1n, x2n, y2n = d["bbox_xyxy"]
+        x1 = min(max(int(round(float(x1n) * W)), 0), W); y1 = min(max(int(round(float(y1n) * H)), 0), H)
+        x2 = min(max(int(round(float(x2n) * W)), 0), W); y2 = min(max(int(round(float(y2n) * H)), 0), H)
+        if x2 - x1 > 1 and y2 - y1 > 1:
+            rects.append((x1, y1, x2, y2))
+    return rects
+
+def pixelate_regions(bgr: np.ndarray, dets: List[Dict], blocks: int = 10, *,
+                     out: Optional[np.ndarray] = None, inplace: bool = False) -> np.ndarray:
+    """
+    Mosaic each box with about `blocks` cells across its shorter side. Only the box
+    pixels are read and written; with inplace=True the rest of the frame is never touched.
+    """
+    if not dets:
+        return bgr if out is None else output_buffer(bgr, out)
+    out = output_buffer(bgr, out, inplace)
+    H, W = out.shape[:2]
+    for x1, y1, x2, y2 in _box_rects(H, W, dets):
+        bw, bh = x2 - x1, y2 - y1
+        cell = max(2, min(bw, bh) // max(1, blocks))
+        small = cv2.resize(out[y1:y2, x1:x2], (max(1, bw // cell), max(1, bh // cell)), interpolation=cv2.INTER_AREA)
+        out[y1:y2, x1:x2] = cv2.resize(small, (bw, bh), interpolation=cv2.INTER_NEAREST)
+    return out
+
+
+# =========================
+# Effects per (type, mode)
+# =========================
+# Each effect writes into the buffer it is given; inpainting builds a new image, which
+# composite() copies back.
+def _inpaint_faces(bgr, dets, ctx):
+    from inpaint import inpaint_faces  # torch/diffusers: only imported when asked for
+    return inpaint_faces(bgr, dets, engine=ctx.get("inpaint_engine", "auto"), quality=ctx.get("quality", "final"))
+
+def _inpaint_plates(bgr, dets, ctx):
+    from inpaint import inpaint_plates
+    return inpaint_plates(bgr, dets, engine=ctx.get("inpaint_engine", "auto"))
+
+def _face_blur(bgr, dets, ctx):
+    return blur_faces(bgr, dets, masks=ctx.get("face_masks"), inplace=True)
+
+def _face_sticker(bgr, dets, ctx):
+    return place_face_stickers(bgr, dets, stickers_dir=ctx.get("stickers_dir", STICKERS_DIR),
+                               expand_pct=0.25, seed=ctx.get("seed"), inplace=True)
+
+def _doc_effect(method: str):
+    return lambda bgr, dets, ctx: blur_documents(bgr, dets, strength=ctx.get("doc_strength"), method=method,
+                                                 inplace=True)
+
+_EFFECTS: Dict[Tuple[str, str], Callable[[np.ndarray, List[Dict], Dict], np.ndarray]] = {
+    ("face", "blur"): _face_blur,
+    ("face", "sticker"): _face_sticker,
+    ("face", "pixelate"): lambda bgr, dets, ctx: pixelate_regions(bgr, dets, inplace=True),
+    ("face", "inpaint"): _inpaint_faces,
+    ("plate", "blur"): lambda bgr, dets, ctx: blur_plates(bgr, dets, inplace=True),
+    ("plate", "sticker"): lambda bgr, dets, ctx: place_plate_stickers(bgr, dets, sticker_path=PLATE_STICKER,
+                                                                      inplace=True),
+    ("plate", "pixelate"): lambda bgr, dets, ctx: pixelate_regions(bgr, dets, inplace=True),
+    ("plate", "inpaint"): _inpaint_plates,
+    ("document", "blur"): _doc_effect("blur"),
+    ("document", "pixelate"): _doc_effect("pixelate"),
+}
+SUPPORTED = frozenset(_EFFECTS)
+
+
+def _group(dets: List[Dict], modes: Dict[str, str]) -> Dict[Tuple[str, str], List[Dict]]:
+    groups: Dict[Tuple[str, str], List[Dict]] = {}
+    for d in dets:
+        t = d.get("type", "")
+        if t not in TYPES:
+            raise ValueError(f"Unknown detection type: {t!r}")
+        mode = d.get("mode") or modes.get(t) or DEFAULT_MODES[t]
+        if (t, mode) not in _EFFECTS:
+            raise ValueError(f"Mode {mode!r} is not supported for {t} detections")
+        groups.setdefault((t, mode), []).append(d)
+    return groups
+
+def composite(bgr: np.ndarray, dets: List[Dict], modes: Optional[Dict[str, str]] = None, *,
+              seed: Optional[str] = None, quality: str = "final", inpaint_engine: str = "auto",
+              doc_strength: Optional[float] = None, stickers_dir: str = STICKERS_DIR, out: Optional[np.ndarray] = None,
+              inplace: bool = False) -> np.ndarray:
+    """
+    Obfuscate a mixed detection list on one decoded image and return the result.
+      - dets: dicts with "type" (face/plate/document), normalized "bbox_xyxy" and, optionally,
+        "attributes" and a per-detection "mode"
+      - modes: mode per type (blur, sticker, pixelate, inpaint); default blur
+      - seed / quality: forwarded to face stickers / face inpainting
+      - inpaint_engine: inpaint backend, "auto", "cpu" or a FLUX engine (see inpaint.resolve_engine)
+      - doc_strength: document blur sigma or pixelate cell size (see blur_doc.blur_documents)
+      - out / inplace: the buffer to paint into (e.g. shared memory), or bgr itself
+    Detections are grouped and validated up front and shared masks are built once,
+    then the groups are applied in TYPES order to one buffer, in place: the frame is
+    copied at most once (bgr -> out, or a fresh copy when neither out nor inplace is given).
+    """
+    groups = _group(dets, modes or {})
+    if not groups:
+        return bgr if out is None else output_buffer(bgr, out)
+
+    H, W = bgr.shape[:2]
+    ctx = {"seed": seed, "quality": quality, "inpaint_engine": inpaint_engine, "doc_strength": doc_strength,
+           "stickers_dir": stickers_dir}
+    if ("face", "blur") in groups:
+        with span("mask.face"):
+            ctx["face_masks"] = face_blur_masks(H, W, groups[("face", "blur")])
+
+    out = output_buffer(bgr, out, inplace)
+    for t in TYPES:
+        for mode in MODES:
+            group = groups.get((t, mode))
+            if group:
+                with span(f"obfuscate.{mode}_{t}"):
+                    res = _EFFECTS[(t, mode)](out, group, ctx)
+                    if res is not out:
+                        if res.shape != out.shape:
+                            # Effects must return the input size; scale back any that work downsampled.
+                            res = cv2.resize(res, (W, H), interpolation=cv2.INTER_AREA)
+                        np.copyto(out, res)
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Obfuscate faces, plates and documents in one pass from typed detections.")
+    ap.add_argument("-i", "--input", required=True, help="Input image path")
+    ap.add_argument("-j", "--json", required=True,
+                    help="Detections .json/.npz: list of {type, bbox_xyxy, [attributes], [mode]}")
+    ap.add_argument("-o", "--output", default=None, help="Output image path")
+    ap.add_argument("-m", "--mode", action="append", default=[],
+                    help="Mode per type, e.g. -m face=sticker -m document=pixelate")
+    ap.add_argument("--seed", default=None, help="Face sticker selection seed")
+    ap.add_argument("--inpaint-engine", default="auto", help="Inpaint backend: auto, cpu, flux_depth, flux_fill")
+    args = ap.parse_args()
+
+    modes = {}
+    for item in args.mode:
+        t, _, mode = item.partition("=")
+        modes[t.strip()] = mode.strip()
+
+    with span("image.decode"):
+        bgr = cv2.imread(args.input)
+    if bgr is None:
+        raise FileNotFoundError(args.input)
+    dets = load_detections(args.json)
+
+    out = composite(bgr, dets, modes, seed=args.seed, inpaint_engine=args.inpaint_engine)
+
+    out_path = args.output or os.path.splitext(args.input)[0] + "_obfuscated.jpg"
+    with span("image.encode"):
+        cv2.imwrite(out_path, out)
+    print(f"Done. Wrote: {out_path}")
+
+
+if __name__ == "__main__":
+    main()
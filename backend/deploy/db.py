@@ -0,0 +1,187 @@
+// Copyright 2025 The NoPeek Authors. All rights reserved.
+// Licensed under the Apache License, Version 2.0 that can be found in the
+// LICENSE file in the root directory of this source tree.
+
+# db.py — async engine, Post/PostImage models and the repository the API writes through
+import argparse, asyncio, os, uuid
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional, Sequence
+
+from sqlalchemy import Column, DateTime, ForeignKey, Index, Integer, String, Text, insert, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import declarative_base, relationship, selectinload
+from sqlalchemy.pool import StaticPool
+
+Base = declarative_base()
+
+
+# =========================
+# Models
+# =========================
+class Post(Base):
+    __tablename__ = "posts"
+
+    id = Column(Integer, primary_key=True, index=True)
+    post_id = Column(String(36), unique=True, index=True)
+    caption = Column(Text, nullable=True)
+    user_id = Column(String(100), nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    images = relationship("PostImage", back_populates="post", cascade="all, delete-orphan",
+                          order_by="PostImage.sort_order")
+
+    # Listing a user's feed: WHERE user_id = ? ORDER BY created_at DESC
+    __table_args__ = (Index("ix_posts_user_id_created_at", "user_id", "created_at"),)
+
+class PostImage(Base):
+    __tablename__ = "post_images"
+
+    id = Column(Integer, primary_key=True, index=True)
+    image_id = Column(String(36), unique=True, index=True)
+    post_id = Column(String(36), ForeignKey("posts.post_id"))
+    image_url = Column(String(500), nullable=False)
+    file_size = Column(Integer, nullable=False)
+    mime_type = Column(String(100), nullable=False)
+    width = Column(Integer, nullable=False)
+    height = Column(Integer, nullable=False)
+    sort_order = Column(Integer, default=0)
+
+    post = relationship("Post", back_populates="images")
+
+    # Loading a post's images in display order
+    __table_args__ = (Index("ix_post_images_post_id_sort_order", "post_id", "sort_order"),)
+
+
+# =========================
+# Engine / sessions
+# =========================
+# Sync driver names from older configs -> their async counterparts.
+_ASYNC_DRIVERS = {
+    "mysql": "mysql+aiomysql",
+    "mysql+pymysql": "mysql+aiomysql",
+    "sqlite": "sqlite+aiosqlite",
+    "sqlite+pysqlite": "sqlite+aiosqlite",
+}
+
+def database_url() -> str:
+    """DATABASE_URL if set (e.g. sqlite:// for local testing), else MySQL from DB_* variables."""
+    url = os.getenv("DATABASE_URL") or (
+        f"mysql+aiomysql://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}"
+        f"@{os.getenv('DB_HOST')}:{os.getenv('DB_PORT')}/{os.getenv('DB_NAME')}"
+    )
+    u = make_url(url)
+    if u.drivername in _ASYNC_DRIVERS:
+        u = u.set(drivername=_ASYNC_DRIVERS[u.drivername])
+    return u.render_as_string(hide_password=False)
+
+def _make_engine(url: str) -> AsyncEngine:
+    u = make_url(url)
+    if u.get_backend_name() == "sqlite":
+        # An in-memory database only exists on its connection, so every session must share it.
+        if u.database in (None, "", ":memory:"):
+            return create_async_engine(url, poolclass=StaticPool)
+        return create_async_engine(url)
+    return create_async_engine(
+        url,
+        pool_size=int(os.getenv("DB_POOL_SIZE", "10")),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "20")),
+        pool_timeout=float(os.getenv("DB_POOL_TIMEOUT", "10")),
+        # Below MySQL's default wait_timeout, so idle connections are replaced before the server drops them.
+        pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        pool_pre_ping=True,
+    )
+
+_ENGINE: Optional[AsyncEngine] = None
+_SESSIONS: Optional[async_sessionmaker] = None
+
+def get_engine() -> AsyncEngine:
+    # Created on first use, not at import, so importing the app never touches the database.
+    global _ENGINE, _SESSIONS
+    if _ENGINE is None:
+        _ENGINE = _make_engine(database_url())
+        _SESSIONS = async_sessionmaker(_ENGINE, expire_on_commit=False)
+    return _ENGINE
+
+async def get_session() -> AsyncIterator[AsyncSession]:
+    """FastAPI dependency. The session only checks out a connection when first used."""
+    get_engine()
+    async with _SESSIONS() as session:
+        yield session
+
+async def init_db() -> None:
+    """Create missing tables and their indexes (indexes on existing tables are not added)."""
+    async with get_engine().begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+
+async def dispose_db() -> None:
+    global _ENGINE, _SESSIONS
+    if _ENGINE is not None:
+        await _ENGINE.dispose()
+    _ENGINE = _SESSIONS = None
+
+
+# =========================
+# Repository
+# =========================
+async def create_post(session: AsyncSession, user_id: str, images: Sequence[Dict],
+                      caption: Optional[str] = None) -> str:
+    """
+    Insert a post and all of its images in one transaction and return the post_id.
+    images: dicts with image_url, file_size, mime_type, width, height (sort_order
+    defaults to list order). The image rows go out as a single multi-row INSERT, so a
+    post costs two statements and a commit however many images it has.
+    """
+    post_id = str(uuid.uuid4())
+    await session.execute(insert(Post).values(
+        post_id=post_id, caption=caption, user_id=user_id, created_at=datetime.utcnow()))
+    if images:
+        rows = [{
+            "image_id": str(uuid.uuid4()),
+            "post_id": post_id,
+            "image_url": im["image_url"],
+            "file_size": int(im["file_size"]),
+            "mime_type": im.get("mime_type", "image/jpeg"),
+            "width": int(im["width"]),
+            "height": int(im["height"]),
+            "sort_order": int(im.get("sort_order", i)),
+        } for i, im in enumerate(images)]
+        await session.execute(insert(PostImage), rows)
+    await session.commit()
+    return post_id
+
+async def list_posts(session: AsyncSession, user_id: str, limit: int = 20,
+                     before: Optional[datetime] = None) -> List[Post]:
+    """
+    A user's posts, newest first, with images loaded. Pass the last created_at as
+    `before` to page (keyset pagination on ix_posts_user_id_created_at).
+    Two queries per page: posts, then all their images in one IN (...).
+    """
+    q = select(Post).where(Post.user_id == user_id)
+    if before is not None:
+        q = q.where(Post.created_at < before)
+    q = q.order_by(Post.created_at.desc()).limit(limit).options(selectinload(Post.images))
+    return list((await session.execute(q)).scalars().all())
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Database maintenance.")
+    ap.add_argument("--create-schema", action="store_true", help="Create missing tables and indexes")
+    args = ap.parse_args()
+
+    async def run():
+        try:
+            if args.create_schema:
+                await init_db()
+                print(f"Done. Schema ready on {make_url(database_url()).render_as_string(hide_password=True)}")
+        finally:
+            await dispose_db()
+
+    if not args.create_schema:
+        ap.print_help()
+        return
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
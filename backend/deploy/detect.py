@@ -3,11 +3,17 @@
 // LICENSE file in the root directory of this source tree.
 
 # detectors.py
-import os, cv2
+import math, os, threading, cv2
 import numpy as np
-from typing import Union, Tuple, List, Dict
+from dataclasses import dataclass, replace
+from typing import Callable, Union, Tuple, List, Dict, Optional
 from PIL import Image
 
+from detections import save_detections
+from gating import gate_enabled, should_run
+import metrics
+from metrics import span
+
 
 
 def _to_bgr(img: Union[str, np.ndarray, Image.Image]) -> np.ndarray:
@@ -47,10 +53,281 @@ def _denorm_xyxy(b: List[float], w: int, h: int) -> Tuple[int, int, int, int]:
     # For drawing only; assume b already validated in [0,1] by upstream checks.
     return x1, y1, x2, y2
 
+# Loaded models are kept per process so repeated calls (video keyframes, the API)
+# don't reload weights every time.
+_FACE_APPS: Dict[Tuple, object] = {}
+# The detector's input size is set per call on the shared app (see _run_face_app).
+_FACE_LOCK = threading.Lock()
+_YOLO_MODELS: Dict[str, object] = {}
+
+# =========================
+# Stub models (no weights)
+# =========================
+def synthetic_boxes(n: int, w: int, h: int, seed: int = 0) -> List[Tuple[float, float, float, float]]:
+    """
+    n pixel boxes (x1, y1, x2, y2) on a jittered grid, each 0.4 of a cell wide, so every
+    box stays in bounds even after the obfuscators' bbox expansion and ellipse growth.
+    """
+    if n <= 0:
+        return []
+    rng = np.random.default_rng(seed)
+    cols = int(np.ceil(np.sqrt(n)))
+    rows = int(np.ceil(n / cols))
+    cw, ch = w / cols, h / rows
+    boxes = []
+    for i in range(n):
+        r, c = divmod(i, cols)
+        jx, jy = rng.uniform(-0.06, 0.06, size=2)
+        cx, cy = (c + 0.5 + jx) * cw, (r + 0.5 + jy) * ch
+        boxes.append((cx - 0.2 * cw, cy - 0.2 * ch, cx + 0.2 * cw, cy + 0.2 * ch))
+    return boxes
+
+class _StubArray:
+    # Mimics the torch tensors ultralytics returns (.cpu().numpy()).
+    def __init__(self, a: np.ndarray): self._a = a
+    def cpu(self): return self
+    def numpy(self): return self._a
+
+class _StubFace:
+    def __init__(self, bbox, gender: int, det_score: float):
+        self.bbox, self.gender, self.det_score = np.asarray(bbox, np.float32), gender, det_score
+
+class _StubFaceApp:
+    def __init__(self, n: int): self.n = n
+    def get(self, bgr: np.ndarray):
+        h, w = bgr.shape[:2]
+        return [_StubFace(b, i % 2, 0.9) for i, b in enumerate(synthetic_boxes(self.n, w, h, seed=1))]
+
+class _StubYolo:
+    def __init__(self, n: int): self.n = n
+    def predict(self, source: np.ndarray, **kw):
+        h, w = source.shape[:2]
+        boxes = np.asarray(synthetic_boxes(self.n, w, h, seed=2), np.float32).reshape(-1, 4)
+        r = type("StubResult", (), {})()
+        r.boxes = type("StubBoxes", (), {})()
+        r.boxes.xyxy, r.boxes.conf = _StubArray(boxes), _StubArray(np.full(len(boxes), 0.8, np.float32))
+        return [r]
+
+_STUB_BOXES: Optional[int] = None
+
+def use_stub_detectors(n_boxes: Optional[int] = 3) -> None:
+    """
+    Swap the face/plate models for deterministic stand-ins that return n_boxes
+    grid boxes, so benchmarks and load tests run without model weights.
+    None restores the real models.
+    """
+    global _STUB_BOXES
+    _STUB_BOXES = n_boxes
+    _FACE_APPS.clear()
+    _YOLO_MODELS.clear()
+
+if os.getenv("NOPEEK_STUB_DETECTORS"):
+    use_stub_detectors(int(os.getenv("NOPEEK_STUB_DETECTORS")))
+
+# =========================
+# Face engine (insightface on ONNX Runtime, CPU)
+# =========================
+@dataclass(frozen=True)
+class FaceEngineConfig:
+    # Only detection (bbox, det_score) and genderage (gender) are used; buffalo_l's
+    # recognition and 2D/3D landmark heads would otherwise run on every face.
+    modules: Tuple[str, ...] = ("detection", "genderage")
+    intra_op_threads: int = 0       # 0 = CPU count / workers per host (see _default_intra_threads)
+    inter_op_threads: int = 1       # the models are sequential graphs; >1 only adds contention
+    graph_opt: str = "all"          # "disable" | "basic" | "extended" | "all"
+    mem_arena: bool = True          # ORT CPU arena: faster repeated runs, holds peak memory
+    det_model: str = ""             # optional detector .onnx replacing buffalo_l's (e.g. int8, see quantize_face_detector)
+    model_name: str = "buffalo_l"
+
+def _default_intra_threads() -> int:
+    # Split the cores between the server's worker processes instead of each one claiming all of them.
+    workers = int(os.getenv("NOPEEK_WORKERS", os.getenv("WEB_CONCURRENCY", "1")) or 1)
+    return max(1, (os.cpu_count() or 1) // max(1, workers))
+
+def face_engine_config_from_env() -> FaceEngineConfig:
+    """NOPEEK_FACE_THREADS, NOPEEK_FACE_INTER_THREADS, NOPEEK_FACE_GRAPH_OPT, NOPEEK_FACE_ARENA=0, NOPEEK_FACE_DET_MODEL."""
+    return FaceEngineConfig(
+        intra_op_threads=int(os.getenv("NOPEEK_FACE_THREADS", "0")),
+        inter_op_threads=int(os.getenv("NOPEEK_FACE_INTER_THREADS", "1")),
+        graph_opt=os.getenv("NOPEEK_FACE_GRAPH_OPT", "all"),
+        mem_arena=os.getenv("NOPEEK_FACE_ARENA", "1") != "0",
+        det_model=os.getenv("NOPEEK_FACE_DET_MODEL", ""),
+    )
+
+_FACE_CONFIG = face_engine_config_from_env()
+
+def configure_face_engine(config: Optional[FaceEngineConfig] = None, **overrides) -> FaceEngineConfig:
+    """Set the face engine configuration (default: from the environment) and drop loaded engines."""
+    global _FACE_CONFIG
+    _FACE_CONFIG = replace(config or face_engine_config_from_env(), **overrides)
+    _FACE_APPS.clear()
+    return _FACE_CONFIG
+
+def _session_options(cfg: FaceEngineConfig):
+    import onnxruntime as ort
+    so = ort.SessionOptions()
+    so.intra_op_num_threads = cfg.intra_op_threads or _default_intra_threads()
+    so.inter_op_num_threads = cfg.inter_op_threads
+    so.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    so.graph_optimization_level = {
+        "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+        "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+        "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+        "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+    }[cfg.graph_opt]
+    so.enable_cpu_mem_arena = cfg.mem_arena
+    return so
+
+def quantize_face_detector(src_onnx: str, dst_onnx: str) -> str:
+    """Write a dynamically int8-quantized copy of a detector .onnx for FaceEngineConfig.det_model."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    quantize_dynamic(src_onnx, dst_onnx, weight_type=QuantType.QUInt8)
+    return dst_onnx
+
+def _face_app():
+    if _STUB_BOXES is not None:
+        return _StubFaceApp(_STUB_BOXES)
+    key = (_FACE_CONFIG,)
+    app = _FACE_APPS.get(key)
+    if app is None:
+        from insightface.app import FaceAnalysis
+        from insightface.model_zoo import model_zoo
+        cfg = _FACE_CONFIG
+        # CPU only; the keyword arguments reach each model's onnxruntime.InferenceSession
+        session_kw = {"providers": ["CPUExecutionProvider"], "sess_options": _session_options(cfg)}
+        app = FaceAnalysis(name=cfg.model_name, allowed_modules=list(cfg.modules), **session_kw)
+        if cfg.det_model:
+            app.models["detection"] = model_zoo.get_model(cfg.det_model, **session_kw)
+            app.det_model = app.models["detection"]
+        app.prepare(ctx_id=-1, det_size=(640, 640))
+        _FACE_APPS[key] = app
+    return app
+
+def _run_face_app(bgr: np.ndarray, det_size: Tuple[int, int]) -> list:
+    # One loaded app serves every input size: SCRFD builds its anchors per size on the fly.
+    app = _face_app()
+    with _FACE_LOCK:
+        det_model = getattr(app, "det_model", None)
+        if det_model is not None:
+            det_model.input_size = tuple(det_size)
+        return app.get(bgr) or []
+
+def _yolo_model(weights: str):
+    if _STUB_BOXES is not None:
+        return _StubYolo(_STUB_BOXES)
+    model = _YOLO_MODELS.get(weights)
+    if model is None:
+        from ultralytics import YOLO
+        model = YOLO(weights)
+        _YOLO_MODELS[weights] = model
+    return model
+
+def plate_gate_score(img: Union[str, np.ndarray, Image.Image], weights: str = "license_plate_detector.pt",
+                     imgsz: int = 320, conf: float = 0.05) -> float:
+    """Best plate confidence from one low-res, low-threshold YOLO pass; 0.0 if nothing at all."""
+    found = _raw_plates(weights, conf, 0.5)(_to_bgr(img), imgsz)
+    return max((s for _, s, _ in found), default=0.0)
+
+# =========================
+# Adaptive detection schedule
+# =========================
+@dataclass(frozen=True)
+class DetectSchedule:
+    min_size: int = 320         # detector input never below this (small selfies are not upscaled past it)
+    max_size: int = 640         # first-pass input cap, and the tile size in source pixels
+    small_px: float = 24.0      # a first-pass box whose shorter side is below this at detector scale means tile
+    tile_overlap: float = 0.2
+    max_tiles: int = 12         # compute bound per image; 0 disables tiling
+    nms_iou: float = 0.5
+
+def detect_schedule_from_env() -> DetectSchedule:
+    """NOPEEK_DET_MAX_SIZE, NOPEEK_DET_SMALL_PX, NOPEEK_DET_MAX_TILES."""
+    return DetectSchedule(
+        max_size=int(os.getenv("NOPEEK_DET_MAX_SIZE", "640")),
+        small_px=float(os.getenv("NOPEEK_DET_SMALL_PX", "24")),
+        max_tiles=int(os.getenv("NOPEEK_DET_MAX_TILES", "12")),
+    )
+
+# A raw pass: (image, input size) -> [(pixel box xyxy, score or None, attributes)]
+_Raw = List[Tuple[np.ndarray, Optional[float], Dict]]
+
+def _input_size(w: int, h: int, sched: DetectSchedule) -> int:
+    # Long side rounded up to the detectors' stride of 32, within [min_size, max_size].
+    return int(min(sched.max_size, max(sched.min_size, math.ceil(max(w, h) / 32) * 32)))
+
+def _tile_grid(w: int, h: int, sched: DetectSchedule) -> List[Tuple[int, int, int, int]]:
+    """Overlapping tiles of max_size source pixels (detector scale 1:1), grown until at most max_tiles."""
+    t = sched.max_size
+    while True:
+        step = t * (1.0 - sched.tile_overlap)
+        cols = 1 if w <= t else math.ceil((w - t) / step) + 1
+        rows = 1 if h <= t else math.ceil((h - t) / step) + 1
+        if cols * rows <= sched.max_tiles:
+            break
+        t = int(t * 1.25)
+    xs = np.linspace(0, max(0, w - t), cols).round().astype(int)
+    ys = np.linspace(0, max(0, h - t), rows).round().astype(int)
+    return [(int(x), int(y), int(min(w, x + t)), int(min(h, y + t))) for y in ys for x in xs]
+
+def _nms_raw(found: _Raw, iou_thr: float) -> _Raw:
+    # Greedy by score; a box also goes if it lies mostly inside a kept one (a partial duplicate).
+    order = sorted(found, key=lambda f: -(f[1] if f[1] is not None else 0.0))
+    keep: _Raw = []
+    for b, s, a in order:
+        dup = False
+        for k, _, _ in keep:
+            iw = min(b[2], k[2]) - max(b[0], k[0]); ih = min(b[3], k[3]) - max(b[1], k[1])
+            if iw <= 0 or ih <= 0:
+                continue
+            inter = iw * ih
+            area_b = (b[2] - b[0]) * (b[3] - b[1]); area_k = (k[2] - k[0]) * (k[3] - k[1])
+            if inter / (area_b + area_k - inter) > iou_thr or inter / min(area_b, area_k) > 0.85:
+                dup = True
+                break
+        if not dup:
+            keep.append((b, s, a))
+    return keep
+
+def _adaptive_detect(bgr: np.ndarray, run: Callable[[np.ndarray, int], _Raw], sched: DetectSchedule, what: str) -> _Raw:
+    """
+    Pass 1: the whole image at _input_size. Only when it finds a box too small to trust
+    at that scale (and the image is larger than max_size) is pass 2 run: max_size tiles at
+    native resolution, boxes cut by an inner tile edge dropped, then cross-tile NMS.
+    """
+    h, w = bgr.shape[:2]
+    size = _input_size(w, h, sched)
+    found = run(bgr, size)
+    scale = size / max(w, h)
+    tiny = any(min(b[2] - b[0], b[3] - b[1]) * scale < sched.small_px for b, _, _ in found)
+    # Stub models lay their boxes out per call, so every tile would add a full new set.
+    if not tiny or sched.max_tiles <= 0 or max(w, h) <= sched.max_size or _STUB_BOXES is not None:
+        metrics.inc("nopeek_detect_passes_total", type=what, passes="1")
+        return found
+
+    metrics.inc("nopeek_detect_passes_total", type=what, passes="tiled")
+    for x1, y1, x2, y2 in _tile_grid(w, h, sched):
+        for b, s, a in run(bgr[y1:y2, x1:x2], sched.max_size):
+            edge = 2.0
+            if ((b[0] < edge and x1 > 0) or (b[1] < edge and y1 > 0) or
+                    (b[2] > x2 - x1 - edge and x2 < w) or (b[3] > y2 - y1 - edge and y2 < h)):
+                continue
+            found.append((b + np.array([x1, y1, x1, y1], np.float32), s, a))
+    return _nms_raw(found, sched.nms_iou)
+
+def _raw_faces(bgr: np.ndarray, size: Union[int, Tuple[int, int]]) -> _Raw:
+    out: _Raw = []
+    for f in _run_face_app(bgr, (size, size) if isinstance(size, int) else tuple(size)):
+        # Use raw float coords from model to avoid hiding out-of-bounds via int casting
+        gender = "male" if int(f.gender) == 1 else "female"
+        conf = float(getattr(f, "det_score", 0.0)) if hasattr(f, "det_score") else None
+        out.append((np.asarray(f.bbox, np.float32)[:4], conf, {"gender": gender}))
+    return out
+
 def detect_faces(
     img: Union[str, np.ndarray, Image.Image],
-    det_size: Tuple[int, int] = (640, 640),
-    preview: str = ""
+    det_size: Optional[Tuple[int, int]] = None,
+    preview: str = "",
+    schedule: Optional[DetectSchedule] = None
 ) -> List[Dict]:
     """
     Returns list of dicts:
@@ -59,35 +336,26 @@ def detect_faces(
         "confidence": float | None,
         "attributes": {"gender": "male"|"female"}  # never 'unknown'; raises if missing
       }
+    det_size fixes a single pass at that input size; by default the input size follows
+    the image and small faces trigger a tiled pass (see DetectSchedule).
     Raises:
       - RuntimeError if gender missing/undeterminable
       - ValueError if any bbox exceeds image bounds or is invalid
     """
-    from insightface.app import FaceAnalysis
-
     bgr = _to_bgr(img)
     h, w = bgr.shape[:2]
 
-    # CPU only
-    ctx_id = -1
-
-    app = FaceAnalysis(name="buffalo_l")
-    app.prepare(ctx_id=ctx_id, det_size=det_size)
-    faces = app.get(bgr) or []
+    if det_size is not None:
+        found = _raw_faces(bgr, det_size)
+    else:
+        found = _adaptive_detect(bgr, _raw_faces, schedule or detect_schedule_from_env(), "face")
 
     dets: List[Dict] = []
-    for f in faces:
-        # Use raw float coords from model to avoid hiding out-of-bounds via int casting
-        x1, y1, x2, y2 = map(float, f.bbox)
-
-        gender = "male" if int(f.gender) == 1 else "female"
-
-        conf = float(getattr(f, "det_score", 0.0)) if hasattr(f, "det_score") else None
-
+    for (x1, y1, x2, y2), conf, attrs in found:
         dets.append({
-            "bbox_xyxy": _norm_xyxy_no_clip(x1, y1, x2, y2, w, h),
+            "bbox_xyxy": _norm_xyxy_no_clip(float(x1), float(y1), float(x2), float(y2), w, h),
             "confidence": conf,
-            "attributes": {"gender": gender}
+            "attributes": attrs
         })
 
     if preview:
@@ -103,12 +371,28 @@ def detect_faces(
 
     return dets
 
+def _raw_plates(weights: str, conf: float, iou: float) -> Callable[[np.ndarray, int], _Raw]:
+    def run(bgr: np.ndarray, size: int) -> _Raw:
+        rgb = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+        # CPU only
+        model = _yolo_model(weights)
+        results = model.predict(source=rgb, imgsz=size, conf=conf, iou=iou, device="cpu", verbose=False)
+        r = results[0]
+        if r.boxes is None:
+            return []
+        # Use float coords directly for validation
+        boxes = r.boxes.xyxy.cpu().numpy().astype(np.float32).reshape(-1, 4)
+        scores = r.boxes.conf.cpu().numpy().astype(float)
+        return [(b, float(s), {}) for b, s in zip(boxes, scores)]
+    return run
+
 def detect_plates(
     img: Union[str, np.ndarray, Image.Image],
     weights: str = "license_plate_detector.pt",
     conf: float = 0.25,
     iou: float = 0.5,
-    preview: str = ""
+    preview: str = "",
+    schedule: Optional[DetectSchedule] = None
 ) -> List[Dict]:
     """
     Returns list of dicts:
@@ -117,33 +401,21 @@ def detect_plates(
         "confidence": float,
         "attributes": {}
       }
+    The YOLO input size follows the image; small plates trigger a tiled pass (see DetectSchedule).
     Raises:
       - ValueError if any bbox exceeds image bounds or is invalid
     """
-    from ultralytics import YOLO
-
     bgr = _to_bgr(img)
     h, w = bgr.shape[:2]
-    rgb = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
-
-    # CPU only
-    model = YOLO(weights)
-    results = model.predict(source=rgb, conf=conf, iou=iou, device="cpu", verbose=False)
-    r = results[0]
-
-    if r.boxes is None:
-        return []
 
-    # Use float coords directly for validation
-    boxes = r.boxes.xyxy.cpu().numpy().astype(float)
-    scores = r.boxes.conf.cpu().numpy().astype(float)
+    found = _adaptive_detect(bgr, _raw_plates(weights, conf, iou), schedule or detect_schedule_from_env(), "plate")
 
     dets: List[Dict] = []
-    for (x1, y1, x2, y2), score in zip(boxes, scores):
+    for (x1, y1, x2, y2), score, attrs in found:
         dets.append({
             "bbox_xyxy": _norm_xyxy_no_clip(float(x1), float(y1), float(x2), float(y2), w, h),
-            "confidence": float(score),
-            "attributes": {}
+            "confidence": score,
+            "attributes": attrs
         })
 
     if preview:
@@ -162,7 +434,7 @@ def detect_plates(
 
 
 if __name__ == "__main__":
-    import argparse, json
+    import argparse
     from pathlib import Path
 
     parser = argparse.ArgumentParser(description="Run detectors on an image (CPU).")
@@ -174,24 +446,35 @@ if __name__ == "__main__":
         help="Which detector to run."
     )
     parser.add_argument("-o", "--output", default="", help="Path to save json.")
+    parser.add_argument("--gate", action="store_true",
+                        help="Plates: skip the detector when a 320 px pass scores below NOPEEK_GATE_PLATE")
     args = parser.parse_args()
 
     img_path = Path(args.input)
     if not img_path.exists():
         raise FileNotFoundError(f"Input image not found: {img_path}")
 
-    if args.type == "face":
-        dets = detect_faces(str(img_path))
-    else:  # "plate"
-        dets = detect_plates(str(img_path))
+    with span("image.decode"):
+        bgr = _to_bgr(str(img_path))
+    with span(f"detect.{args.type}"):
+        if args.type == "face":
+            dets = detect_faces(bgr)
+        elif args.gate and gate_enabled("plate") and not should_run("plate", plate_gate_score(bgr)):
+            # Read by the API to count gate decisions; the empty result is still written below
+            print("gate: skip")
+            dets = []
+        else:  # "plate"
+            if args.gate and gate_enabled("plate"):
+                print("gate: run")
+            dets = detect_plates(bgr)
 
     # Save JSON to same stem name, with .json extension
     out_path = img_path.with_suffix(".json")
     if args.output:
         out_path = Path(args.output)
     os.makedirs(out_path.parent, exist_ok=True)
-    with open(out_path, "w", encoding="utf-8") as f:
-        json.dump(dets, f, ensure_ascii=False, indent=2)
+    # .npz -> compact binary (what the API caches), otherwise compact JSON
+    save_detections(str(out_path), dets)
 
     print(f"Detections saved to {out_path}")
 
@@ -0,0 +1,156 @@
+// Copyright 2025 The NoPeek Authors. All rights reserved.
+// Licensed under the Apache License, Version 2.0 that can be found in the
+// LICENSE file in the root directory of this source tree.
+
+# detections.py — array-backed detection container, compact binary (.npz) format and the shared loader
+import io, json
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+# Attribute codes: gender is the only attribute the detectors produce.
+GENDERS = ("female", "male")          # index = code; -1 = absent
+_GENDER_CODE = {g: i for i, g in enumerate(GENDERS)}
+
+# Per-detection keys other than bbox/confidence/attributes that survive a round trip.
+_EXTRA_KEYS = ("type", "mode", "sticker")
+
+
+class Detections:
+    """
+    N detections of one image as arrays:
+      - boxes:  (N, 4) float32 normalized xyxy
+      - scores: (N,) float32, NaN where the detector gave no confidence
+      - gender: (N,) int8 code into GENDERS, -1 if absent
+      - extra:  None, or N dicts of anything else (other attributes, type, mode, sticker)
+    to_list() gives the list-of-dicts shape the obfuscators and the API use;
+    to_bytes()/save(".npz") is the compact form used for the detection cache and IPC.
+    """
+
+    __slots__ = ("boxes", "scores", "gender", "extra")
+
+    def __init__(self, boxes: np.ndarray, scores: Optional[np.ndarray] = None,
+                 gender: Optional[np.ndarray] = None, extra: Optional[List[Dict]] = None):
+        self.boxes = np.asarray(boxes, np.float32).reshape(-1, 4)
+        n = len(self.boxes)
+        self.scores = np.full(n, np.nan, np.float32) if scores is None else np.asarray(scores, np.float32)
+        self.gender = np.full(n, -1, np.int8) if gender is None else np.asarray(gender, np.int8)
+        self.extra = extra
+
+    def __len__(self) -> int:
+        return len(self.boxes)
+
+    # ---- dict form ----
+    @classmethod
+    def from_list(cls, dets: Iterable[Dict]) -> "Detections":
+        boxes, scores, gender, extra = [], [], [], []
+        has_extra = False
+        for d in dets:
+            boxes.append(d["bbox_xyxy"])
+            conf = d.get("confidence")
+            scores.append(np.nan if conf is None else conf)
+            attrs = dict(d.get("attributes") or {})
+            gender.append(_GENDER_CODE.get(attrs.pop("gender", None), -1))
+            e = {k: d[k] for k in _EXTRA_KEYS if k in d}
+            if attrs:
+                e["attributes"] = attrs
+            has_extra = has_extra or bool(e)
+            extra.append(e)
+        return cls(np.array(boxes, np.float32).reshape(-1, 4), np.array(scores, np.float32),
+                   np.array(gender, np.int8), extra if has_extra else None)
+
+    def to_list(self) -> List[Dict]:
+        # One bulk tolist() per array instead of per-element float() conversions; rounding
+        # to 6 places keeps float32 noise (0.30000001192...) out of the JSON.
+        boxes = self.boxes.astype(np.float64).round(6).tolist()
+        scores = self.scores.astype(np.float64).round(6).tolist()
+        gender = self.gender.tolist()
+        out = []
+        for i, b in enumerate(boxes):
+            attrs = {"gender": GENDERS[gender[i]]} if gender[i] >= 0 else {}
+            d = {"bbox_xyxy": b, "confidence": None if scores[i] != scores[i] else scores[i], "attributes": attrs}
+            if self.extra is not None and self.extra[i]:
+                e = dict(self.extra[i])
+                d["attributes"] = {**attrs, **e.pop("attributes", {})}
+                d.update(e)
+            out.append(d)
+        return out
+
+    # ---- binary form ----
+    def to_bytes(self) -> bytes:
+        arrays = {"boxes": self.boxes, "scores": self.scores, "gender": self.gender}
+        if self.extra is not None:
+            arrays["extra"] = np.array(json.dumps(self.extra, ensure_ascii=False, separators=(",", ":")))
+        buf = io.BytesIO()
+        np.savez(buf, **arrays)
+        return buf.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "Detections":
+        with np.load(io.BytesIO(data), allow_pickle=False) as z:
+            extra = json.loads(str(z["extra"])) if "extra" in z.files else None
+            return cls(z["boxes"], z["scores"], z["gender"], extra)
+
+    # ---- files ----
+    def save(self, path: str) -> None:
+        """.npz -> binary, anything else -> compact JSON in the list-of-dicts shape."""
+        if path.endswith(".npz"):
+            with open(path, "wb") as f:
+                f.write(self.to_bytes())
+        else:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(self.to_list(), f, ensure_ascii=False, separators=(",", ":"))
+
+    @classmethod
+    def load(cls, path: str) -> "Detections":
+        if path.endswith(".npz"):
+            with open(path, "rb") as f:
+                return cls.from_bytes(f.read())
+        return cls.from_list(load_detections(path))
+
+
+def _load_any(path: str) -> List[Dict]:
+    if path.endswith(".npz"):
+        with open(path, "rb") as f:
+            return Detections.from_bytes(f.read()).to_list()
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    if not isinstance(data, list):
+        raise ValueError("Detections JSON must be a list of objects.")
+    return data
+
+def load_detections(path: str) -> List[Dict]:
+    """
+    Load detections from .npz or a JSON list of dicts with 'bbox_xyxy' (normalized xyxy).
+    Entries without a 4-value bbox are skipped; non-dict attributes become {}.
+    """
+    out: List[Dict] = []
+    for d in _load_any(path):
+        if not isinstance(d, dict):
+            continue
+        bb = d.get("bbox_xyxy", None)
+        if not (isinstance(bb, (list, tuple)) and len(bb) == 4):
+            continue
+        attrs = d.get("attributes", {})
+        det = {"bbox_xyxy": bb, "attributes": attrs if isinstance(attrs, dict) else {}}
+        if d.get("confidence") is not None:
+            det["confidence"] = d["confidence"]
+        for k in _EXTRA_KEYS:
+            if isinstance(d.get(k), str):
+                det[k] = d[k]
+        out.append(det)
+    return out
+
+def save_detections(path: str, dets: List[Dict]) -> None:
+    Detections.from_list(dets).save(path)
+
+def response_view(dets: List[Dict]) -> List[Dict]:
+    """API view: type, bbox_xyxy and, for faces, gender."""
+    out = []
+    for d in dets:
+        r = {"type": d["type"], "bbox_xyxy": d["bbox_xyxy"]}
+        gender = (d.get("attributes") or {}).get("gender")
+        if d["type"] == "face" and gender:
+            r["gender"] = gender
+        out.append(r)
+    return out
@@ -0,0 +1,303 @@
+// Copyright 2025 The NoPeek Authors. All rights reserved.
+// Licensed under the Apache License, Version 2.0 that can be found in the
+// LICENSE file in the root directory of this source tree.
+
+# encode.py — JPEG size model and response encoder shared by the generation pipeline and the API
+import asyncio, base64, math, os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from typing import List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+
+# Encoded JPEG size grows sub-linearly with pixel count (downscaling packs more
+# detail per pixel), so we model bytes ≈ a * pixels**b through two cheap anchors
+# instead of encoding the full frame repeatedly:
+#   - full resolution: a mosaic of native-resolution tiles sampled on a grid
+#     (captures fine texture that a thumbnail would average away)
+#   - low resolution: a single thumbnail encode at _PROBE_SIDE
+# Target scales land between the two anchors, so this interpolates rather than extrapolates.
+_PROBE_SIDE = 512
+_MOSAIC_TILE = 128   # multiple of 16 so tiles sit on the MCU grid
+_MOSAIC_GRID = 8
+_EXPONENT_RANGE = (0.55, 1.05)
+_SAFETY = 0.92       # the model tends to undershoot mid-range scales slightly
+
+
+def _jpeg_bytes(bgr: np.ndarray, quality: int) -> np.ndarray:
+    ok, buf = cv2.imencode(".jpg", bgr, [int(cv2.IMWRITE_JPEG_QUALITY), int(quality)])
+    if not ok:
+        raise RuntimeError("cv2.imencode failed while estimating size")
+    return buf
+
+def _resize_scale(bgr: np.ndarray, scale: float) -> np.ndarray:
+    H, W = bgr.shape[:2]
+    new_w = max(1, int(round(W * scale)))
+    new_h = max(1, int(round(H * scale)))
+    if (new_w, new_h) == (W, H):
+        return bgr
+    return cv2.resize(bgr, (new_w, new_h), interpolation=cv2.INTER_AREA)
+
+def _tile_mosaic(bgr: np.ndarray, tile: int = _MOSAIC_TILE, grid: int = _MOSAIC_GRID) -> np.ndarray:
+    H, W = bgr.shape[:2]
+    ys = (np.linspace(0, H - tile, grid).astype(int) // 16) * 16
+    xs = (np.linspace(0, W - tile, grid).astype(int) // 16) * 16
+    return np.vstack([np.hstack([bgr[y:y + tile, x:x + tile] for x in xs]) for y in ys])
+
+def _thumbnail(bgr: np.ndarray, side: int) -> np.ndarray:
+    H, W = bgr.shape[:2]
+    # decimate first so INTER_AREA only touches ~2x the thumbnail's pixels
+    step = max(1, max(H, W) // (side * 2))
+    small = bgr[::step, ::step]
+    return _resize_scale(small, side / float(max(small.shape[:2])))
+
+def jpeg_size_model(bgr: np.ndarray, quality: int = 92) -> Optional[Tuple[float, float]]:
+    """
+    Fit (a, b) in bytes ≈ a * pixels**b from a native-resolution tile mosaic and a thumbnail.
+    Returns None when the image is too small for probing to be cheaper than a real encode.
+    """
+    H, W = bgr.shape[:2]
+    if max(H, W) <= _PROBE_SIDE * 2 or min(H, W) < _MOSAIC_TILE * 2:
+        return None
+
+    mosaic = _tile_mosaic(bgr)
+    full_pixels = float(H * W)
+    full_bytes = len(_jpeg_bytes(mosaic, quality)) * full_pixels / float(mosaic.shape[0] * mosaic.shape[1])
+
+    thumb = _thumbnail(bgr, _PROBE_SIDE)
+    thumb_pixels = float(thumb.shape[0] * thumb.shape[1])
+    thumb_bytes = float(len(_jpeg_bytes(thumb, quality)))
+
+    b = math.log(full_bytes / thumb_bytes) / math.log(full_pixels / thumb_pixels)
+    b = float(np.clip(b, *_EXPONENT_RANGE))
+    a = full_bytes / (full_pixels ** b)
+    return a, b
+
+def estimate_jpeg_bytes(bgr: np.ndarray, quality: int = 92, scale: float = 1.0) -> int:
+    """Predict the encoded JPEG size of bgr resized by `scale`, without a full-size encode."""
+    model = jpeg_size_model(bgr, quality=quality)
+    if model is None:
+        return len(_jpeg_bytes(_resize_scale(bgr, scale), quality))
+    a, b = model
+    H, W = bgr.shape[:2]
+    return int(a * (H * W * scale * scale) ** b)
+
+def scale_for_bytes(bgr: np.ndarray, target_bytes: int, quality: int = 92, min_side: int = 0) -> float:
+    """
+    One-shot scale factor (<= 1.0) whose JPEG encode is predicted to fit target_bytes.
+    The shorter side never drops below min_side (unless it already is).
+    """
+    H, W = bgr.shape[:2]
+    model = jpeg_size_model(bgr, quality=quality)
+    if model is None:
+        cur = len(_jpeg_bytes(bgr, quality))
+        if cur <= target_bytes:
+            return 1.0
+        scale = math.sqrt(target_bytes / float(cur))
+    else:
+        a, b = model
+        if a * (H * W) ** b <= target_bytes:
+            return 1.0
+        target_pixels = (target_bytes * _SAFETY / a) ** (1.0 / b)
+        scale = math.sqrt(target_pixels / float(H * W))
+
+    floor = min(1.0, min_side / float(min(H, W))) if min_side else 0.1
+    return float(np.clip(scale, max(floor, 0.1), 1.0))
+
+def downsample_to_bytes(
+    bgr: np.ndarray,
+    target_bytes: int,
+    min_side: int = 0,
+    quality: int = 92,
+    encode: bool = False,
+) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Resize bgr once so its JPEG encode fits (approximately) in target_bytes.
+    With encode=True the final encode is returned alongside the image so callers
+    that ship JPEG bytes don't have to encode it a second time; if the model
+    undershot, one corrective resize from the measured size is applied.
+    Returns (image, jpeg_buffer_or_None).
+    """
+    scale = scale_for_bytes(bgr, target_bytes, quality=quality, min_side=min_side)
+    out = _resize_scale(bgr, scale)
+    if not encode:
+        return out, None
+
+    buf = _jpeg_bytes(out, quality)
+    if len(buf) > target_bytes:
+        h, w = out.shape[:2]
+        floor = min(1.0, min_side / float(min(h, w))) if min_side else 0.1
+        fix = float(np.clip(math.sqrt(target_bytes / float(len(buf))) * 0.97, floor, 1.0))
+        if fix < 1.0:
+            out = _resize_scale(out, fix)
+            buf = _jpeg_bytes(out, quality)
+    return out, buf
+
+
+# =========================
+# Response encoding
+# =========================
+# Formats in server preference order; a format is offered only when the client
+# advertises it and this OpenCV build has a writer for it.
+_FORMATS = {
+    "avif": {"ext": ".avif", "mime": "image/avif"},
+    "webp": {"ext": ".webp", "mime": "image/webp"},
+    "jpeg": {"ext": ".jpg",  "mime": "image/jpeg"},
+}
+_SUBSAMPLING = {"444": "IMWRITE_JPEG_SAMPLING_FACTOR_444",
+                "422": "IMWRITE_JPEG_SAMPLING_FACTOR_422",
+                "420": "IMWRITE_JPEG_SAMPLING_FACTOR_420"}
+_MIN_QUALITY = 40
+
+@dataclass
+class EncodeOptions:
+    fmt: str = "jpeg"           # "jpeg" | "webp" | "avif"
+    quality: int = 95           # upper bound when target_bytes is set
+    target_bytes: int = 0       # 0 = no byte budget
+    progressive: bool = False   # JPEG only
+    subsampling: str = ""       # JPEG only: "444" | "422" | "420"; "" = encoder default
+
+def can_write(fmt: str) -> bool:
+    if fmt not in _FORMATS:
+        return False
+    try:
+        return bool(cv2.haveImageWriter(_FORMATS[fmt]["ext"]))
+    except cv2.error:
+        return False
+
+def negotiate_format(accepted: Sequence[str]) -> str:
+    """Pick the best format both sides support. `accepted` holds names ("webp") or mime types ("image/webp")."""
+    names = {a.strip().lower().replace("image/", "") for a in accepted if a}
+    if "jpg" in names:
+        names.add("jpeg")
+    for fmt in _FORMATS:
+        if fmt in names and can_write(fmt):
+            return fmt
+    return "jpeg"
+
+def _encode_params(opts: EncodeOptions, quality: int) -> List[int]:
+    if opts.fmt == "webp":
+        return [int(cv2.IMWRITE_WEBP_QUALITY), int(np.clip(quality, 1, 100))]
+    if opts.fmt == "avif":
+        return [int(getattr(cv2, "IMWRITE_AVIF_QUALITY")), int(np.clip(quality, 0, 100))]
+    params = [int(cv2.IMWRITE_JPEG_QUALITY), int(quality)]
+    if opts.progressive:
+        params += [int(cv2.IMWRITE_JPEG_PROGRESSIVE), 1]
+    if opts.subsampling:
+        flag = getattr(cv2, "IMWRITE_JPEG_SAMPLING_FACTOR", None)
+        value = getattr(cv2, _SUBSAMPLING.get(opts.subsampling, ""), None)
+        if flag is not None and value is not None:
+            params += [int(flag), int(value)]
+    return params
+
+def _encode(bgr: np.ndarray, opts: EncodeOptions, quality: int) -> np.ndarray:
+    ok, buf = cv2.imencode(_FORMATS[opts.fmt]["ext"], bgr, _encode_params(opts, quality))
+    if not ok:
+        raise RuntimeError(f"cv2.imencode failed for format {opts.fmt}")
+    return buf
+
+def _quality_for_bytes(bgr: np.ndarray, opts: EncodeOptions) -> int:
+    """Bisect quality on the native-resolution tile mosaic, which costs a fraction of a full encode."""
+    H, W = bgr.shape[:2]
+    if min(H, W) < _MOSAIC_TILE * 2:
+        sample, ratio = bgr, 1.0
+    else:
+        sample = _tile_mosaic(bgr)
+        ratio = float(H * W) / float(sample.shape[0] * sample.shape[1])
+    budget = opts.target_bytes * _SAFETY
+
+    lo, hi = min(_MIN_QUALITY, int(opts.quality)), int(opts.quality)
+    if len(_encode(sample, opts, hi)) * ratio <= budget:
+        return hi
+    while hi - lo > 2:
+        mid = (lo + hi) // 2
+        if len(_encode(sample, opts, mid)) * ratio <= budget:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+def encode_image(bgr: np.ndarray, opts: EncodeOptions) -> Tuple[bytes, str]:
+    """
+    Encode bgr for a response. With a byte budget, quality is lowered first (down to
+    _MIN_QUALITY, or the requested quality if that is lower) and only then is the image
+    downscaled; the returned buffer fits the budget (checked against the full-size encode,
+    not just the estimate) unless even a 1-pixel image would not, in which case that is returned.
+    Returns (encoded_bytes, mime_type).
+    """
+    if not can_write(opts.fmt):
+        opts = replace(opts, fmt="jpeg")
+    mime = _FORMATS[opts.fmt]["mime"]
+    if not opts.target_bytes:
+        return _encode(bgr, opts, opts.quality).tobytes(), mime
+
+    floor = min(_MIN_QUALITY, int(opts.quality))
+    quality = _quality_for_bytes(bgr, opts)
+    buf = _encode(bgr, opts, quality)
+    if len(buf) > opts.target_bytes and quality > floor:
+        # The mosaic under-estimated the full image: bisect the rest of the range on full
+        # encodes (hi is always over budget, lo/lo_buf the best fit found so far).
+        lo, hi = floor, quality
+        lo_buf = _encode(bgr, opts, lo)
+        if len(lo_buf) <= opts.target_bytes:
+            while hi - lo > 2:
+                mid = (lo + hi) // 2
+                mid_buf = _encode(bgr, opts, mid)
+                if len(mid_buf) <= opts.target_bytes:
+                    lo, lo_buf = mid, mid_buf
+                else:
+                    hi = mid
+        quality, buf = lo, lo_buf
+    if len(buf) > opts.target_bytes:
+        # Over budget at the quality floor: downscale until it fits.
+        img = bgr
+        if opts.fmt == "jpeg" and not opts.progressive and not opts.subsampling:
+            img, buf = downsample_to_bytes(bgr, opts.target_bytes, quality=quality, encode=True)
+        for _ in range(4):
+            if len(buf) <= opts.target_bytes or min(img.shape[:2]) <= 1:
+                break
+            img = _resize_scale(img, math.sqrt(opts.target_bytes / float(len(buf))) * 0.97)
+            buf = _encode(img, opts, quality)
+        if len(buf) > opts.target_bytes:
+            # The size model missed (tiny budgets are dominated by headers): bisect the scale
+            # on full encodes between the current size (over) and a 1-pixel long side.
+            hi = img.shape[1] / float(bgr.shape[1])
+            lo = 1.0 / max(bgr.shape[:2])
+            buf = _encode(_resize_scale(bgr, lo), opts, quality)
+            if len(buf) <= opts.target_bytes:
+                while hi / lo > 1.03:
+                    mid = math.sqrt(lo * hi)
+                    mid_buf = _encode(_resize_scale(bgr, mid), opts, quality)
+                    if len(mid_buf) <= opts.target_bytes:
+                        lo, buf = mid, mid_buf
+                    else:
+                        hi = mid
+    return buf.tobytes(), mime
+
+def to_data_url(data: bytes, mime: str) -> str:
+    return f"data:{mime};base64,{base64.b64encode(data).decode('utf-8')}"
+
+def encode_data_url(bgr: np.ndarray, opts: EncodeOptions) -> str:
+    return to_data_url(*encode_image(bgr, opts))
+
+
+# Encoder work runs on a small dedicated pool so API handlers don't block the event
+# loop; cv2.imencode releases the GIL, so threads encode in parallel.
+_ENCODE_POOL: Optional[ThreadPoolExecutor] = None
+
+def _encode_pool() -> ThreadPoolExecutor:
+    global _ENCODE_POOL
+    if _ENCODE_POOL is None:
+        workers = int(os.getenv("ENCODE_THREADS", "0")) or min(4, os.cpu_count() or 1)
+        _ENCODE_POOL = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="encode")
+    return _ENCODE_POOL
+
+async def encode_image_async(bgr: np.ndarray, opts: EncodeOptions) -> Tuple[bytes, str]:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_encode_pool(), encode_image, bgr, opts)
+
+async def encode_data_url_async(bgr: np.ndarray, opts: EncodeOptions) -> str:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_encode_pool(), encode_data_url, bgr, opts)
@@ -22,6 +22,10 @@ python sticker.py -i imgs/$image_path.jpg -o results/sticker_face_$image_path.jp
 
 # given json, use Generative models to generate cartoon faces
 python inpaint.py -i imgs/$image_path.jpg -o results/inpaint_face_$image_path.jpg -j jsons/face_$image_path.json -t face
+# without a GPU: classical OpenCV toon faces / synthetic plate text (--engine auto picks this when CUDA is missing)
+# python inpaint.py -i imgs/$image_path.jpg -o results/inpaint_plate_$image_path.jpg -j jsons/plate_$image_path.json -t plate --engine cpu
+# latency of the two backends side by side (the flux ops need CUDA)
+# python bench.py --ops inpaint_faces_cpu,inpaint_faces_flux,inpaint_plates_cpu,inpaint_plates_flux --mp 1,12 --boxes 1
 
 
 image_path=agus-dietrich-eUjufrdx_bM-unsplash
@@ -29,3 +33,34 @@ image_path=agus-dietrich-eUjufrdx_bM-unsplash
 
 # detect doc for image
 python blur_doc.py -i imgs/$image_path.jpg -o results/blur_doc_$image_path.jpg
+
+# whole directory in one process: models load once, outputs land in results/ and jsons/ as above;
+# rerun the same command to resume after an interruption
+# python batch.py -i imgs -m face=blur -m plate=blur -m face=sticker -m face=inpaint
+# python batch.py --manifest archive.txt -m face=blur -m plate=blur -m document=blur --composite -w 4
+
+# faces, plates and documents in one pass from a typed detections JSON (one decode, one encode)
+# python compositor.py -i imgs/$image_path.jpg -j jsons/$image_path.json -o results/composite_$image_path.jpg -m plate=pixelate
+
+# blur faces in a video (detectors on keyframes, tracked boxes in between)
+# python video.py -i clip.mp4 -o results/blur_face_clip.mp4 -t face -k 10
+# python video.py --check-edges   # boxes cut by the frame border must still be obfuscated
+
+# benchmark detect/obfuscate/encode on synthetic + fixture images (stub detectors, no weights needed)
+# python bench.py --mp 1,4,12 --boxes 0,1,10 -o results/bench_baseline.json
+# python bench.py --mp 1,4,12 --boxes 0,1,10 -o results/bench.json --compare results/bench_baseline.json
+
+# int8 face detector: quantize buffalo_l's det_10g.onnx once, then point the engine at it
+# python -c "import detect; detect.quantize_face_detector('$HOME/.insightface/models/buffalo_l/det_10g.onnx', 'det_10g_int8.onnx')"
+# NOPEEK_FACE_DET_MODEL=det_10g_int8.onnx NOPEEK_FACE_THREADS=2 python detect.py -i imgs/$image_path.jpg -t face
+
+# load-test the API in-process (SQLite + stub detectors) at several concurrency levels (pip install -r requirements-dev.txt)
+# python loadtest.py -c 1,4,8 -n 40 -o results/loadtest.json
+
+# worker pool: one model-holding process per core, images passed through shared memory
+# python workers.py -i imgs/$image_path.jpg -w 4 -n 32
+# NOPEEK_WORKERS=4 uvicorn test:app --host 0.0.0.0 --port 8000
+
+# import-time budgets: fails if a module imports too slowly or pulls in torch/paddle/... eagerly
+# python importtime.py
+# python -X importtime -c "import compositor" 2>&1 | sort -t'|' -k2 -n | tail -15
@@ -0,0 +1,29 @@
+// Copyright 2025 The NoPeek Authors. All rights reserved.
+// Licensed under the Apache License, Version 2.0 that can be found in the
+// LICENSE file in the root directory of this source tree.
+
+# gating.py — cheap scene checks that decide whether the plate / document detectors run at all
+import os
+
+import metrics
+
+# Minimum gate score for the full detector to run; lower = safer recall, fewer skips; 0 = never skip.
+#   plate:    best plate confidence from a 320 px YOLO pass at conf 0.05 (detect.plate_gate_score)
+#   document: best proposal confidence from one 800 px proposal pass (blur_doc.document_gate_score)
+_DEFAULT_THRESHOLDS = {"plate": 0.1, "document": 0.3}
+
+
+def gate_threshold(detector: str) -> float:
+    return float(os.getenv(f"NOPEEK_GATE_{detector.upper()}", _DEFAULT_THRESHOLDS[detector]))
+
+def gate_enabled(detector: str) -> bool:
+    return gate_threshold(detector) > 0
+
+def record_gate(detector: str, ran: bool) -> None:
+    metrics.inc("nopeek_gate_total", detector=detector, decision="run" if ran else "skip")
+
+def should_run(detector: str, score: float) -> bool:
+    """Gate decision for one image, counted in nopeek_gate_total{detector, decision}."""
+    ran = score >= gate_threshold(detector)
+    record_gate(detector, ran)
+    return ran
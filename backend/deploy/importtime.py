@@ -0,0 +1,98 @@
+// Copyright 2025 The NoPeek Authors. All rights reserved.
+// Licensed under the Apache License, Version 2.0 that can be found in the
+// LICENSE file in the root directory of this source tree.
+
+# importtime.py — import-time budget check for the deploy modules (python -X importtime)
+import argparse, os, subprocess, sys
+from typing import Dict, List, Optional, Set, Tuple
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Cumulative import time per module in ms, about 2x what a 1-core dev box measures; numpy
+# (~70 ms) and cv2 (~110 ms) are the floor for anything that touches images.
+BUDGETS_MS: Dict[str, float] = {
+    "lazy": 10,
+    "metrics": 15,
+    "gating": 15,
+    "storage": 100,        # asyncio
+    "cache": 120,
+    "detections": 200,
+    "workers": 250,
+    "masks": 250,
+    "blur": 250,
+    "sticker": 300,
+    "blur_doc": 300,
+    "encode": 300,
+    "detect": 300,
+    "inpaint": 300,        # torch/diffusers are deferred; importing them here costs seconds
+    "compositor": 350,
+    "batch": 400,
+    "db": 800,             # SQLAlchemy ORM + asyncio extension
+    "test": 2000,          # FastAPI + everything above
+}
+
+# Model stacks that must only load on first use, never as a side effect of an import.
+DEFERRED = ("torch", "diffusers", "image_gen_aux", "paddleocr", "paddle", "insightface", "onnxruntime", "ultralytics")
+
+
+def _measure(module: str) -> Tuple[Optional[float], Set[str], str]:
+    """(cumulative ms or None on failure, top-level packages imported, stderr tail) for one cold import."""
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                          capture_output=True, text=True, cwd=HERE)
+    total, loaded = None, set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        parts = line[len("import time:"):].split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        name = parts[2].strip()
+        loaded.add(name.split(".")[0])
+        if parts[2].rstrip() == f" {module}":    # the module's own line is the unindented one
+            total = int(parts[1]) / 1000.0
+    if proc.returncode != 0:
+        total = None
+    return total, loaded, proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else ""
+
+def check(modules: List[str], repeat: int = 3, scale: float = 1.0) -> List[str]:
+    """Import each module `repeat` times in a fresh interpreter; returns the failures."""
+    failures = []
+    for module in modules:
+        budget = BUDGETS_MS[module] * scale
+        runs = [_measure(module) for _ in range(max(1, repeat))]
+        times = [t for t, _, _ in runs if t is not None]
+        if not times:
+            failures.append(f"{module}: import failed ({runs[-1][2]})")
+            print(f"{module:<12} {'error':>10}   budget {budget:7.0f} ms   FAIL")
+            continue
+        best = min(times)
+        deferred = sorted(set(DEFERRED) & runs[0][1])
+        ok = best <= budget and not deferred
+        print(f"{module:<12} {best:7.1f} ms   budget {budget:7.0f} ms   {'ok' if ok else 'FAIL'}"
+              + (f"   loads {', '.join(deferred)}" if deferred else ""))
+        if best > budget:
+            failures.append(f"{module}: {best:.1f} ms > {budget:.0f} ms")
+        if deferred:
+            failures.append(f"{module}: imports {', '.join(deferred)} eagerly")
+    return failures
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Fail when a module's cold import exceeds its budget or loads a model stack.")
+    ap.add_argument("modules", nargs="*", help=f"Modules to check (default: all of {', '.join(BUDGETS_MS)})")
+    ap.add_argument("--repeat", type=int, default=3, help="Cold imports per module; the fastest counts")
+    ap.add_argument("--scale", type=float, default=float(os.getenv("IMPORT_BUDGET_SCALE", 1.0)),
+                    help="Multiply every budget, e.g. 2 on a slow CI runner")
+    args = ap.parse_args()
+
+    unknown = [m for m in args.modules if m not in BUDGETS_MS]
+    if unknown:
+        ap.error(f"no budget for: {', '.join(unknown)}")
+    failures = check(args.modules or list(BUDGETS_MS), args.repeat, args.scale)
+    if failures:
+        print("\n".join(["", "Import budget exceeded:"] + [f"  {f}" for f in failures]))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,13 +2,34 @@
 // Licensed under the Apache License, Version 2.0 that can be found in the
 // LICENSE file in the root directory of this source tree.
 
-import argparse, os, cv2, json
+import argparse, os, zlib, cv2
 import numpy as np
-import torch, random
+import random
+from functools import lru_cache
 from typing import List, Dict, Tuple, Sequence
-from PIL import Image
 
-print(torch.cuda.is_available(), torch.cuda.device_count(), torch.cuda.get_device_name(0) if torch.cuda.is_available() else "N/A")
+from encode import downsample_to_bytes
+from detections import load_detections
+from lazy import lazy_import
+from masks import stamp_ellipse, stamp_rect
+from metrics import span
+
+# torch and PIL load on first use, so importing this module (compositor, --help) stays cheap
+torch = lazy_import("torch")
+Image = lazy_import("PIL.Image")
+
+@lru_cache(maxsize=1)
+def cuda_available() -> bool:
+    """True when torch is installed and sees a CUDA device; loads torch on first call."""
+    try:
+        return bool(torch.cuda.is_available())
+    except ImportError:
+        return False
+
+def _device_info() -> str:
+    if not cuda_available():
+        return "False 0 N/A"
+    return f"True {torch.cuda.device_count()} {torch.cuda.get_device_name(0)}"
 
 def _set_seed(s: int):
     random.seed(s)
@@ -59,95 +80,235 @@ def _ellipse_mask_from_bbox(h: int, w: int, box: Tuple[int, int, int, int],
     rx, ry = int(bw * (0.5 + grow)), int(bh * (0.55 + grow))
     _assert_in_bounds(cx - rx, cy - ry, cx + rx, cy + ry, w, h, "ellipse")
     m = np.zeros((h, w), np.uint8)
-    cv2.ellipse(m, (cx, cy), (rx, ry), 0, 0, 360, 255, -1)
-    if feather > 0:
-        k = feather | 1
-        m = cv2.GaussianBlur(m, (k, k), 0)
+    stamp_ellipse(m, (cx, cy), (rx, ry), feather)
     return m
 
 def _rect_mask_for_plate(H: int, W: int, box: Tuple[int, int, int, int], pad: int, feather: int) -> np.ndarray:
     x1, y1, x2, y2 = box
     _assert_in_bounds(x1 - pad, y1 - pad, x2 + pad, y2 + pad, W, H, "plate+pad")
     m = np.zeros((H, W), np.uint8)
-    cv2.rectangle(m, (x1 - pad, y1 - pad), (x2 + pad, y2 + pad), 255, -1)
-    if feather > 0:
-        k = feather | 1
-        m = cv2.GaussianBlur(m, (k, k), 0)
+    stamp_rect(m, x1 - pad, y1 - pad, x2 + pad, y2 + pad, feather)
     return m
 
-def _load_detections(json_path: str) -> List[Dict]:
-    with open(json_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    if not isinstance(data, list):
-        raise ValueError("Detections JSON must be a list of objects.")
-    out: List[Dict] = []
-    for d in data:
-        if not isinstance(d, dict):
-            continue
-        bb = d.get("bbox_xyxy", None)
-        if isinstance(bb, (list, tuple)) and len(bb) == 4:
-            attrs = d.get("attributes", {})
-            if not isinstance(attrs, dict):
-                attrs = {}
-            out.append({"bbox_xyxy": bb, "attributes": attrs})
-    return out
-
-
-# ---- lightweight size-based downsampler (JPEG-estimate) ----
-def _encoded_size_bytes(bgr: np.ndarray, quality: int = 92) -> int:
-    ok, buf = cv2.imencode(".jpg", bgr, [int(cv2.IMWRITE_JPEG_QUALITY), int(quality)])
-    if not ok:
-        raise RuntimeError("cv2.imencode failed while estimating size")
-    return len(buf)
-
+# ---- lightweight size-based downsampler (JPEG size model) ----
 def _downsample_to_approx_bytes(
     bgr: np.ndarray,
     target_bytes: int = 1_000_000,   # ~1 MB
     min_side: int = 640,             # don’t shrink below this
     quality: int = 92                # encoding quality used only for size estimation
 ) -> np.ndarray:
-    H, W = bgr.shape[:2]
-    cur = _encoded_size_bytes(bgr, quality=quality)
-    if cur <= target_bytes:
+    # scale is predicted from two low-res trial encodes; no full-size encode needed
+    out, _ = downsample_to_bytes(bgr, target_bytes=target_bytes, min_side=min_side, quality=quality)
+    return out
+
+
+# ---- quality tiers for the face pipeline ----
+# "preview" runs a short schedule at reduced resolution so the client gets a usable
+# stylized image quickly; "final" is the full schedule. Step counts only shrink, the
+# prompt/LoRA/seed are shared so the preview is a faithful sketch of the final.
+FACE_QUALITY_TIERS = {
+    "preview": {"max_side": 640,  "fill_steps": 12, "depth_steps": 8,  "depth_strength": 0.95},
+    "final":   {"max_side": 1280, "fill_steps": 60, "depth_steps": 36, "depth_strength": 0.985},
+}
+
+
+# ---- engines ----
+# The FLUX engines need a CUDA device; "cpu" is classical OpenCV work that runs anywhere in
+# bounded time (tens of ms per box). "auto" takes NOPEEK_INPAINT_ENGINE when set, otherwise
+# the first FLUX engine if CUDA is available, else "cpu".
+FACE_ENGINES = ("flux_depth", "flux_fill", "cpu")
+PLATE_ENGINES = ("flux_fill", "cpu")
+ENGINES = ("auto",) + FACE_ENGINES
+
+def resolve_engine(engine: str, target: str) -> str:
+    """Concrete engine for target "face" or "plate"; raises ValueError for an engine the target lacks."""
+    engines = FACE_ENGINES if target == "face" else PLATE_ENGINES
+    if engine == "auto":
+        engine = os.getenv("NOPEEK_INPAINT_ENGINE", "auto")
+        if engine == "auto":
+            engine = engines[0] if cuda_available() else "cpu"
+        elif engine.startswith("flux") and engine not in engines:
+            engine = engines[0]   # e.g. NOPEEK_INPAINT_ENGINE=flux_depth -> flux_fill for plates
+    if engine not in engines:
+        raise ValueError(f"{target} engine must be one of {', '.join(('auto',) + engines)}, got {engine!r}")
+    return engine
+
+
+# ---- CPU engine: faces ----
+def _cel_shade(bgr: np.ndarray) -> np.ndarray:
+    # edge-preserving smoothing, then lightness posterized into bands; chroma is kept, so no hue shifts
+    smooth = cv2.bilateralFilter(cv2.bilateralFilter(bgr, 9, 75, 9), 9, 75, 9)
+    lab = cv2.cvtColor(smooth, cv2.COLOR_BGR2LAB)
+    lab[..., 0] = (lab[..., 0] // 48) * 48 + 24
+    return cv2.cvtColor(lab, cv2.COLOR_LAB2BGR)
+
+def _draw_toon_face(img: np.ndarray, cx: float, cy: float, rx: float, ry: float,
+                    skin: Tuple[int, int, int], ink: Tuple[int, int, int]):
+    # flat outlined head in the face's own skin tone, two glossy eyes and a small smile
+    t = max(1, int(round(rx / 22)))
+    c, axes = (int(cx), int(cy)), (max(2, int(rx)), max(2, int(ry)))
+    cv2.ellipse(img, c, axes, 0, 0, 360, skin, -1, cv2.LINE_AA)
+    cv2.ellipse(img, c, axes, 0, 0, 360, ink, t, cv2.LINE_AA)
+    ew, eh = max(2, int(rx * 0.13)), max(3, int(ry * 0.17))
+    for sx in (-1, 1):
+        ex, ey = int(cx + sx * rx * 0.36), int(cy - ry * 0.08)
+        cv2.ellipse(img, (ex, ey), (ew, eh), 0, 0, 360, ink, -1, cv2.LINE_AA)
+        cv2.circle(img, (ex - ew // 3, ey - eh // 3), max(1, ew // 3), (255, 255, 255), -1, cv2.LINE_AA)
+    cv2.ellipse(img, (int(cx), int(cy + ry * 0.36)), (max(2, int(rx * 0.16)), max(1, int(ry * 0.07))),
+                0, 15, 165, ink, t, cv2.LINE_AA)
+
+def cartoon_faces_cpu(bgr: np.ndarray, dets: List[Dict], quality: str = "final") -> np.ndarray:
+    """
+    CPU face replacement with the FLUX path's box expansion and feathered ellipse mask.
+    Each face is filled from its surroundings with Telea inpainting (no facial feature
+    survives), cel-shaded, painted over with a flat toon head in the face's skin tone and
+    blended in. Work happens on the
+    face ROI at <= 256 px (preview: 128 px), so the cost per face does not grow with the image.
+    """
+    if not dets:
+        return bgr
+    if quality not in FACE_QUALITY_TIERS:
+        raise ValueError(f"quality must be one of {sorted(FACE_QUALITY_TIERS)}")
+    side = 128 if quality == "preview" else 256
+    grow, feather = 0.20, 35
+
+    out = bgr.copy()
+    H, W = out.shape[:2]
+    for k, d in enumerate(dets):
+        # same expansion as the FLUX path, but clipped rather than rejected at the frame edge
+        x1, y1, x2, y2 = _denorm_xyxy(d["bbox_xyxy"], W, H)
+        dx, dy = int(round((x2 - x1) * 0.16)), int(round((y2 - y1) * 0.16))
+        x1, y1, x2, y2 = max(0, x1 - dx), max(0, y1 - dy), min(W, x2 + dx), min(H, y2 + dy)
+        if x2 <= x1 or y2 <= y1:
+            continue
+        bw, bh = x2 - x1, y2 - y1
+        cx, cy = x1 + bw // 2, y1 + bh // 2
+        rx, ry = int(bw * (0.5 + grow)), int(bh * (0.55 + grow))
+        # ROI = ellipse + feather reach + a ring of context for the fill, clipped to the frame
+        m = feather // 2 + 1 + max(rx, ry) // 4
+        ox1, oy1, ox2, oy2 = max(0, cx - rx - m), max(0, cy - ry - m), min(W, cx + rx + m + 1), min(H, cy + ry + m + 1)
+        roi = out[oy1:oy2, ox1:ox2]
+        mask = np.zeros(roi.shape[:2], np.uint8)
+        stamp_ellipse(mask, (cx - ox1, cy - oy1), (rx, ry), feather)
+
+        rh, rw = roi.shape[:2]
+        scale = min(1.0, side / max(rh, rw))
+        sw, sh = max(1, int(round(rw * scale))), max(1, int(round(rh * scale)))
+        small = cv2.resize(roi, (sw, sh), interpolation=cv2.INTER_AREA)
+        hole = cv2.resize(mask, (sw, sh), interpolation=cv2.INTER_AREA)
+        # skin tone from the face centre, taken before the fill
+        fx, fy, fr = int((cx - ox1) * scale), int((cy - oy1) * scale), max(1, int(min(bw, bh) * 0.15 * scale))
+        skin = np.median(small[max(0, fy - fr):fy + fr + 1, max(0, fx - fr):fx + fr + 1].reshape(-1, 3), axis=0)
+        holes = (hole > 8).astype(np.uint8) * 255
+        filled = cv2.inpaint(small, holes, 3, cv2.INPAINT_TELEA)
+        # Telea streaks over large holes; soften the fill before shading
+        soft = cv2.GaussianBlur(filled, (0, 0), max(1.0, max(sw, sh) / 64))
+        np.copyto(filled, soft, where=holes[..., None] > 0)
+        toon = _cel_shade(filled)
+        _draw_toon_face(toon, (cx - ox1) * scale, (cy - oy1) * scale, (bw / 2) * scale, (bh * 0.55) * scale,
+                        tuple(int(v) for v in skin), tuple(int(v * 0.3) for v in skin))
+        toon = cv2.resize(toon, (rw, rh), interpolation=cv2.INTER_LINEAR)
+
+        a = mask.astype(np.float32) / 255.0
+        roi[:] = cv2.blendLinear(toon, roi.copy(), a, 1.0 - a)
+    return out
+
+
+# ---- CPU engine: plates ----
+_PLATE_CHARS = "ABCDEFGHJKLMNPRSTUVWXYZ0123456789"
+
+def _plate_text(rng: np.random.Generator, aspect: float) -> str:
+    n = int(np.clip(round(aspect * 3), 4, 8))
+    chars = "".join(rng.choice(list(_PLATE_CHARS), n))
+    return chars if n < 6 else f"{chars[:n // 2]} {chars[n // 2:]}"
+
+def synth_plates_cpu(bgr: np.ndarray, dets: List[Dict], seed: int = 1234) -> np.ndarray:
+    """
+    CPU plate replacement: each plate (padded and feathered like the FLUX path) is
+    repainted as a blank plate in its own background and ink colours, with random
+    characters seeded per plate and input, softened and grained to sit in the photo.
+    """
+    if not dets:
         return bgr
+    pad, feather = 6, 21
+    font = cv2.FONT_HERSHEY_DUPLEX
 
-    # one-shot scale based on sqrt ratio of sizes
-    scale = max((target_bytes / float(cur)) ** 0.5, 0.1)
-    new_w = max(min_side, int(W * scale))
-    new_h = max(min_side, int(H * scale))
-    if new_w < W or new_h < H:
-        bgr = cv2.resize(bgr, (new_w, new_h), interpolation=cv2.INTER_AREA)
-
-    # refine with a short multiplicative backoff if still too big
-    backoff = 0.88
-    tries = 0
-    while _encoded_size_bytes(bgr, quality=quality) > target_bytes and tries < 6:
-        h, w = bgr.shape[:2]
-        if h <= min_side or w <= min_side:
-            break
-        bgr = cv2.resize(
-            bgr,
-            (max(min_side, int(w * backoff)), max(min_side, int(h * backoff))),
-            interpolation=cv2.INTER_AREA,
-        )
-        tries += 1
-    return bgr
+    out = bgr.copy()
+    H, W = out.shape[:2]
+    for idx, d in enumerate(dets):
+        x1, y1, x2, y2 = _denorm_xyxy(d["bbox_xyxy"], W, H)
+        x1, y1, x2, y2 = max(0, x1), max(0, y1), min(W, x2), min(H, y2)
+        if x2 - x1 < 2 or y2 - y1 < 2:
+            continue
+        plate = bgr[y1:y2, x1:x2]
+        # the plate's own pixels pick the characters: stable for an input, different across inputs
+        rng = np.random.default_rng([(seed + idx * 101) & 0x7FFFFFFF, zlib.crc32(np.ascontiguousarray(plate))])
+        gray = cv2.cvtColor(plate, cv2.COLOR_BGR2GRAY)
+        lo, hi = np.percentile(gray, (15, 70))
+        bg = plate[gray >= hi].reshape(-1, 3).mean(axis=0)
+        ink = plate[gray <= lo].reshape(-1, 3).mean(axis=0)
+        if abs(float(hi) - float(lo)) < 40:   # flat or unreadable plate: pick a contrasting ink
+            ink = np.zeros(3) if bg.mean() > 110 else np.full(3, 235.0)
+
+        # canvas covers the padded box so the feather only ever blends plate into car
+        px1, py1, px2, py2 = max(0, x1 - pad), max(0, y1 - pad), min(W, x2 + pad), min(H, y2 + pad)
+        canvas = np.empty((py2 - py1, px2 - px1, 3), np.uint8)
+        canvas[:] = np.clip(bg, 0, 255).astype(np.uint8)
+        bw, bh = x2 - x1, y2 - y1
+        ox, oy = x1 - px1, y1 - py1
+        ink_c = tuple(int(c) for c in np.clip(ink, 0, 255))
+        cv2.rectangle(canvas, (ox, oy), (ox + bw - 1, oy + bh - 1), ink_c, max(1, bh // 18), cv2.LINE_AA)
+
+        text = _plate_text(rng, bw / max(1, bh))
+        thick = max(1, bh // 10)
+        (tw, th), _ = cv2.getTextSize(text, font, 1.0, thick)
+        fs = min(0.82 * bw / max(1, tw), 0.58 * bh / max(1, th))
+        thick = max(1, int(round(thick * min(1.0, fs))))
+        (tw, th), _ = cv2.getTextSize(text, font, fs, thick)
+        cv2.putText(canvas, text, (ox + (bw - tw) // 2, oy + (bh + th) // 2), font, fs, ink_c, thick, cv2.LINE_AA)
+
+        canvas = cv2.GaussianBlur(canvas, (0, 0), max(0.6, bh / 70))
+        grain = rng.normal(0.0, 3.0, canvas.shape).astype(np.float32)
+        canvas = np.clip(canvas.astype(np.float32) + grain, 0, 255).astype(np.uint8)
+
+        # blend over the ROI the feathered rect reaches
+        r = feather // 2 + 1
+        rx1, ry1, rx2, ry2 = max(0, px1 - r), max(0, py1 - r), min(W, px2 + r), min(H, py2 + r)
+        roi = out[ry1:ry2, rx1:rx2]
+        src = roi.copy()
+        src[py1 - ry1:py2 - ry1, px1 - rx1:px2 - rx1] = canvas
+        mask = np.zeros(roi.shape[:2], np.uint8)
+        stamp_rect(mask, px1 - rx1, py1 - ry1, px2 - rx1 - 1, py2 - ry1 - 1, feather)
+        a = mask.astype(np.float32) / 255.0
+        roi[:] = cv2.blendLinear(src, roi.copy(), a, 1.0 - a)
+    return out
 
 
 def inpaint_faces(bgr: np.ndarray,
                   dets: List[Dict],
-                  engine: str = "flux_depth") -> np.ndarray:
+                  engine: str = "auto",
+                  quality: str = "final") -> np.ndarray:
     """
     Stronger anime stylization for *all* faces.
     - Heavier LoRA
     - Stronger overwrite (depth strength higher)
     - Larger mask & bbox expansion
+    - engine: "flux_depth" / "flux_fill" (CUDA), "cpu" (cartoon_faces_cpu) or "auto"
+    - quality: "preview" (few steps, reduced resolution) or "final" (full schedule)
     """
     if not dets:
         return bgr
-    if not torch.cuda.is_available():
-        raise RuntimeError("CUDA not available: the face pipeline requires a CUDA device for speed.")
-
+    if quality not in FACE_QUALITY_TIERS:
+        raise ValueError(f"quality must be one of {sorted(FACE_QUALITY_TIERS)}")
+    engine = resolve_engine(engine, "face")
+    if engine == "cpu":
+        return cartoon_faces_cpu(bgr, dets, quality=quality)
+    if not cuda_available():
+        raise RuntimeError(f"CUDA not available: engine {engine!r} requires a CUDA device; use engine='cpu'.")
+    tier = FACE_QUALITY_TIERS[quality]
+
+    # FLUX runs on a ~1 MB working copy; the result is scaled back so callers get their own size.
+    orig_hw = bgr.shape[:2]
     bgr = _downsample_to_approx_bytes(bgr, target_bytes=1_000_000, min_side=640, quality=92)
 
     from diffusers import FluxFillPipeline, FluxControlInpaintPipeline
@@ -171,7 +332,7 @@ def inpaint_faces(bgr: np.ndarray,
     # More aggressive coverage & blending for a full replacement
     grow = 0.20     # was 0.12
     feather = 35    # slightly softer edges than 33
-    max_side = 1280
+    max_side = tier["max_side"]
 
     # LoRA (kept from your setup but increased influence)
     lora_repo   = "XLabs-AI/flux-lora-collection"
@@ -182,9 +343,9 @@ def inpaint_faces(bgr: np.ndarray,
 
     # Sampling tuned for stronger stylization
     # Flux-Fill benefits from a few more steps & modest guidance
-    fill_steps, fill_guidance = 60, 8.0          # was 44, 30.0 (30 is too high for stylization here)
+    fill_steps, fill_guidance = tier["fill_steps"], 8.0          # final: 60 (was 44, 30.0 — 30 is too high for stylization here)
     # Depth: increase overwrite strength to replace original features more decisively
-    depth_steps, depth_guidance, depth_strength = 36, 7.0, 0.985  # was 30, 10.0, 0.90
+    depth_steps, depth_guidance, depth_strength = tier["depth_steps"], 7.0, tier["depth_strength"]  # final: 36, 7.0, 0.985 (was 30, 10.0, 0.90)
 
     common = f"{base_prompt}, {', '.join(style_tags)}, ultra clean, high quality"
 
@@ -267,12 +428,20 @@ def inpaint_faces(bgr: np.ndarray,
             out_np = cv2.resize(out_np, (W, H), interpolation=cv2.INTER_LANCZOS4)
         work = out_np
 
-    return cv2.cvtColor(work, cv2.COLOR_RGB2BGR)
+    res = cv2.cvtColor(work, cv2.COLOR_RGB2BGR)
+    if res.shape[:2] != orig_hw:
+        res = cv2.resize(res, (orig_hw[1], orig_hw[0]), interpolation=cv2.INTER_LANCZOS4)
+    return res
 
 
-def inpaint_plates(bgr: np.ndarray, dets: List[Dict]) -> np.ndarray:
+def inpaint_plates(bgr: np.ndarray, dets: List[Dict], engine: str = "auto") -> np.ndarray:
     if not dets:
         return bgr
+    engine = resolve_engine(engine, "plate")
+    if engine == "cpu":
+        return synth_plates_cpu(bgr, dets)
+    if not cuda_available():
+        raise RuntimeError(f"CUDA not available: engine {engine!r} requires a CUDA device; use engine='cpu'.")
 
     from diffusers import FluxFillPipeline
 
@@ -291,7 +460,9 @@ def inpaint_plates(bgr: np.ndarray, dets: List[Dict]) -> np.ndarray:
 
     H, W = bgr.shape[:2]
     work = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
-    dtype, device = torch.float16, torch.device("cuda")
+    device = torch.device("cuda")
+    major, _ = torch.cuda.get_device_capability(0)
+    dtype = torch.float16 if major >= 7 else torch.float32
     h, w = _round_hw(H, W, mult=16, max_side=max_side)
 
     pipe = FluxFillPipeline.from_pretrained("black-forest-labs/FLUX.1-Fill-dev",
@@ -340,33 +511,45 @@ def main():
     ap.add_argument("-j", "--json", required=True, help="Detections JSON (list of {bbox_xyxy:[x1,y1,x2,y2], ...})")
     ap.add_argument("-t", "--target", choices=["face", "plate"], required=True, help="What to inpaint")
     ap.add_argument("-o", "--output", default=None, help="Output image path")
-    ap.add_argument("--engine", choices=["flux_fill", "flux_depth"], default="flux_depth",
-                    help="Face inpaint engine (used only when -t face)")
+    ap.add_argument("--engine", choices=list(ENGINES), default="auto",
+                    help="flux_depth / flux_fill need CUDA (plates: flux_fill only); cpu runs anywhere; "
+                         "auto = $NOPEEK_INPAINT_ENGINE, else FLUX with CUDA, else cpu")
+    ap.add_argument("--quality", choices=sorted(FACE_QUALITY_TIERS), default="final",
+                    help="Face quality tier: 'preview' is fast and low-res, 'final' is the full schedule")
     args = ap.parse_args()
-
-    bgr = cv2.imread(args.input)
+    try:
+        engine = resolve_engine(args.engine, args.target)
+    except ValueError as e:
+        ap.error(str(e))
+    print(_device_info(), f"engine={engine}")
+
+    with span("image.decode"):
+        bgr = cv2.imread(args.input)
     if bgr is None:
         raise FileNotFoundError(args.input)
 
-    dets: List[Dict] = _load_detections(args.json)
+    dets: List[Dict] = load_detections(args.json)
 
     if args.target == "face":
         if not dets:
             print("No face boxes in JSON — output will equal input.")
             out = bgr
         else:
-            out = inpaint_faces(bgr, dets, engine=args.engine)
+            with span("obfuscate.inpaint_face"):
+                out = inpaint_faces(bgr, dets, engine=engine, quality=args.quality)
         suffix = "_face_inpaint.jpg"
     else:
         if not dets:
             print("No plate boxes in JSON — output will equal input.")
             out = bgr
         else:
-            out = inpaint_plates(bgr, dets)
+            with span("obfuscate.inpaint_plate"):
+                out = inpaint_plates(bgr, dets, engine=engine)
         suffix = "_plate_inpaint.jpg"
 
     out_path = args.output or os.path.splitext(args.input)[0] + suffix
-    cv2.imwrite(out_path, out)
+    with span("image.encode"):
+        cv2.imwrite(out_path, out)
     print(f"Done. Wrote: {out_path}")
     print(f"Elapsed: {time.time() - s_:.1f} sec.")
 
@@ -0,0 +1,153 @@
+// Copyright 2025 The NoPeek Authors. All rights reserved.
+// Licensed under the Apache License, Version 2.0 that can be found in the
+// LICENSE file in the root directory of this source tree.
+
+# jpeg_patch.py — re-encode only the changed MCUs of a JPEG, copy every other DCT block as-is
+import os, tempfile
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+_HAS_JPEGLIB = False
+try:
+    import jpeglib  # in requirements.txt; without it every patch request falls back to a full encode
+    _HAS_JPEGLIB = True
+except Exception:
+    _HAS_JPEGLIB = False
+
+
+# Luma sampling factors we know how to splice (chroma must be 1x1):
+# 4:4:4, 4:2:2 (horizontal), 4:4:0 (vertical) and 4:2:0.
+_SPLICEABLE_LUMA = {(1, 1), (2, 1), (1, 2), (2, 2)}
+
+
+def _mcu_size(samp_factor: np.ndarray) -> Optional[Tuple[int, int]]:
+    """Return (mcu_w, mcu_h) in pixels, or None if the sampling layout isn't spliceable."""
+    sf = np.asarray(samp_factor)
+    if sf.shape != (3, 2) or not (sf[1] == 1).all() or not (sf[2] == 1).all():
+        return None
+    v, h = int(sf[0][0]), int(sf[0][1])
+    if (h, v) not in _SPLICEABLE_LUMA:
+        return None
+    return 8 * h, 8 * v
+
+# Every spliceable MCU is 8 or 16 px on a side, so rects on a 16 px grid fit any of them.
+REGION_GRID = 16
+# Past this share of the frame a patch saves nothing over a full encode.
+MAX_PATCH_FRACTION = 0.5
+
+
+def _grid_rects(grid: np.ndarray, W: int, H: int, cell_w: int, cell_h: int) -> List[Tuple[int, int, int, int]]:
+    # Merge touching dirty cells into rectangles (bounding boxes of 8-connected components).
+    n, _, stats, _ = cv2.connectedComponentsWithStats(grid.astype(np.uint8), connectivity=8)
+    rects = []
+    for i in range(1, n):
+        gx, gy, gw_i, gh_i = (int(v) for v in stats[i][:4])
+        rects.append((gx * cell_w, gy * cell_h, min(W, (gx + gw_i) * cell_w), min(H, (gy + gh_i) * cell_h)))
+    return rects
+
+def dirty_mcu_rects(before: np.ndarray, after: np.ndarray, mcu_w: int = REGION_GRID,
+                    mcu_h: int = REGION_GRID) -> List[Tuple[int, int, int, int]]:
+    """
+    MCU-aligned rectangles (x1, y1, x2, y2) covering every pixel that differs between
+    before and after. Works for any obfuscator since it only looks at the pixels, so
+    `after` must be the exact obfuscated buffer: diffing a re-decoded JPEG marks the whole frame.
+    """
+    H, W = before.shape[:2]
+    gh, gw = -(-H // mcu_h), -(-W // mcu_w)
+    # Channels side by side (H x W*C), padded to a whole number of MCUs; a max filter the
+    # size of one MCU anchored at its top-left corner, sampled once per MCU, is that MCU's max.
+    diff = cv2.absdiff(before, after).reshape(H, -1)
+    c = diff.shape[1] // W
+    diff = cv2.copyMakeBorder(diff, 0, gh * mcu_h - H, 0, (gw * mcu_w - W) * c, cv2.BORDER_CONSTANT, value=0)
+    cell = cv2.getStructuringElement(cv2.MORPH_RECT, (mcu_w * c, mcu_h))
+    grid = cv2.dilate(diff, cell, anchor=(0, 0), borderType=cv2.BORDER_CONSTANT, borderValue=0)[::mcu_h, ::mcu_w * c] > 0
+    if not grid.any():
+        return []
+    return _grid_rects(grid, W, H, mcu_w, mcu_h)
+
+def snap_rects(rects: List[Tuple[int, int, int, int]], W: int, H: int, mcu_w: int,
+               mcu_h: int) -> List[Tuple[int, int, int, int]]:
+    """Pixel rectangles grown outward to the MCU grid, clipped to the frame and merged where they touch."""
+    gh, gw = -(-H // mcu_h), -(-W // mcu_w)
+    grid = np.zeros((gh, gw), bool)
+    for x1, y1, x2, y2 in rects:
+        x1, y1, x2, y2 = max(0, int(x1)), max(0, int(y1)), min(W, int(x2)), min(H, int(y2))
+        if x2 > x1 and y2 > y1:
+            grid[y1 // mcu_h:-(-y2 // mcu_h), x1 // mcu_w:-(-x2 // mcu_w)] = True
+    if not grid.any():
+        return []
+    return _grid_rects(grid, W, H, mcu_w, mcu_h)
+
+def _paste_blocks(dst: np.ndarray, src: np.ndarray, by: int, bx: int) -> None:
+    # Tiles on the right/bottom edge may carry padding blocks past the original's block grid.
+    th = min(src.shape[0], dst.shape[0] - by)
+    tw = min(src.shape[1], dst.shape[1] - bx)
+    dst[by:by + th, bx:bx + tw] = src[:th, :tw]
+
+def patch_jpeg(original_path: str, after_bgr: np.ndarray, output_path: str,
+               before_bgr: Optional[np.ndarray] = None,
+               rects: Optional[List[Tuple[int, int, int, int]]] = None) -> bool:
+    """
+    Write output_path as the JPEG at original_path with only the changed MCUs replaced.
+
+    The changed rectangles are cut from after_bgr on the MCU grid, encoded with the
+    original's quantization tables and sampling factors, and their DCT blocks are
+    copied over the original coefficients; every untouched block is carried over
+    bit-exact, so there is no generation loss outside the obfuscated area.
+
+    rects: the regions the obfuscator wrote (pixels, e.g. from dirty_mcu_rects on the
+    exact buffer). Without them the change is found by diffing after_bgr against
+    before_bgr, which only works when after_bgr was never re-encoded.
+
+    Returns False (and writes nothing) when the patch can't be made losslessly or isn't
+    worth it: jpeglib missing, progressive or non-YCbCr input, unsupported sampling, a
+    size mismatch, more than MAX_PATCH_FRACTION of the frame dirty, or the re-encoded
+    tiles not reproducing the original tables. Callers fall back to a full re-encode.
+    """
+    if not _HAS_JPEGLIB:
+        return False
+    if rects is None:
+        if before_bgr is None:
+            before_bgr = cv2.imread(original_path, cv2.IMREAD_COLOR)
+        if before_bgr is None or before_bgr.shape != after_bgr.shape:
+            return False
+
+    try:
+        im = jpeglib.read_dct(original_path)
+        if im.num_components != 3 or getattr(im, "progressive_mode", False):
+            return False
+        if (im.height, im.width) != after_bgr.shape[:2]:
+            return False
+        mcu = _mcu_size(im.samp_factor)
+        if mcu is None:
+            return False
+        mcu_w, mcu_h = mcu
+
+        if rects is None:
+            rects = dirty_mcu_rects(before_bgr, after_bgr, mcu_w, mcu_h)
+        else:
+            rects = snap_rects(rects, im.width, im.height, mcu_w, mcu_h)
+        if sum((x2 - x1) * (y2 - y1) for x1, y1, x2, y2 in rects) > MAX_PATCH_FRACTION * im.width * im.height:
+            return False
+        with tempfile.TemporaryDirectory() as tmp:
+            tile_path = os.path.join(tmp, "tile.jpg")
+            for x1, y1, x2, y2 in rects:
+                rgb = np.ascontiguousarray(cv2.cvtColor(after_bgr[y1:y2, x1:x2], cv2.COLOR_BGR2RGB))
+                spatial = jpeglib.from_spatial(rgb)
+                spatial.samp_factor = np.asarray(im.samp_factor)
+                spatial.write_spatial(tile_path, qt=im.qt, quant_tbl_no=im.quant_tbl_no)
+                tile = jpeglib.read_dct(tile_path)
+                if not np.array_equal(tile.qt, im.qt) or not np.array_equal(tile.samp_factor, im.samp_factor):
+                    return False
+
+                _paste_blocks(im.Y, tile.Y, y1 // 8, x1 // 8)
+                _paste_blocks(im.Cb, tile.Cb, y1 // mcu_h, x1 // mcu_w)
+                _paste_blocks(im.Cr, tile.Cr, y1 // mcu_h, x1 // mcu_w)
+
+        im.write_dct(output_path)
+        return True
+    except Exception as e:
+        print(f"JPEG patch failed, falling back to full encode: {e}")
+        return False
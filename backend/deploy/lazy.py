@@ -0,0 +1,48 @@
+// Copyright 2025 The NoPeek Authors. All rights reserved.
+// Licensed under the Apache License, Version 2.0 that can be found in the
+// LICENSE file in the root directory of this source tree.
+
+# lazy.py — deferred imports for heavy optional stacks (torch, PIL, paddleocr, ...)
+import importlib, importlib.util, threading
+from types import ModuleType
+
+
+class LazyModule:
+    """
+    Stand-in for a module that is imported on first attribute access, so importing the
+    script that holds it stays cheap (CLI --help, worker cold start). A missing package
+    raises ImportError at that first use instead of at import.
+    """
+
+    __slots__ = ("_name", "_module", "_lock")
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self) -> ModuleType:
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    def __repr__(self) -> str:
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module {self._name!r} ({state})>"
+
+
+def lazy_import(name: str) -> LazyModule:
+    """torch = lazy_import("torch"): the import happens on the first torch.<attr>."""
+    return LazyModule(name)
+
+def module_available(name: str) -> bool:
+    """Whether `name` is installed, without importing it (top-level package lookup only)."""
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
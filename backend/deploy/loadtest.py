@@ -0,0 +1,286 @@
+// Copyright 2025 The NoPeek Authors. All rights reserved.
+// Licensed under the Apache License, Version 2.0 that can be found in the
+// LICENSE file in the root directory of this source tree.
+
+# loadtest.py — replay a recorded request mix against the API and report throughput, latency and loop lag
+import argparse, asyncio, base64, glob, importlib.util, json, os, random, sys, time
+from typing import Dict, List, Tuple
+
+import numpy as np
+import httpx  # pip install -r requirements-dev.txt
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Default mix when no corpus is given: label -> (endpoint, body without image_data, weight).
+DEFAULT_MIX: Dict[str, Tuple[str, Dict, int]] = {
+    "upload": ("/upload", {"user_id": "loadtest"}, 2),
+    "blur": ("/process_image", {"type": "blur"}, 4),
+    "sticker": ("/process_image", {"type": "sticker"}, 3),
+    "doc": ("/process_doc", {"type": ["license_plate", "document_file"]}, 1),
+}
+
+
+# =========================
+# Corpus
+# =========================
+def make_corpus(images: List[str], mix: Dict[str, int]) -> List[Dict]:
+    """One entry per (image, request kind); weights repeat an entry in the replay order."""
+    corpus = []
+    for path in images:
+        for label, weight in mix.items():
+            endpoint, body, _ = DEFAULT_MIX[label]
+            corpus.append({"label": label, "endpoint": endpoint, "body": dict(body),
+                           "image": os.path.relpath(path, HERE), "weight": weight})
+    return corpus
+
+def load_corpus(path: str) -> List[Dict]:
+    """
+    JSONL, one request per line:
+      {"label": "blur", "endpoint": "/process_image", "body": {"type": "blur"},
+       "image": "imgs/x.jpg", "weight": 3}
+    "image" is read and sent as body["image_data"]; paths are relative to this directory.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip() and not line.startswith("//")]
+
+def _materialize(corpus: List[Dict], seed: int) -> List[Tuple[str, str, bytes]]:
+    """Expand weights, shuffle once with the seed and pre-serialize each body."""
+    encoded: Dict[str, str] = {}
+    plan = []
+    for entry in corpus:
+        img = entry.get("image", "")
+        if img and img not in encoded:
+            with open(os.path.join(HERE, img), "rb") as f:
+                encoded[img] = "data:image/jpeg;base64," + base64.b64encode(f.read()).decode("ascii")
+        body = dict(entry.get("body", {}))
+        if img:
+            body["image_data"] = encoded[img]
+        payload = json.dumps(body).encode("utf-8")
+        label = entry.get("label") or entry["endpoint"]
+        plan += [(label, entry["endpoint"], payload)] * max(1, int(entry.get("weight", 1)))
+    random.Random(seed).shuffle(plan)
+    return plan
+
+
+# =========================
+# Local stand-in backend
+# =========================
+def boot_local_app(db_url: str, stub_boxes: int):
+    """
+    Import test.py with SQLite and weight-free stub detectors. Must run before anything
+    else touches the database: the engine is created from DATABASE_URL on first use, and
+    the tables by the app's startup handler (see _run, which drives the lifespan).
+    """
+    os.environ["DATABASE_URL"] = db_url
+    # Inherited by the detect.py subprocesses the endpoints spawn.
+    os.environ["NOPEEK_STUB_DETECTORS"] = str(stub_boxes)
+    # The endpoints pass paths relative to the deploy directory.
+    os.chdir(HERE)
+    if HERE not in sys.path:
+        sys.path.insert(0, HERE)
+    spec = importlib.util.spec_from_file_location("nopeek_app", os.path.join(HERE, "test.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.app
+
+
+# =========================
+# Load generation
+# =========================
+def _is_error(resp: httpx.Response) -> bool:
+    if resp.status_code >= 400:
+        return True
+    try:
+        body = resp.json()
+    except ValueError:
+        return True
+    # Handlers report failures as ({"error": ...}, status), which FastAPI serializes as a list.
+    if isinstance(body, list):
+        body = body[0] if body else {}
+    return isinstance(body, dict) and "error" in body
+
+async def _loop_lag_monitor(samples: List[float], stop: asyncio.Event, interval: float = 0.01):
+    # A sleep that overshoots means something held the event loop.
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        t0 = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - t0 - interval))
+
+async def run_level(client: httpx.AsyncClient, plan: List[Tuple[str, str, bytes]], concurrency: int,
+                    n_requests: int, duration: float) -> Dict:
+    records: List[Tuple[str, float, bool]] = []
+    errors: Dict[str, int] = {}
+    lag: List[float] = []
+    stop = asyncio.Event()
+    next_idx = 0
+    deadline = time.perf_counter() + duration if duration > 0 else float("inf")
+
+    async def worker():
+        nonlocal next_idx
+        while time.perf_counter() < deadline and (duration > 0 or next_idx < n_requests):
+            label, endpoint, payload = plan[next_idx % len(plan)]
+            next_idx += 1
+            t0 = time.perf_counter()
+            try:
+                resp = await client.post(endpoint, content=payload, headers={"content-type": "application/json"})
+                failed = _is_error(resp)
+                if failed:
+                    errors[f"{label}: HTTP {resp.status_code}"] = errors.get(f"{label}: HTTP {resp.status_code}", 0) + 1
+            except httpx.HTTPError as e:
+                failed = True
+                errors[f"{label}: {type(e).__name__}"] = errors.get(f"{label}: {type(e).__name__}", 0) + 1
+            records.append((label, time.perf_counter() - t0, failed))
+
+    monitor = asyncio.create_task(_loop_lag_monitor(lag, stop))
+    t_start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - t_start
+    stop.set()
+    await monitor
+    return _summarize(concurrency, records, errors, lag, elapsed)
+
+def _percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {}
+    ms = np.asarray(values) * 1000.0
+    return {f"p{q}_ms": round(float(np.percentile(ms, q)), 1) for q in (50, 90, 95, 99)} | \
+           {"max_ms": round(float(ms.max()), 1)}
+
+def _summarize(concurrency: int, records, errors, lag, elapsed) -> Dict:
+    by_label: Dict[str, List[float]] = {}
+    for label, seconds, _ in records:
+        by_label.setdefault(label, []).append(seconds)
+    n = len(records)
+    n_err = sum(1 for r in records if r[2])
+    return {
+        "concurrency": concurrency,
+        "requests": n,
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(n / max(elapsed, 1e-9), 2),
+        "error_rate": round(n_err / max(n, 1), 4),
+        "errors": errors,
+        "latency": _percentiles([r[1] for r in records]),
+        "latency_by_label": {k: _percentiles(v) | {"requests": len(v)} for k, v in sorted(by_label.items())},
+        "loop_lag": _percentiles(lag),
+    }
+
+def _print_level(r: Dict):
+    lat, lag = r["latency"], r["loop_lag"]
+    print(f"c={r['concurrency']:<3} {r['requests']:>5} req  {r['throughput_rps']:>7.2f} req/s  "
+          f"p50 {lat.get('p50_ms', 0):>8.1f}  p95 {lat.get('p95_ms', 0):>8.1f}  p99 {lat.get('p99_ms', 0):>8.1f} ms  "
+          f"err {r['error_rate']:.1%}  loop lag p99 {lag.get('p99_ms', 0):.1f} / max {lag.get('max_ms', 0):.1f} ms")
+    for label, s in r["latency_by_label"].items():
+        print(f"      {label:<12} {s['requests']:>5}  p50 {s['p50_ms']:>8.1f}  p95 {s['p95_ms']:>8.1f} ms")
+
+def compare(levels: List[Dict], baseline: Dict, threshold: float) -> List[str]:
+    """Throughput drops or p95 growth beyond `threshold`, matched by concurrency level."""
+    base = {lv["concurrency"]: lv for lv in baseline.get("levels", [])}
+    out = []
+    for lv in levels:
+        b = base.get(lv["concurrency"])
+        if b is None:
+            continue
+        if b["throughput_rps"] and lv["throughput_rps"] < b["throughput_rps"] * (1.0 - threshold):
+            out.append(f"c={lv['concurrency']} throughput {b['throughput_rps']} -> {lv['throughput_rps']} req/s")
+        old, new = b["latency"].get("p95_ms"), lv["latency"].get("p95_ms")
+        if old and new and new > old * (1.0 + threshold):
+            out.append(f"c={lv['concurrency']} p95 {old} -> {new} ms")
+        if lv["error_rate"] > b["error_rate"]:
+            out.append(f"c={lv['concurrency']} error rate {b['error_rate']:.1%} -> {lv['error_rate']:.1%}")
+    return out
+
+async def _sweep(args, plan, transport, base_url) -> List[Dict]:
+    levels = []
+    async with httpx.AsyncClient(transport=transport, base_url=base_url, timeout=args.timeout) as client:
+        for c in args.concurrency:
+            if args.warmup:
+                await run_level(client, plan, c, args.warmup, 0)
+            r = await run_level(client, plan, c, args.requests, args.duration)
+            _print_level(r)
+            levels.append(r)
+    return levels
+
+async def _run(args, plan) -> List[Dict]:
+    if args.url:
+        return await _sweep(args, plan, None, args.url.rstrip("/"))
+    app = boot_local_app(args.db, args.stub_boxes)
+    # ASGITransport doesn't send lifespan events; run startup/shutdown (schema creation) ourselves.
+    async with app.router.lifespan_context(app):
+        return await _sweep(args, plan, httpx.ASGITransport(app=app), "http://nopeek.local")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Load-test the API against a live server or an in-process stand-in (SQLite + stub detectors).")
+    ap.add_argument("--corpus", default="", help="JSONL request corpus (default: built from --images with the default mix)")
+    ap.add_argument("--images", default="imgs", help="Image directory for the default corpus")
+    ap.add_argument("--mix", default=",".join(f"{k}={v[2]}" for k, v in DEFAULT_MIX.items()),
+                    help="Default-corpus weights, e.g. upload=2,blur=4,sticker=3,doc=1")
+    ap.add_argument("--make-corpus", default="", help="Write the default corpus to this JSONL path and exit")
+    ap.add_argument("-c", "--concurrency", default="1,4,8", help="Comma-separated concurrency levels to sweep")
+    ap.add_argument("-n", "--requests", type=int, default=40, help="Requests per level")
+    ap.add_argument("-d", "--duration", type=float, default=0.0, help="Seconds per level (overrides -n)")
+    ap.add_argument("--warmup", type=int, default=2, help="Unrecorded requests before each level")
+    ap.add_argument("--url", default="", help="Target a running server instead of the in-process app")
+    ap.add_argument("--db", default="sqlite://", help="Database URL for the in-process app")
+    ap.add_argument("--stub-boxes", type=int, default=3, help="Boxes returned by the stub detectors")
+    ap.add_argument("--timeout", type=float, default=300.0, help="Per-request timeout (s)")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("-o", "--output", default="results/loadtest.json", help="Results JSON path")
+    ap.add_argument("--compare", default="", help="Baseline results JSON; exit 1 on regressions")
+    ap.add_argument("--threshold", type=float, default=0.2, help="Allowed throughput drop / p95 growth")
+    args = ap.parse_args()
+    args.concurrency = [int(v) for v in args.concurrency.split(",") if v.strip()]
+    # boot_local_app() changes directory; resolve the output path against the caller's cwd first.
+    out_path = os.path.abspath(args.output)
+
+    if args.corpus:
+        corpus = load_corpus(args.corpus)
+    else:
+        mix = {k: int(v) for k, v in (kv.split("=") for kv in args.mix.split(",") if kv.strip())}
+        unknown = [k for k in mix if k not in DEFAULT_MIX]
+        if unknown:
+            ap.error(f"unknown request kinds in --mix: {', '.join(unknown)}")
+        images = sorted(glob.glob(os.path.join(HERE, args.images, "*.jpg")))
+        corpus = make_corpus(images, mix)
+    if args.make_corpus:
+        with open(args.make_corpus, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(e) + "\n" for e in corpus)
+        print(f"Done. Wrote {len(corpus)} entries to {args.make_corpus}")
+        return
+    if not corpus:
+        ap.error("empty corpus")
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    plan = _materialize(corpus, args.seed)
+    levels = asyncio.run(_run(args, plan))
+
+    results = {
+        "meta": {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"), "target": args.url or "in-process",
+                 "db": "" if args.url else args.db, "stub_boxes": None if args.url else args.stub_boxes,
+                 "corpus": args.corpus or f"{args.images} ({args.mix})", "seed": args.seed,
+                 # In-process the app shares the loop, so lag includes handler work that blocks it.
+                 "loop_lag_scope": "client" if args.url else "app"},
+        "levels": levels,
+    }
+    if baseline is not None:
+        results["regressions"] = compare(levels, baseline, args.threshold)
+
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    with open(out_path, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Done. Wrote {out_path}")
+
+    if baseline is not None:
+        for r in results["regressions"]:
+            print(f"REGRESSION {r}")
+        if results["regressions"]:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
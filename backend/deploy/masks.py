@@ -0,0 +1,92 @@
+// Copyright 2025 The NoPeek Authors. All rights reserved.
+// Licensed under the Apache License, Version 2.0 that can be found in the
+// LICENSE file in the root directory of this source tree.
+
+# masks.py — feathered ellipse / rectangle masks, rendered once per size into cached tiles
+from functools import lru_cache
+from typing import Tuple
+
+import cv2
+import numpy as np
+
+# A feathered shape depends only on its size and feather, not on where it sits, so it is
+# drawn and blurred once per (size, feather) on a tile just big enough to hold the feather
+# and then stamped into the frame. Building a mask costs O(shapes x box), not O(shapes x frame).
+# Detected and tracked boxes rarely repeat an exact size, so sizes above TILE_EXACT_MAX are
+# rounded to a TILE_QUANTUM grid for the cache and the cached tile is resized to the exact
+# size when stamped (a resize is far cheaper than the large-kernel blur it replaces).
+TILE_CACHE_SIZE = 256
+TILE_QUANTUM = 8
+TILE_EXACT_MAX = 32
+
+
+def _odd(n: int) -> int:
+    return n if n % 2 == 1 else n + 1
+
+def _pad(k: int) -> int:
+    # The kernel's reach plus one, so the tile's reflected border only ever sees zeros.
+    return k // 2 + 1 if k > 1 else 0
+
+def _quantize(n: int) -> int:
+    return n if n <= TILE_EXACT_MAX else int(round(n / TILE_QUANTUM)) * TILE_QUANTUM
+
+def _fit(tile: np.ndarray, h: int, w: int, k: int) -> np.ndarray:
+    """The cached tile resized to h x w (nearest for hard masks, so they stay binary)."""
+    if tile.shape[:2] == (h, w):
+        return tile
+    return cv2.resize(tile, (w, h), interpolation=cv2.INTER_LINEAR if k > 1 else cv2.INTER_NEAREST)
+
+@lru_cache(maxsize=TILE_CACHE_SIZE)
+def ellipse_tile(rx: int, ry: int, k: int) -> np.ndarray:
+    """Filled ellipse with semi-axes (rx, ry), Gaussian-feathered with a k x k kernel (k odd, 0 = hard)."""
+    p = _pad(k)
+    tile = np.zeros((2 * (ry + p) + 1, 2 * (rx + p) + 1), np.uint8)
+    cv2.ellipse(tile, (rx + p, ry + p), (rx, ry), 0, 0, 360, 255, -1)
+    if k > 1:
+        tile = cv2.GaussianBlur(tile, (k, k), 0)
+    tile.flags.writeable = False
+    return tile
+
+@lru_cache(maxsize=TILE_CACHE_SIZE)
+def rect_tile(w: int, h: int, k: int) -> np.ndarray:
+    """Filled w x h rectangle, Gaussian-feathered with a k x k kernel (k odd, 0 = hard)."""
+    p = _pad(k)
+    tile = np.zeros((h + 2 * p, w + 2 * p), np.uint8)
+    tile[p:p + h, p:p + w] = 255
+    if k > 1:
+        tile = cv2.GaussianBlur(tile, (k, k), 0)
+    tile.flags.writeable = False
+    return tile
+
+
+def stamp(dst: np.ndarray, tile: np.ndarray, x: int, y: int) -> None:
+    """dst = max(dst, tile) with the tile's top-left at (x, y), clipped to dst; in place."""
+    H, W = dst.shape[:2]
+    th, tw = tile.shape[:2]
+    x0, y0, x1, y1 = max(0, x), max(0, y), min(W, x + tw), min(H, y + th)
+    if x0 >= x1 or y0 >= y1:
+        return
+    roi = dst[y0:y1, x0:x1]
+    np.maximum(roi, tile[y0 - y:y1 - y, x0 - x:x1 - x], out=roi)
+
+def stamp_ellipse(dst: np.ndarray, center: Tuple[int, int], axes: Tuple[int, int], feather: int) -> None:
+    """
+    cv2.ellipse(filled) then a feather x feather Gaussian, max-ed into dst; pixel-exact up to
+    TILE_EXACT_MAX semi-axes, from a resized quantized tile above.
+    """
+    k = _odd(feather) if feather > 0 else 0
+    (cx, cy), (rx, ry) = center, (int(axes[0]), int(axes[1]))
+    p = _pad(k)
+    tile = _fit(ellipse_tile(_quantize(rx), _quantize(ry), k), 2 * (ry + p) + 1, 2 * (rx + p) + 1, k)
+    stamp(dst, tile, int(cx) - rx - p, int(cy) - ry - p)
+
+def stamp_rect(dst: np.ndarray, x1: int, y1: int, x2: int, y2: int, feather: int) -> None:
+    """
+    cv2.rectangle((x1, y1), (x2, y2), filled; corners inclusive) then a feather x feather Gaussian;
+    pixel-exact up to TILE_EXACT_MAX sides, from a resized quantized tile above.
+    """
+    k = _odd(feather) if feather > 0 else 0
+    p = _pad(k)
+    w, h = x2 - x1 + 1, y2 - y1 + 1
+    tile = _fit(rect_tile(_quantize(w), _quantize(h), k), h + 2 * p, w + 2 * p, k)
+    stamp(dst, tile, x1 - p, y1 - p)
@@ -0,0 +1,145 @@
+// Copyright 2025 The NoPeek Authors. All rights reserved.
+// Licensed under the Apache License, Version 2.0 that can be found in the
+// LICENSE file in the root directory of this source tree.
+
+# metrics.py — per-stage timing spans, Prometheus text exposition and Server-Timing headers
+import atexit, contextvars, os, re, sys, threading, time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Latency buckets (seconds) cover base64 decodes (~ms) up to cartoon generation (minutes).
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+class Histogram:
+    """Cumulative-bucket histogram, Prometheus style. Thread-safe."""
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.total = 0.0
+        self.n = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self.counts[bisect_left(self.buckets, value)] += 1
+            self.total += value
+            self.n += 1
+
+    def snapshot(self) -> Tuple[List[int], float, int]:
+        with self._lock:
+            return list(self.counts), self.total, self.n
+
+
+_LOCK = threading.Lock()
+_STAGES: Dict[str, Histogram] = {}
+_COUNTERS: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+
+# Spans finished during the current request, as (stage, seconds); None outside a request.
+_REQUEST_SPANS: contextvars.ContextVar[Optional[List[Tuple[str, float]]]] = \
+    contextvars.ContextVar("nopeek_request_spans", default=None)
+
+
+def _stage(name: str) -> Histogram:
+    h = _STAGES.get(name)
+    if h is None:
+        with _LOCK:
+            h = _STAGES.setdefault(name, Histogram())
+    return h
+
+def observe(stage: str, seconds: float) -> None:
+    _stage(stage).observe(seconds)
+    spans = _REQUEST_SPANS.get()
+    if spans is not None:
+        spans.append((stage, seconds))
+
+def inc(name: str, value: float = 1.0, **labels: str) -> None:
+    key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+    with _LOCK:
+        _COUNTERS[key] = _COUNTERS.get(key, 0.0) + value
+
+@contextmanager
+def span(stage: str) -> Iterator[None]:
+    """
+    Time a block as `stage`:
+        with span("detect.face"):
+            dets = detect_faces(bgr)
+    Failures are counted in nopeek_stage_errors_total and re-raised.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        inc("nopeek_stage_errors_total", stage=stage)
+        raise
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+# =========================
+# Per-request collection
+# =========================
+def begin_request() -> contextvars.Token:
+    return _REQUEST_SPANS.set([])
+
+def request_spans() -> List[Tuple[str, float]]:
+    return list(_REQUEST_SPANS.get() or [])
+
+def end_request(token: contextvars.Token) -> None:
+    _REQUEST_SPANS.reset(token)
+
+_TOKEN_UNSAFE = re.compile(r"[^A-Za-z0-9_-]")
+
+def server_timing(spans: Sequence[Tuple[str, float]]) -> str:
+    """Format spans as a Server-Timing header value (durations in ms; repeated stages are summed)."""
+    totals: Dict[str, float] = {}
+    for stage, seconds in spans:
+        totals[stage] = totals.get(stage, 0.0) + seconds
+    return ", ".join(f"{_TOKEN_UNSAFE.sub('_', stage)};dur={seconds * 1000.0:.1f}" for stage, seconds in totals.items())
+
+
+# =========================
+# Exposition
+# =========================
+def _fmt(v: float) -> str:
+    return "+Inf" if v == float("inf") else repr(float(v))
+
+def render_prometheus() -> str:
+    """Render all metrics in the Prometheus text exposition format (version 0.0.4)."""
+    lines = ["# HELP nopeek_stage_seconds Time spent per pipeline stage.",
+             "# TYPE nopeek_stage_seconds histogram"]
+    for stage, h in sorted(_STAGES.items()):
+        counts, total, n = h.snapshot()
+        cum = 0
+        for le, c in zip(h.buckets + (float("inf"),), counts):
+            cum += c
+            lines.append(f'nopeek_stage_seconds_bucket{{stage="{stage}",le="{_fmt(le)}"}} {cum}')
+        lines.append(f'nopeek_stage_seconds_sum{{stage="{stage}"}} {total!r}')
+        lines.append(f'nopeek_stage_seconds_count{{stage="{stage}"}} {n}')
+
+    with _LOCK:
+        counters = sorted(_COUNTERS.items())
+    seen = set()
+    for (name, labels), value in counters:
+        if name not in seen:
+            lines.append(f"# TYPE {name} counter")
+            seen.add(name)
+        label_str = ",".join(f'{k}="{v}"' for k, v in labels)
+        lines.append(f"{name}{{{label_str}}} {value!r}" if label_str else f"{name} {value!r}")
+    return "\n".join(lines) + "\n"
+
+def print_report(file=sys.stderr) -> None:
+    """Human-readable per-stage summary, used by the CLIs when NOPEEK_TIMING=1."""
+    if not _STAGES:
+        return
+    print("stage                          calls    total(s)    mean(ms)", file=file)
+    for stage, h in sorted(_STAGES.items()):
+        _, total, n = h.snapshot()
+        print(f"{stage:<30} {n:>5} {total:>11.3f} {total / max(n, 1) * 1000.0:>11.1f}", file=file)
+
+
+if os.getenv("NOPEEK_TIMING"):
+    atexit.register(print_report)
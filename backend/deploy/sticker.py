@@ -2,12 +2,16 @@
 // Licensed under the Apache License, Version 2.0 that can be found in the
 // LICENSE file in the root directory of this source tree.
 
-import os, glob, random, json
+import os, glob, hashlib, json
 import cv2
 import numpy as np
 import argparse
 from typing import List, Dict, Tuple, Optional
 
+from blur import output_buffer
+from detections import load_detections
+from metrics import span
+
 
 def _denorm_xyxy(b, W: int, H: int) -> Tuple[int, int, int, int]:
     x1 = int(round(float(b[0]) * W)); y1 = int(round(float(b[1]) * H))
@@ -27,26 +31,46 @@ def _expand_bbox(x1, y1, x2, y2, W, H, pct=0.15, what="expanded bbox"):
     _assert_in_bounds(ex1, ey1, ex2, ey2, W, H, what)
     return ex1, ey1, ex2, ey2
 
-def _load_detections(json_path: str) -> List[Dict]:
+def face_sticker_pool(stickers_dir: str = "stickers", gender: str = "") -> List[str]:
+    """Sorted sticker file names for a gender; all face stickers if the gender is unknown."""
+    male   = sorted(os.path.basename(p) for p in glob.glob(os.path.join(stickers_dir, "vecteezy_male_*.png")))
+    female = sorted(os.path.basename(p) for p in glob.glob(os.path.join(stickers_dir, "vecteezy_female_*.png")))
+    g = (gender or "").strip().lower()
+    if g == "male" and male:
+        return male
+    if g == "female" and female:
+        return female
+    return male + female
+
+def _seed_from_dets(dets: List[Dict]) -> str:
+    boxes = [[round(float(v), 5) for v in d["bbox_xyxy"]] for d in dets]
+    return hashlib.blake2b(json.dumps(boxes).encode("utf-8"), digest_size=8).hexdigest()
+
+def assign_face_stickers(dets: List[Dict], stickers_dir: str = "stickers", seed: Optional[str] = None) -> List[Optional[str]]:
     """
-    Load detections from a JSON file.
-    Expected format: a list of dicts, each with 'bbox_xyxy' (normalized xyxy).
-    Other keys like 'confidence' or 'attributes' are ignored by this script.
+    Sticker file name for each face, deterministic in (seed, face index): face i gets
+    pool[blake2b(f"{seed}:{i}") % len(pool)] from its gendered pool. A det that already
+    carries a valid "sticker" keeps it, so a returned assignment can be replayed exactly.
+    seed defaults to a hash of the boxes; the API passes the image content hash.
+    None marks a face with no sticker available.
     """
-    with open(json_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    if not isinstance(data, list):
-        raise ValueError("Detections JSON must be a list of objects.")
-    out = []
-    for d in data:
-        if isinstance(d, dict) and "bbox_xyxy" in d:
-            bb = d["bbox_xyxy"]
-            if isinstance(bb, (list, tuple)) and len(bb) == 4:
-                # keep attributes if present (e.g., gender)
-                attrs = d.get("attributes", {}) if isinstance(d.get("attributes", {}), dict) else {}
-                out.append({"bbox_xyxy": bb, "attributes": attrs})
-    return out
-
+    if seed is None:
+        seed = _seed_from_dets(dets)
+    names: List[Optional[str]] = []
+    for i, d in enumerate(dets):
+        gender = ""
+        if isinstance(d, dict) and isinstance(d.get("attributes", None), dict):
+            gender = d["attributes"].get("gender", "") or ""
+        pool = face_sticker_pool(stickers_dir, gender)
+        fixed = d.get("sticker") if isinstance(d, dict) else None
+        if fixed and os.path.basename(fixed) == fixed and os.path.exists(os.path.join(stickers_dir, fixed)):
+            names.append(fixed)
+        elif pool:
+            h = int.from_bytes(hashlib.blake2b(f"{seed}:{i}".encode("utf-8"), digest_size=8).digest(), "big")
+            names.append(pool[h % len(pool)])
+        else:
+            names.append(None)
+    return names
 
 def place_face_stickers(
     bgr: np.ndarray,
@@ -55,7 +79,10 @@ def place_face_stickers(
     *,
     expand_pct: float = 0.15,     # grow bbox a bit so sticker fully covers face
     fit_mode: str = "cover",      # "cover" fits the smaller dimension, may crop; "contain" fits inside
-    max_aspect_stretch: float = 1.3
+    max_aspect_stretch: float = 1.3,
+    seed: Optional[str] = None,
+    out: Optional[np.ndarray] = None,
+    inplace: bool = False
 ) -> np.ndarray:
     """
     Overlay gendered transparent PNG stickers on detected faces.
@@ -66,33 +93,23 @@ def place_face_stickers(
               optional gender string at d["attributes"].get("gender", "") in {"male","female"}
 
     Behavior:
-      - Picks a random sticker per face from stickers_dir/vecteezy_male_*.png or vecteezy_female_*.png
+      - Picks a sticker per face from stickers_dir/vecteezy_male_*.png or vecteezy_female_*.png
+        via assign_face_stickers(dets, stickers_dir, seed), so the same input gives the same bytes
       - Expands the bbox by expand_pct
       - Resizes sticker to (roughly) cover the expanded bbox while preserving transparency
       - Alpha-blends onto the image, safely handling edges/out-of-bounds
+      - Writes into `out`, or into bgr itself when inplace, instead of a copy
 
     Returns:
-      - New image with stickers applied (uint8 BGR)
+      - Image with stickers applied (uint8 BGR)
     """
     if not dets:
-        return bgr
+        return bgr if out is None else output_buffer(bgr, out)
 
     H, W = bgr.shape[:2]
-    out = bgr.copy()
-
-    # Cache sticker file lists by gender
-    male_paths   = sorted(glob.glob(os.path.join(stickers_dir, "vecteezy_male_*.png")))
-    female_paths = sorted(glob.glob(os.path.join(stickers_dir, "vecteezy_female_*.png")))
-    all_paths = (male_paths or []) + (female_paths or [])
-
-    def _pick_path(gender: str) -> Optional[str]:
-        g = (gender or "").strip().lower()
-        if g == "male" and male_paths:
-            return random.choice(male_paths)
-        if g == "female" and female_paths:
-            return random.choice(female_paths)
-        # Fallback: pick from whichever exists
-        return random.choice(all_paths) if all_paths else None
+    out = output_buffer(bgr, out, inplace)
+
+    names = assign_face_stickers(dets, stickers_dir, seed)
 
     def _overlay_bgra(dst: np.ndarray, sticker_bgra: np.ndarray, x: int, y: int) -> None:
         """
@@ -129,15 +146,11 @@ def place_face_stickers(
             # No alpha channel—just paste
             roi_dst[:] = roi_src
 
-    for d in dets:
-        # Resolve gender and pick a sticker
-        gender = ""
-        if isinstance(d, dict) and isinstance(d.get("attributes", None), dict):
-            gender = d["attributes"].get("gender", "") or ""
-        sticker_path = _pick_path(gender)
-        if not sticker_path:
+    for d, name in zip(dets, names):
+        if not name:
             # No stickers available; skip gracefully
             continue
+        sticker_path = os.path.join(stickers_dir, name)
 
         # Load sticker with alpha
         sticker = cv2.imread(sticker_path, cv2.IMREAD_UNCHANGED)
@@ -189,12 +202,16 @@ def place_face_stickers(
     return out
 
 
-def place_plate_stickers(bgr: np.ndarray, dets: List[Dict], sticker_path="stickers/vecteezy_plate.png", expand_pct=0.15) -> np.ndarray:
+def place_plate_stickers(bgr: np.ndarray, dets: List[Dict], sticker_path="stickers/vecteezy_plate.png", expand_pct=0.15,
+                         *, out: Optional[np.ndarray] = None, inplace: bool = False) -> np.ndarray:
     """
     Overlay a fixed transparent PNG sticker on each detected plate.
+    Writes into `out`, or into bgr itself when inplace, instead of a copy.
     """
+    if not dets:
+        return bgr if out is None else output_buffer(bgr, out)
     H, W = bgr.shape[:2]
-    out = bgr.copy()
+    out = output_buffer(bgr, out, inplace)
 
     sticker = cv2.imread(sticker_path, cv2.IMREAD_UNCHANGED)
     if sticker is None:
@@ -254,28 +271,29 @@ def main():
     ap.add_argument("-j", "--json", required=True, help="Path to detections JSON (list of {bbox_xyxy:[x1,y1,x2,y2], ...})")
     ap.add_argument("-o", "--output", default=None, help="Output image path")
     ap.add_argument("-t", "--target", choices=["face", "plate"], default="face")
+    ap.add_argument("--seed", default=None, help="Face sticker selection seed (default: hash of the boxes)")
     args = ap.parse_args()
 
-    bgr = cv2.imread(args.input)
+    with span("image.decode"):
+        bgr = cv2.imread(args.input)
     if bgr is None:
         raise FileNotFoundError(args.input)
 
-    dets = _load_detections(args.json)
+    dets = load_detections(args.json)
 
-    if args.target == "face":
-        # Slightly bigger (as requested earlier): 0.25 expansion
-        out = place_face_stickers(bgr, dets, stickers_dir="stickers", expand_pct=0.25)
-        suffix = "_face_sticker.jpg"
-        if not dets:
-            print("No face boxes in JSON — output will equal input.")
-    else:
-        out = place_plate_stickers(bgr, dets, sticker_path="stickers/vecteezy_plate.png", expand_pct=0.15)
-        suffix = "_plate_sticker.jpg"
-        if not dets:
-            print("No plate boxes in JSON — output will equal input.")
+    with span(f"obfuscate.sticker_{args.target}"):
+        if args.target == "face":
+            # Slightly bigger (as requested earlier): 0.25 expansion
+            out = place_face_stickers(bgr, dets, stickers_dir="stickers", expand_pct=0.25, seed=args.seed)
+        else:
+            out = place_plate_stickers(bgr, dets, sticker_path="stickers/vecteezy_plate.png", expand_pct=0.15)
+    suffix = f"_{args.target}_sticker.jpg"
+    if not dets:
+        print(f"No {args.target} boxes in JSON — output will equal input.")
 
     out_path = args.output or os.path.splitext(args.input)[0] + suffix
-    cv2.imwrite(out_path, out)
+    with span("image.encode"):
+        cv2.imwrite(out_path, out)
     print(f"Done. Wrote: {out_path}")
 
 
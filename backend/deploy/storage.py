@@ -0,0 +1,178 @@
+// Copyright 2025 The NoPeek Authors. All rights reserved.
+// Licensed under the Apache License, Version 2.0 that can be found in the
+// LICENSE file in the root directory of this source tree.
+
+# storage.py — content-addressed upload store with atomic writes and a TTL / size-budget sweeper
+import asyncio, hashlib, os, tempfile, time, uuid
+from typing import Iterator, List, Optional, Tuple
+
+# Layout under the store root:
+#   objects/ab/cd/<digest>.<ext>         uploaded images, one file per distinct content
+#   objects/ab/cd/<digest>.<name>        results derived from that content (e.g. detections)
+#   scratch/<uuid>_<name>                per-request intermediates, removed when the request ends
+#   posts/ab/cd/<digest>.<ext>           images referenced by the posts table (never swept)
+_SWEPT = ("objects", "scratch")
+_TMP_PREFIX = ".tmp-"
+
+# Magic bytes of formats that are kept as uploaded; anything else is re-encoded by the caller.
+_MAGIC = ((b"\xff\xd8\xff", ".jpg"), (b"\x89PNG\r\n\x1a\n", ".png"), (b"RIFF", ".webp"))
+_MIME = {".jpg": "image/jpeg", ".png": "image/png", ".webp": "image/webp"}
+
+
+def content_hash(data: bytes) -> str:
+    # blake2b is several times faster than sha256 in CPython; 128 bits is plenty for dedup.
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def sniff_suffix(data: bytes) -> str:
+    """File extension for formats stored verbatim, or "" if the bytes should be re-encoded."""
+    for magic, suffix in _MAGIC:
+        if data.startswith(magic) and (suffix != ".webp" or data[8:12] == b"WEBP"):
+            return suffix
+    return ""
+
+def mime_type(path: str) -> str:
+    """MIME type of a stored image, from the suffix put() gave it (always one of the sniffed formats)."""
+    return _MIME.get(os.path.splitext(path)[1].lower(), "application/octet-stream")
+
+def atomic_write(path: str, data: bytes) -> None:
+    """Write via a temp file in the same directory plus rename, so readers never see a partial file."""
+    d = os.path.dirname(path)
+    os.makedirs(d, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=_TMP_PREFIX, dir=d)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+class UploadStore:
+    """
+    Uploads keyed by content hash: re-uploading the same photo reuses the stored file and
+    every result derived from it. objects/ and scratch/ are kept within ttl_s and
+    max_bytes by sweep(), least recently used first (a hit refreshes the mtime).
+    """
+
+    def __init__(self, root: str, ttl_s: float = 24 * 3600, max_bytes: int = 2 << 30,
+                 scratch_ttl_s: float = 3600):
+        self.root = root
+        self.ttl_s = ttl_s
+        self.max_bytes = max_bytes
+        self.scratch_ttl_s = scratch_ttl_s
+        for ns in _SWEPT + ("posts",):
+            os.makedirs(os.path.join(root, ns), exist_ok=True)
+
+    # ---- paths ----
+    def _sharded(self, ns: str, digest: str, suffix: str) -> str:
+        return os.path.join(self.root, ns, digest[:2], digest[2:4], digest + suffix)
+
+    def object_path(self, digest: str, suffix: str) -> str:
+        return self._sharded("objects", digest, suffix)
+
+    @staticmethod
+    def digest(object_path: str) -> str:
+        """Content hash of a stored object, from its file name."""
+        return os.path.basename(object_path).split(".", 1)[0]
+
+    def derived_path(self, object_path: str, name: str) -> str:
+        """Path for a result derived from a stored object, e.g. derived_path(p, "face.json")."""
+        return os.path.splitext(object_path)[0] + "." + name
+
+    def scratch_path(self, name: str) -> str:
+        return os.path.join(self.root, "scratch", f"{uuid.uuid4().hex}_{name}")
+
+    # ---- writes ----
+    def put(self, data: bytes, suffix: str, digest: str = "", namespace: str = "objects") -> Tuple[str, bool]:
+        """
+        Store data and return (path, created). If the content is already stored, nothing is
+        written and created is False. digest defaults to content_hash(data); callers that
+        re-encode an upload pass the hash of the original bytes so repeats still match.
+        """
+        path = self._sharded(namespace, digest or content_hash(data), suffix)
+        if os.path.exists(path):
+            self.touch(path)
+            return path, False
+        atomic_write(path, data)
+        return path, True
+
+    def touch(self, path: str) -> None:
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def discard(self, *paths: Optional[str]) -> None:
+        for p in paths:
+            if p:
+                try:
+                    os.remove(p)
+                except FileNotFoundError:
+                    pass
+
+    # ---- lifecycle ----
+    def _files(self) -> Iterator[Tuple[str, float, int, str]]:
+        for ns in _SWEPT:
+            for dirpath, _, names in os.walk(os.path.join(self.root, ns)):
+                for name in names:
+                    p = os.path.join(dirpath, name)
+                    try:
+                        st = os.stat(p)
+                    except FileNotFoundError:
+                        continue
+                    yield p, st.st_mtime, st.st_size, ns
+
+    def sweep(self, now: Optional[float] = None) -> Tuple[int, int]:
+        """
+        Remove expired files, then the least recently used ones until the store fits in
+        max_bytes. Returns (files_removed, bytes_removed).
+        """
+        now = time.time() if now is None else now
+        kept: List[Tuple[float, int, str]] = []
+        removed = freed = 0
+        for path, mtime, size, ns in self._files():
+            ttl = self.scratch_ttl_s if ns == "scratch" or os.path.basename(path).startswith(_TMP_PREFIX) else self.ttl_s
+            if now - mtime > ttl:
+                self.discard(path)
+                removed += 1
+                freed += size
+            else:
+                kept.append((mtime, size, path))
+
+        total = sum(size for _, size, _ in kept)
+        if total > self.max_bytes:
+            for mtime, size, path in sorted(kept):
+                # Leave in-flight files alone; they belong to requests still running.
+                if now - mtime < 60:
+                    continue
+                self.discard(path)
+                removed += 1
+                freed += size
+                total -= size
+                if total <= self.max_bytes:
+                    break
+
+        # Drop shard directories emptied by the sweep.
+        for ns in _SWEPT:
+            for dirpath, dirnames, filenames in os.walk(os.path.join(self.root, ns), topdown=False):
+                if not dirnames and not filenames and dirpath != os.path.join(self.root, ns):
+                    try:
+                        os.rmdir(dirpath)
+                    except OSError:
+                        pass
+        return removed, freed
+
+    async def sweep_forever(self, interval_s: float = 300.0) -> None:
+        """Background task: sweep every interval_s seconds off the event loop."""
+        while True:
+            try:
+                removed, freed = await asyncio.to_thread(self.sweep)
+                if removed:
+                    print(f"Upload store sweep: removed {removed} files ({freed / 2**20:.1f} MB)")
+            except Exception as e:
+                print(f"Upload store sweep failed: {e}")
+            await asyncio.sleep(interval_s)
@@ -2,131 +2,307 @@
 // Licensed under the Apache License, Version 2.0 that can be found in the
 // LICENSE file in the root directory of this source tree.
 
-from fastapi import FastAPI, UploadFile, File, Depends, Body
-from sqlalchemy import create_engine, Column, String, Text, DateTime, Integer, ForeignKey
-from sqlalchemy.orm import sessionmaker, declarative_base, relationship, Session
-from datetime import datetime
+from fastapi import FastAPI, UploadFile, File, Depends, Body, Request
+from sqlalchemy.ext.asyncio import AsyncSession
+import json
 import uuid
 import os
-from PIL import Image
-import io
+import time
 from dotenv import load_dotenv
 import subprocess
-import time
+import asyncio
 import base64
-import json
 import cv2
 import numpy as np
 
+from blur_doc import document_gate_score
+from cache import ALGORITHM_VERSIONS, ResultCache, detections_hash, result_key
+from compositor import SUPPORTED, composite
+from db import create_post, dispose_db, get_session, init_db
+from detections import Detections, response_view, save_detections
+from encode import EncodeOptions, encode_data_url, encode_data_url_async, encode_image_async, negotiate_format, to_data_url
+from gating import gate_enabled, gate_threshold, record_gate, should_run
+from inpaint import ENGINES, resolve_engine
+from jpeg_patch import dirty_mcu_rects, patch_jpeg
+import metrics
+from metrics import span
+from sticker import assign_face_stickers
+from storage import UploadStore, content_hash, mime_type, sniff_suffix
+from workers import WorkerPool
+
 # -------------------- 初始化 --------------------
-from starlette.responses import JSONResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse, PlainTextResponse
 
 load_dotenv()
 app = FastAPI()
 
 UPLOAD_DIR = "uploads"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
-
-# -------------------- 数据库配置 --------------------
-SQLALCHEMY_DATABASE_URL = (
-    f"mysql+pymysql://{os.getenv('DB_USER')}:{os.getenv('DB_PASSWORD')}"
-    f"@{os.getenv('DB_HOST')}:{os.getenv('DB_PORT')}/{os.getenv('DB_NAME')}"
+STICKERS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stickers")
+# 上传图像按内容哈希存储：同一张图重复上传共用文件与检测结果；后台按 TTL 与总大小上限清理
+STORE = UploadStore(
+    UPLOAD_DIR,
+    ttl_s=float(os.getenv("UPLOAD_TTL_S", 24 * 3600)),
+    max_bytes=int(os.getenv("UPLOAD_MAX_BYTES", 2 << 30)),
 )
-
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
-
-# -------------------- 数据库模型 --------------------
-class Post(Base):
-    __tablename__ = "posts"
-
-    id = Column(Integer, primary_key=True, index=True)
-    post_id = Column(String(36), unique=True, index=True)
-    caption = Column(Text, nullable=True)
-    user_id = Column(String(100), nullable=False)
-    created_at = Column(DateTime, default=datetime.utcnow)
-
-    images = relationship("PostImage", back_populates="post", cascade="all, delete-orphan")
-
-class PostImage(Base):
-    __tablename__ = "post_images"
-
-    id = Column(Integer, primary_key=True, index=True)
-    image_id = Column(String(36), unique=True, index=True)
-    post_id = Column(String(36), ForeignKey("posts.post_id"))
-    image_url = Column(String(500), nullable=False)
-    file_size = Column(Integer, nullable=False)
-    mime_type = Column(String(100), nullable=False)
-    width = Column(Integer, nullable=False)
-    height = Column(Integer, nullable=False)
-    sort_order = Column(Integer, default=0)
-
-    post = relationship("Post", back_populates="images")
-
-Base.metadata.create_all(bind=engine)
-
-# -------------------- 工具函数 --------------------
-def get_db():
-    db = SessionLocal()
+# 处理结果缓存：内存层按字节数 LRU 淘汰，磁盘层放在上传存储中（同样受 TTL 与总大小限制）
+RESULTS = ResultCache(STORE, max_memory_bytes=int(os.getenv("RESULT_CACHE_MEMORY_BYTES", 256 << 20)))
+
+# 常驻模型的工作进程池：NOPEEK_WORKERS>0 时检测与合成在工作进程中进行（每个进程绑定各自的 CPU 核，
+# 图像经共享内存传递），API 进程只做 I/O；为 0（默认）时仍走子进程脚本
+POOL = WorkerPool(int(os.getenv("NOPEEK_WORKERS", 0)), int(os.getenv("NOPEEK_WORKER_THREADS", 0)))
+
+# 是否默认在响应中返回 Server-Timing 头（也可由客户端通过 X-Server-Timing: 1 单独开启）
+SERVER_TIMING = os.getenv("SERVER_TIMING", "") in ("1", "true")
+
+# -------------------- 耗时统计 --------------------
+def _request_stage(request: Request) -> str:
+    """
+    请求整体耗时的指标名：按匹配到的路由取第一段路径（如 /process_result/{job_id} 记为 request.process_result）。
+    未匹配任何路由的请求（404 探测等）统一记为 request.other，客户端路径不会产生新的指标
+    """
+    route = request.scope.get("route")
+    if route is None:
+        return "request.other"
+    return "request." + (route.path.strip("/").split("/")[0] or "root")
+
+@app.middleware("http")
+async def timing_middleware(request: Request, call_next):
+    """按请求收集各阶段耗时，整体耗时计入 request.<路由>（见 _request_stage），按需写入 Server-Timing 头"""
+    token = metrics.begin_request()
     try:
-        yield db
+        start = time.perf_counter()
+        try:
+            response = await call_next(request)
+        except BaseException:
+            metrics.inc("nopeek_stage_errors_total", stage=_request_stage(request))
+            raise
+        finally:
+            metrics.observe(_request_stage(request), time.perf_counter() - start)
+        if SERVER_TIMING or request.headers.get("x-server-timing") == "1":
+            response.headers["Server-Timing"] = metrics.server_timing(metrics.request_spans())
+        return response
     finally:
-        db.close()
-
-def generate_unique_filename(original_filename: str) -> str:
-    ext = os.path.splitext(original_filename)[1].lower()
-    allowed_extensions = {".jpg", ".jpeg", ".png", ".gif", ".webp", ".bmp"}
-    if ext not in allowed_extensions:
-        ext = ".jpg"
-    return f"{uuid.uuid4().hex}{ext}"
+        metrics.end_request(token)
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus 文本格式的阶段耗时直方图与错误计数"""
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+# -------------------- 数据库 --------------------
+# 引擎、模型与写入接口见 db.py（异步驱动，不阻塞事件循环）。
+# 建表在启动时进行而非导入时；已有库可设置 DB_CREATE_SCHEMA=0 跳过，或用 python db.py --create-schema 手动执行
+@app.on_event("startup")
+async def startup_db():
+    if os.getenv("DB_CREATE_SCHEMA", "1") != "0":
+        await init_db()
+
+@app.on_event("shutdown")
+async def shutdown_db():
+    await dispose_db()
+
+@app.on_event("startup")
+async def start_worker_pool():
+    POOL.start()
+
+@app.on_event("shutdown")
+async def stop_worker_pool():
+    POOL.close()
+
+@app.on_event("startup")
+async def start_upload_sweeper():
+    # 保存任务引用，避免被垃圾回收
+    app.state.upload_sweeper = asyncio.create_task(
+        STORE.sweep_forever(float(os.getenv("UPLOAD_SWEEP_INTERVAL_S", 300))))
 
-def base64_to_image(base64_string: str) -> np.ndarray:
+# -------------------- 工具函数 --------------------
+def base64_to_bytes(base64_string: str) -> bytes:
     # 移除可能的数据URL前缀
     if ',' in base64_string:
         base64_string = base64_string.split(',')[1]
     
     # 解码base64字符串
-    image_data = base64.b64decode(base64_string)
-    
+    with span("base64.decode"):
+        return base64.b64decode(base64_string)
+
+def bytes_to_image(raw: bytes) -> np.ndarray:
     # 将字节数据转换为numpy数组
-    nparr = np.frombuffer(image_data, np.uint8)
+    nparr = np.frombuffer(raw, np.uint8)
     
     # 解码图像
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    with span("image.decode"):
+        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
     return img
 
-def image_to_base64(image: np.ndarray) -> str:
-    # 编码图像为JPEG格式
-    _, buffer = cv2.imencode('.jpg', image)
-    
-    # 转换为base64字符串
-    base64_string = base64.b64encode(buffer).decode('utf-8')
-    
-    return f"data:image/jpeg;base64,{base64_string}"
-
-def run_detection(image_path: str, detection_type: str) -> list:
+def base64_to_image(base64_string: str) -> np.ndarray:
+    return bytes_to_image(base64_to_bytes(base64_string))
+
+def store_input_image(raw: bytes, img: np.ndarray, namespace: str = "objects") -> str:
+    """
+    按内容哈希保存输入图像并返回路径；同一张图已存在时不再写盘。
+    JPEG/PNG/WebP 原样保存（局部重编码需要原始 JPEG 字节），其他格式重新编码为 JPEG
+    """
+    suffix = sniff_suffix(raw)
+    data = raw
+    if not suffix:
+        ok, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 95])
+        if not ok:
+            raise ValueError("无法编码输入图像")
+        data, suffix = buf.tobytes(), ".jpg"
+    with span("fs.write"):
+        path, _ = STORE.put(data, suffix, digest=content_hash(raw), namespace=namespace)
+    return path
+
+def patched_jpeg_bytes(original_path: str, processed_img: np.ndarray, regions: list):
+    """
+    局部重编码: 仅重新编码 regions（被修改区域）覆盖的 MCU，其余 DCT 系数原样复制。
+    无法无损拼接时（渐进式 JPEG、量化表不匹配、修改面积过大等）返回 None，调用方回退到整图编码。
+    """
+    patched_path = STORE.scratch_path("patched.jpg")
+    try:
+        if not patch_jpeg(original_path, processed_img, patched_path, rects=regions):
+            return None
+        with open(patched_path, "rb") as f:
+            return f.read()
+    finally:
+        STORE.discard(patched_path)
+
+async def changed_regions(original_img: np.ndarray, processed_img: np.ndarray, render_key: str = "") -> list:
+    """
+    被修改的区域（按 16 像素网格对齐的矩形）。processed_img 必须是处理结果本身：
+    读回的 JPEG 与原图几乎处处不同，会把整图都标为修改。给出 render_key 时随渲染结果一起缓存
+    """
+    with span("encode.diff"):
+        regions = await run_in_threadpool(dirty_mcu_rects, original_img, processed_img)
+    if render_key:
+        await RESULTS.put_async(result_key("regions", render_key), json.dumps(regions).encode("utf-8"), "application/json")
+    return regions
+
+async def encode_result(processed_img: np.ndarray, encode_opts: EncodeOptions, output_mode: str = "",
+                        original_path: str = "", regions: list = None):
+    """
+    编码返回图像，返回 (bytes, mime)。output_mode 为 "patch" 且已知被修改区域 regions 时
+    优先尝试局部重编码；区域未知（例如读回处理脚本输出的 JPEG）时直接整图编码
+    """
+    if output_mode == "patch" and original_path and regions is not None:
+        with span("encode.patch"):
+            data = await run_in_threadpool(patched_jpeg_bytes, original_path, processed_img, regions)
+        if data is not None:
+            return data, "image/jpeg"
+    with span("encode"):
+        return await encode_image_async(processed_img, encode_opts)
+
+async def cached_result(render_key: str, response_key: str, encode_opts: EncodeOptions, output_mode: str,
+                        original_path: str):
+    """
+    查询结果缓存，命中时返回 (bytes, mime):
+    先找相同编码参数下已编码好的响应；再找已渲染的处理结果，只需重新编码；都没有返回 None
+    """
+    hit = await RESULTS.get_async(response_key)
+    if hit is not None:
+        return hit
+    rendered = await RESULTS.get_async(render_key)
+    if rendered is None:
+        return None
+    processed_img = bytes_to_image(rendered[0])
+    if processed_img is None:
+        return None
+    # 缓存的渲染结果是 JPEG，不能与原图逐像素比较；局部重编码使用处理时记录的修改区域
+    regions = None
+    if output_mode == "patch":
+        cached_regions = await RESULTS.get_async(result_key("regions", render_key))
+        regions = json.loads(cached_regions[0]) if cached_regions is not None else None
+    hit = await encode_result(processed_img, encode_opts, output_mode, original_path, regions)
+    await RESULTS.put_async(response_key, *hit)
+    return hit
+
+def image_to_base64(image: np.ndarray, target_bytes: int = 0) -> str:
+    # 编码图像为JPEG格式；指定 target_bytes 时先降低质量，仍超出时再按尺寸模型缩放
+    return encode_data_url(image, EncodeOptions(target_bytes=target_bytes))
+
+def response_encode_options(params, accept_header: str = "") -> EncodeOptions:
+    """
+    根据客户端参数和 Accept 头决定返回图像的编码方式:
+      - accept_formats: 客户端支持的格式列表，例如 ["webp", "jpeg"]（也可通过 Accept: image/webp 声明）
+      - output_quality: 编码质量（有字节预算时为上限）
+      - max_bytes: 返回图像的字节预算
+      - progressive / subsampling: 仅对 JPEG 生效
+    """
+    accepted = params.get("accept_formats", []) or []
+    if isinstance(accepted, str):
+        accepted = accepted.split(",")
+    accepted = list(accepted) + [a.split(";")[0] for a in accept_header.split(",") if a.strip().startswith("image/")]
+
+    return EncodeOptions(
+        fmt=negotiate_format(accepted),
+        quality=int(params.get("output_quality", 95)),
+        target_bytes=int(params.get("max_bytes", 0) or 0),
+        progressive=str(params.get("progressive", "")).lower() in ("1", "true"),
+        subsampling=str(params.get("subsampling", "") or ""),
+    )
+
+def _detection_json_path(image_path: str, name: str, cache: bool) -> str:
+    """
+    检测结果文件路径（.npz 二进制格式，见 detections.py）。cache 为 True 时与内容寻址的输入图像放在一起，
+    同一张图再次请求时直接复用；否则（中间结果图像）写入临时目录。桩检测器的结果单独存放，避免压测污染真实结果
+    """
+    if not cache:
+        return STORE.scratch_path(f"{name}.npz")
+    tag = ".stub" if os.getenv("NOPEEK_STUB_DETECTORS") else ""
+    # 车牌检测经过场景门控时，结果与门控阈值相关，阈值不同的结果分开缓存
+    if name == "plate" and gate_enabled("plate"):
+        tag += f".gate{gate_threshold('plate'):g}"
+    return STORE.derived_path(image_path, f"{name}{tag}.npz")
+
+def _load_cached_detections(json_path: str, name: str):
+    """读取已缓存的检测结果，不存在时返回 None"""
+    if not os.path.exists(json_path):
+        return None
+    STORE.touch(json_path)
+    metrics.inc("nopeek_detection_cache_hits_total", type=name)
+    return Detections.load(json_path).to_list()
+
+def _publish_detections(tmp_path: str, json_path: str, cache: bool) -> list:
+    """读取子进程写出的结果；需要缓存时原子地移动到缓存位置"""
+    detections = Detections.load(tmp_path).to_list()
+    if cache:
+        os.replace(tmp_path, json_path)
+    else:
+        STORE.discard(tmp_path)
+    return detections
+
+def run_detection(image_path: str, detection_type: str, cache: bool = True) -> list:
     """运行检测并返回结果"""
     try:
-        # 构建命令
-        cmd = ["python", "detect.py", "-i", image_path, "-t", detection_type]
-        
-        # 执行命令
-        result = subprocess.run(cmd, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
-        
-        if result.returncode != 0:
-            print(f"检测错误 ({detection_type}): {result.stderr}")
-            return []
-        
-        # 读取生成的JSON文件
-        json_path = os.path.splitext(image_path)[0] + ".json"
-        
-        if not os.path.exists(json_path):
-            print(f"JSON文件未找到: {json_path}")
-            return []
-        
-        with open(json_path, 'r') as f:
-            detections = json.load(f)
+        json_path = _detection_json_path(image_path, detection_type, cache)
+        detections = _load_cached_detections(json_path, detection_type) if cache else None
+
+        if detections is None:
+            # 子进程先写临时文件，成功后再移入缓存，并发请求不会读到写了一半的文件
+            tmp_path = STORE.scratch_path(f"{detection_type}.npz")
+            cmd = ["python", "detect.py", "-i", image_path, "-t", detection_type, "-o", tmp_path]
+            # 车牌：先做低分辨率门控，场景中没有车牌迹象时跳过完整检测
+            gated = detection_type == "plate" and gate_enabled("plate")
+            if gated:
+                cmd.append("--gate")
+
+            # 执行命令
+            with span(f"detect.{detection_type}"):
+                result = subprocess.run(cmd, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+            if result.returncode != 0:
+                print(f"检测错误 ({detection_type}): {result.stderr}")
+                STORE.discard(tmp_path)
+                return []
+            if gated:
+                record_gate("plate", "gate: skip" not in result.stdout)
+
+            if not os.path.exists(tmp_path):
+                print(f"检测结果文件未找到: {tmp_path}")
+                return []
+
+            detections = _publish_detections(tmp_path, json_path, cache)
         
         # 为每个检测结果添加类型信息
         for detection in detections:
@@ -138,36 +314,46 @@ def run_detection(image_path: str, detection_type: str) -> list:
         return []
 
 
-def run_document_detection(image_path: str) -> list:
-    """运行文档检测并返回结果"""
+def run_document_detection(image_path: str, cache: bool = True, img: np.ndarray = None) -> list:
+    """运行文档检测并返回结果；提供已解码的 img 时先做场景门控，没有文档迹象则跳过检测"""
     try:
         # 确保输入图像存在
         if not os.path.exists(image_path):
             print(f"输入图像不存在: {image_path}")
             return []
 
-        # 构建命令
-        json_path = os.path.splitext(image_path)[0] + "_doc.json"
-        cmd = ["python", "blur_doc.py", "-i", image_path, "-j", json_path]
+        json_path = _detection_json_path(image_path, "document", cache)
+        detections = _load_cached_detections(json_path, "document") if cache else None
 
-        # 执行命令
-        result = subprocess.run(cmd, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
-
-        if result.returncode != 0:
-            print(f"文档检测错误: {result.stderr}")
-            # 尝试读取可能已生成的JSON文件
-            if os.path.exists(json_path):
-                print("但JSON文件已存在，尝试读取...")
-            else:
+        if detections is None and img is not None and gate_enabled("document"):
+            with span("gate.document"):
+                score = document_gate_score(img)
+            if not should_run("document", score):
                 return []
 
-        # 检查JSON文件是否存在
-        if not os.path.exists(json_path):
-            print(f"文档JSON文件未找到: {json_path}")
-            return []
+        if detections is None:
+            # 构建命令
+            tmp_path = STORE.scratch_path("document.npz")
+            cmd = ["python", "blur_doc.py", "-i", image_path, "-j", tmp_path]
 
-        with open(json_path, 'r') as f:
-            detections = json.load(f)
+            # 执行命令
+            with span("detect.document"):
+                result = subprocess.run(cmd, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+            if result.returncode != 0:
+                print(f"文档检测错误: {result.stderr}")
+                # 尝试读取可能已生成的检测结果文件
+                if os.path.exists(tmp_path):
+                    print("但检测结果文件已存在，尝试读取...")
+                else:
+                    return []
+
+            # 检查检测结果文件是否存在
+            if not os.path.exists(tmp_path):
+                print(f"文档检测结果文件未找到: {tmp_path}")
+                return []
+
+            detections = _publish_detections(tmp_path, json_path, cache)
 
         # 为每个检测结果添加类型信息
         for detection in detections:
@@ -178,21 +364,66 @@ def run_document_detection(image_path: str) -> list:
         print(f"运行文档检测时出错: {str(e)}")
         return []
 
-def process_image_with_script(input_path: str, output_path: str, json_path: str, script_type: str, detection_type: str = "face") -> bool:
+async def detect(image_path: str, detection_type: str, img: np.ndarray) -> list:
+    """
+    检测入口（face / plate / document），返回带类型信息的检测结果。启用工作进程池时在工作进程中检测，
+    已解码的图像经共享内存传入，结果写入与子进程相同的缓存；否则走 run_detection / run_document_detection
+    """
+    if not POOL.enabled:
+        # 子进程检测会阻塞数秒，放到线程池中等待，事件循环只做 I/O
+        if detection_type == "document":
+            return await run_in_threadpool(run_document_detection, image_path, img=img)
+        return await run_in_threadpool(run_detection, image_path, detection_type)
+    try:
+        json_path = _detection_json_path(image_path, detection_type, True)
+        detections = _load_cached_detections(json_path, detection_type)
+
+        if detections is None:
+            with span(f"detect.{detection_type}"):
+                result = await POOL.run(f"detect_{detection_type}s", img, gate=True)
+            detections = result["dets"]
+            if result["ran"] is not None:
+                record_gate(detection_type, result["ran"])
+            # 文档门控跳过时不缓存（与 run_document_detection 一致），其余结果原子地写入缓存
+            if result["ran"] is not False or detection_type != "document":
+                tmp_path = STORE.scratch_path(f"{detection_type}.npz")
+                save_detections(tmp_path, detections)
+                os.replace(tmp_path, json_path)
+
+        for detection in detections:
+            detection['type'] = detection_type
+        return detections
+    except Exception as e:
+        print(f"运行检测时出错 ({detection_type}): {str(e)}")
+        return []
+
+def _script_command(input_path: str, output_path: str, json_path: str, script_type: str,
+                    detection_type: str = "face", quality: str = "final", engine: str = "auto") -> list:
+    """构建处理脚本的命令行，未知类型返回空列表"""
+    if script_type == "blur":
+        return ["python", "blur.py", "-i", input_path, "-o", output_path, "-j", json_path, "-t", detection_type]
+    if script_type == "sticker":
+        return ["python", "sticker.py", "-i", input_path, "-o", output_path, "-j", json_path, "-t", detection_type]
+    if script_type == "cartoon":
+        cmd = ["python", "inpaint.py", "-i", input_path, "-o", output_path, "-j", json_path, "-t", detection_type,
+               "--engine", engine]
+        if detection_type == "face":
+            cmd += ["--quality", quality]
+        return cmd
+    return []
+
+def process_image_with_script(input_path: str, output_path: str, json_path: str, script_type: str,
+                              detection_type: str = "face", quality: str = "final", engine: str = "auto") -> bool:
     """使用不同的脚本处理图像"""
     try:
-        if script_type == "blur":
-            cmd = ["python", "blur.py", "-i", input_path, "-o", output_path, "-j", json_path, "-t", detection_type]
-        elif script_type == "sticker":
-            cmd = ["python", "sticker.py", "-i", input_path, "-o", output_path, "-j", json_path, "-t", detection_type]
-        elif script_type == "cartoon":
-            cmd = ["python", "inpaint.py", "-i", input_path, "-o", output_path, "-j", json_path, "-t", detection_type]
-        else:
+        cmd = _script_command(input_path, output_path, json_path, script_type, detection_type, quality, engine)
+        if not cmd:
             print(f"未知的处理类型: {script_type}")
             return False
         
         # 执行命令
-        result = subprocess.run(cmd, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        with span(f"obfuscate.{script_type}_{detection_type}"):
+            result = subprocess.run(cmd, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
         
         if result.returncode != 0:
             print(f"{script_type}处理错误: {result.stderr}")
@@ -203,44 +434,125 @@ def process_image_with_script(input_path: str, output_path: str, json_path: str,
         print(f"运行{script_type}处理时出错: {str(e)}")
         return False
 
-def blur_document_regions(image_path: str, output_path: str, detections: list) -> bool:
-    """模糊文档区域"""
+# -------------------- 卡通化后台任务 --------------------
+# 预览档位先同步返回，完整档位在后台子进程中继续生成，客户端通过 job_id 轮询结果。
+# 同时运行的子进程数有上限（每个都要加载扩散模型），其余任务排队；回收进程、写入结果缓存
+# 与清理都由后台巡检任务完成，不依赖客户端轮询；无人领取的任务到期后丢弃
+CARTOON_MAX_RUNNING = max(1, int(os.getenv("CARTOON_MAX_RUNNING", 1)))
+CARTOON_JOB_TIMEOUT_S = float(os.getenv("CARTOON_JOB_TIMEOUT_S", 1800))
+CARTOON_RESULT_TTL_S = float(os.getenv("CARTOON_RESULT_TTL_S", 3600))
+CARTOON_POLL_S = 1.0
+CARTOON_JOBS = {}
+
+def start_cartoon_final_job(input_path: str, json_path: str, render_key: str = "", engine: str = "auto") -> str:
+    """登记完整质量的卡通化任务（排队，由巡检任务按并发上限启动），返回 job_id；完成后结果以 render_key 写入结果缓存"""
+    job_id = uuid.uuid4().hex
+    output_path = STORE.scratch_path(f"cartoon_final_{job_id}.jpg")
+    # stderr 写入日志文件而不是管道，避免扩散模型的进度条塞满管道缓冲区
+    log_path = STORE.scratch_path(f"cartoon_final_{job_id}.log")
+    CARTOON_JOBS[job_id] = {
+        "status": "queued",
+        "cmd": _script_command(input_path, output_path, json_path, "cartoon", "face", "final", engine),
+        "proc": None,
+        "output_path": output_path,
+        "log_path": log_path,
+        "render_key": render_key,
+        "created": time.monotonic(),
+        "updated": time.monotonic(),
+        # 输入图像按内容寻址、可能被其他请求共用，不随任务删除
+        "temp_files": [json_path, log_path],
+    }
+    return job_id
+
+def _cleanup_cartoon_job(job: dict) -> None:
+    STORE.discard(*job["temp_files"], job["output_path"])
+
+def _launch_cartoon_job(job: dict) -> None:
+    with open(job["log_path"], "w") as log:
+        job["proc"] = subprocess.Popen(job["cmd"], stdout=subprocess.DEVNULL, stderr=log,
+                                       cwd=os.path.dirname(os.path.abspath(__file__)))
+    job["status"] = "running"
+    job["updated"] = time.monotonic()
+
+def _finish_cartoon_job(job: dict, returncode: int) -> None:
+    """子进程结束后：成功则写入结果缓存；无论成败都删除临时文件，任务只保留状态供客户端查询"""
+    job["status"] = "failed"
     try:
-        # 读取图像
-        img = cv2.imread(image_path)
-        if img is None:
-            print(f"无法读取图像: {image_path}")
-            return False
-        
-        # 对每个检测区域进行模糊处理
-        for detection in detections:
-            if detection['type'] == 'document':
-                x1, y1, x2, y2 = detection['bbox_xyxy']
-                h, w = img.shape[:2]
-                
-                # 转换为像素坐标
-                x1 = int(x1 * w)
-                y1 = int(y1 * h)
-                x2 = int(x2 * w)
-                y2 = int(y2 * h)
-                
-                # 提取区域并模糊
-                region = img[y1:y2, x1:x2]
-                blurred_region = cv2.GaussianBlur(region, (51, 51), 0)
-                
-                # 将模糊后的区域放回原图
-                img[y1:y2, x1:x2] = blurred_region
-        
-        # 保存结果
-        cv2.imwrite(output_path, img)
-        return True
+        if returncode != 0:
+            with open(job["log_path"], "r", errors="replace") as f:
+                print(f"cartoon后台处理错误: {f.read()[-2000:]}")
+            return
+        with open(job["output_path"], "rb") as f:
+            rendered = f.read()
+        if bytes_to_image(rendered) is None:
+            print("cartoon后台处理错误: 无法读取处理后的图像")
+            return
+        job["result"] = (rendered, "image/jpeg")
+        if job["render_key"]:
+            RESULTS.put(job["render_key"], rendered, "image/jpeg")
+        job["status"] = "done"
     except Exception as e:
-        print(f"模糊文档区域时出错: {str(e)}")
-        return False
+        print(f"cartoon后台处理错误: {str(e)}")
+    finally:
+        job["proc"] = None
+        job["updated"] = time.monotonic()
+        _cleanup_cartoon_job(job)
+
+def reap_cartoon_jobs(now: float = None) -> None:
+    """巡检一次：回收结束的子进程、终止超时任务、按并发上限启动排队任务、丢弃过期任务"""
+    now = time.monotonic() if now is None else now
+    running = 0
+    for job_id, job in list(CARTOON_JOBS.items()):
+        if job["status"] == "running":
+            returncode = job["proc"].poll()
+            if returncode is None and now - job["updated"] > CARTOON_JOB_TIMEOUT_S:
+                job["proc"].kill()
+                returncode = job["proc"].wait()
+                print(f"cartoon后台任务超时: {job_id}")
+            if returncode is None:
+                running += 1
+            else:
+                _finish_cartoon_job(job, returncode)
+        elif job["status"] in ("done", "failed") and now - job["updated"] > CARTOON_RESULT_TTL_S:
+            CARTOON_JOBS.pop(job_id, None)
+        elif job["status"] == "queued" and now - job["created"] > CARTOON_RESULT_TTL_S:
+            CARTOON_JOBS.pop(job_id, None)
+            _cleanup_cartoon_job(job)
+    # dict 保持插入顺序，即先到先启动；巡检在线程池中运行，处理函数可能同时登记新任务，遍历快照
+    for job in list(CARTOON_JOBS.values()):
+        if running >= CARTOON_MAX_RUNNING:
+            break
+        if job["status"] == "queued":
+            _launch_cartoon_job(job)
+            running += 1
+
+async def watch_cartoon_jobs() -> None:
+    while True:
+        try:
+            # 读取结果、解码与写缓存都是阻塞操作，不在事件循环中进行
+            await run_in_threadpool(reap_cartoon_jobs)
+        except Exception as e:
+            print(f"cartoon任务巡检出错: {str(e)}")
+        await asyncio.sleep(CARTOON_POLL_S)
+
+@app.on_event("startup")
+async def start_cartoon_watcher():
+    # 保存任务引用，避免被垃圾回收
+    app.state.cartoon_watcher = asyncio.create_task(watch_cartoon_jobs())
+
+@app.on_event("shutdown")
+async def stop_cartoon_jobs():
+    app.state.cartoon_watcher.cancel()
+    for job in CARTOON_JOBS.values():
+        if job["proc"] is not None and job["proc"].poll() is None:
+            job["proc"].kill()
+            job["proc"].wait()
+        _cleanup_cartoon_job(job)
+    CARTOON_JOBS.clear()
 
 # -------------------- 上传接口 --------------------
 @app.post("/upload")
-async def upload_image(data: dict = Body(...), db: Session = Depends(get_db)):
+async def upload_image(data: dict = Body(...), db: AsyncSession = Depends(get_session)):
     try:
         # 1. 获取base64编码的图像数据
         image_base64 = data.get("image_data", "")
@@ -248,14 +560,15 @@ async def upload_image(data: dict = Body(...), db: Session = Depends(get_db)):
             return {"error": "未提供图像数据"}, 400
         
         # 2. 将base64转换为图像并保存
-        img = base64_to_image(image_base64)
-        filename = generate_unique_filename("uploaded_image.jpg")
-        local_input_path = os.path.join(UPLOAD_DIR, filename)
-        cv2.imwrite(local_input_path, img)
+        raw = base64_to_bytes(image_base64)
+        img = bytes_to_image(raw)
+        if img is None:
+            return {"error": "无效的图像数据"}, 400
+        local_input_path = store_input_image(raw, img)
         
         # 3. 运行人脸和车牌检测
-        face_detections = run_detection(local_input_path, "face")
-        plate_detections = run_detection(local_input_path, "plate")
+        face_detections = await detect(local_input_path, "face", img)
+        plate_detections = await detect(local_input_path, "plate", img)
         
         # 4. 合并检测结果
         all_detections = face_detections + plate_detections
@@ -264,104 +577,228 @@ async def upload_image(data: dict = Body(...), db: Session = Depends(get_db)):
         # annotated_image = draw_detections(img, all_detections)
         
         # 6. 将原图和标注图转换为base64
-        original_base64 = image_to_base64(img)
+        # original_base64 = image_to_base64(img)
         # annotated_base64 = image_to_base64(annotated_image)
         
-        # 7. 提取需要返回给前端的数据（只需要bbox_xyxy）
-        response_detections = []
-        for det in all_detections:
-            response_det = {
-                "type": det["type"],
-                "bbox_xyxy": det["bbox_xyxy"]
-            }
-            # 如果是人脸，添加gender信息
-            if det["type"] == "face" and "attributes" in det and "gender" in det["attributes"]:
-                response_det["gender"] = det["attributes"]["gender"]
-            response_detections.append(response_det)
+        # 7. 提取需要返回给前端的数据（类型、bbox_xyxy，人脸附带性别）
+        response_detections = response_view(all_detections)
         
-        # 8. 返回结果
-        return JSONResponse({
+        # 8. 提供 user_id 时记录帖子及其图片
+        response = {
         #    "original_image": original_base64,
         #    "annotated_image": annotated_base64,
             "detections": response_detections
-        })
+        }
+        user_id = data.get("user_id", "")
+        if user_id:
+            h, w = img.shape[:2]
+            # 帖子引用的图像单独存放，不参与 TTL 清理
+            post_image_path = store_input_image(raw, img, namespace="posts")
+            with span("db.create_post"):
+                response["post_id"] = await create_post(db, user_id, [{
+                    "image_url": post_image_path,
+                    "file_size": os.path.getsize(post_image_path),
+                    "mime_type": mime_type(post_image_path),
+                    "width": w,
+                    "height": h,
+                }], caption=data.get("caption"))
+
+        # 9. 返回结果
+        return JSONResponse(response)
         
     except Exception as e:
         # 记录错误日志
         print(f"处理失败: {str(e)}")
+        metrics.inc("nopeek_request_errors_total", endpoint="/upload")
         return {"error": f"处理失败: {str(e)}"}, 500
 
 # -------------------- 处理图像接口 --------------------
 @app.post("/process_image")
-async def process_image(data: dict = Body(...)):
+async def process_image(request: Request, data: dict = Body(...)):
     try:
         # 1. 获取参数
         image_base64 = data.get("image_data", "")
         process_type = data.get("type", "")
+        # 卡通化档位: "final"（默认）或 "preview"（少步数、低分辨率，完整结果在后台继续生成）
+        quality = data.get("quality", "final")
+        # 卡通化后端: "auto"（默认）、"cpu"（OpenCV 传统方法，任何节点都可在有限时间内完成）或 FLUX 引擎
+        engine = data.get("engine", "auto")
         
         if not image_base64:
             return {"error": "未提供图像数据"}, 400
+
+        if quality not in ("preview", "final"):
+            return {"error": f"未知的质量档位: {quality}"}, 400
+
+        if engine not in ENGINES:
+            return {"error": f"未知的卡通化后端: {engine}"}, 400
+        if process_type == "cartoon":
+            # auto 在此解析为具体引擎（NOPEEK_INPAINT_ENGINE，或按 CUDA 是否可用），结果缓存按具体引擎区分
+            try:
+                engine = resolve_engine(engine, "face")
+            except ValueError as e:
+                return {"error": str(e)}, 400
+            if engine == "cpu":
+                # CPU 引擎本身很快，没有预览档位，直接返回完整结果
+                quality = "final"
+
+        encode_opts = response_encode_options(data, request.headers.get("accept", ""))
+        # 输出模式: "" 为整图重新编码；"patch" 为只重新编码被修改的 JPEG 块
+        output_mode = data.get("output_mode", "")
         
         # 2. 将base64转换为图像并保存
-        img = base64_to_image(image_base64)
-        filename = generate_unique_filename("process_image.jpg")
-        local_input_path = os.path.join(UPLOAD_DIR, filename)
-        cv2.imwrite(local_input_path, img)
+        raw = base64_to_bytes(image_base64)
+        img = bytes_to_image(raw)
+        if img is None:
+            return {"error": "无效的图像数据"}, 400
+        local_input_path = store_input_image(raw, img)
         
         # 3. 运行人脸检测
-        face_detections = run_detection(local_input_path, "face")
+        face_detections = await detect(local_input_path, "face", img)
         
         if not face_detections:
             # 如果没有检测到人脸，直接返回原图
-            result_base64 = image_to_base64(img)
+            result_base64 = await encode_data_url_async(img, encode_opts)
             return JSONResponse({
                 "processed_image": result_base64,
                 "message": "未检测到人脸，返回原图"
             })
         
-        # 4. 保存检测结果到JSON文件
-        json_filename = os.path.splitext(filename)[0] + ".json"
-        json_path = os.path.join(UPLOAD_DIR, json_filename)
-        with open(json_path, 'w') as f:
-            json.dump(face_detections, f)
-        
-        # 5. 根据处理类型处理图像
-        output_filename = f"processed_{process_type}_{filename}"
-        output_path = os.path.join(UPLOAD_DIR, output_filename)
-        
-        success = process_image_with_script(local_input_path, output_path, json_path, process_type, "face")
-        
-        if not success:
-            return {"error": f"{process_type}处理失败"}, 500
-        
-        # 6. 读取处理后的图像并转换为base64
-        processed_img = cv2.imread(output_path)
-        if processed_img is None:
-            return {"error": "无法读取处理后的图像"}, 500
-        
-        result_base64 = image_to_base64(processed_img)
-        
-        # 7. 清理临时文件
-        try:
-            os.remove(local_input_path)
-            os.remove(json_path)
-            os.remove(output_path)
-        except:
-            pass
-        
-        # 8. 返回结果
-        return JSONResponse({
-            "processed_image": result_base64
-        })
+        # 贴纸分配：每张脸的贴纸由 seed 与人脸序号确定（默认 seed 为输入内容哈希），
+        # 客户端可回传 stickers 列表逐一指定，以复现同一结果
+        stickers = None
+        if process_type == "sticker":
+            seed = str(data.get("seed") or STORE.digest(local_input_path))
+            requested = data.get("stickers") or []
+            if not isinstance(requested, list):
+                return {"error": "stickers 必须是列表"}, 400
+            for d, name in zip(face_detections, requested):
+                if name:
+                    d["sticker"] = str(name)
+            stickers = assign_face_stickers(face_detections, STICKERS_DIR, seed)
+            for d, name in zip(face_detections, stickers):
+                if name:
+                    d["sticker"] = name
+        
+        # 4. 查询结果缓存（输入内容、处理类型、检测结果、贴纸分配、算法版本）。
+        # 卡通化只缓存完整质量的结果，命中时任何档位都直接返回完整结果
+        version = ALGORITHM_VERSIONS.get(process_type, "0")
+        if process_type == "cartoon":
+            version += f"/{engine}"
+        render_key = result_key("render", STORE.digest(local_input_path), process_type,
+                                version, detections_hash(face_detections),
+                                ",".join(n or "" for n in stickers or []))
+        response_key = result_key("response", render_key, encode_opts, output_mode)
+        cached = await cached_result(render_key, response_key, encode_opts, output_mode, local_input_path)
+        if cached is not None:
+            response = {"processed_image": to_data_url(*cached)}
+            if process_type == "cartoon":
+                response["quality"] = "final"
+            if stickers is not None:
+                response["seed"] = seed
+                response["stickers"] = stickers
+            return JSONResponse(response)
+        
+        json_path = output_path = None
+        regions = None
+        in_process = process_type in ("blur", "sticker") or (process_type == "cartoon" and engine == "cpu")
+        if in_process and (POOL.enabled or output_mode == "patch"):
+            # 5-6. 在工作进程中（图像经共享内存往返，不落盘）或本进程线程池中合成；局部重编码需要
+            # 未经重编码的处理结果，所以 patch 模式也走这里。渲染缓存保存与处理脚本相同的 JPEG（质量 95）
+            mode = "inpaint" if process_type == "cartoon" else process_type
+            if POOL.enabled:
+                processed_img = await POOL.run("composite", img, dets=face_detections, modes={"face": mode},
+                                               inpaint_engine=engine)
+            else:
+                processed_img = await run_in_threadpool(composite, img, face_detections, {"face": mode},
+                                                        inpaint_engine=engine)
+            if output_mode == "patch":
+                regions = await changed_regions(img, processed_img, render_key)
+            _, buf = await run_in_threadpool(cv2.imencode, ".jpg", processed_img, [cv2.IMWRITE_JPEG_QUALITY, 95])
+            rendered = buf.tobytes()
+        else:
+            # 5. 保存检测结果（二进制格式）供处理脚本读取
+            json_path = STORE.scratch_path("face.npz")
+            save_detections(json_path, face_detections)
+        
+            # 6. 根据处理类型处理图像
+            output_path = STORE.scratch_path(f"{process_type}.jpg")
+        
+            success = await run_in_threadpool(process_image_with_script, local_input_path, output_path, json_path,
+                                              process_type, "face", quality, engine)
+        
+            if not success:
+                STORE.discard(json_path, output_path)
+                return {"error": f"{process_type}处理失败"}, 500
+        
+            # 读取处理脚本输出的图像
+            with open(output_path, "rb") as f:
+                rendered = f.read()
+            processed_img = bytes_to_image(rendered)
+            if processed_img is None:
+                STORE.discard(json_path, output_path)
+                return {"error": "无法读取处理后的图像"}, 500
+        
+        # 7. 编码并写入结果缓存
+        encoded = await encode_result(processed_img, encode_opts, output_mode, local_input_path, regions)
+        result_base64 = to_data_url(*encoded)
+
+        # 预览档位：后台继续生成完整结果，完成后写入结果缓存
+        job_id = None
+        if process_type == "cartoon" and quality == "preview":
+            job_id = start_cartoon_final_job(local_input_path, json_path, render_key, engine)
+        else:
+            await RESULTS.put_async(render_key, rendered, "image/jpeg")
+            await RESULTS.put_async(response_key, *encoded)
+        
+        # 8. 清理临时文件（输入图像与检测结果保留在内容寻址存储中，由后台清理）
+        with span("fs.cleanup"):
+            STORE.discard(output_path, json_path if job_id is None else None)
+        
+        # 9. 返回结果
+        response = {"processed_image": result_base64}
+        if job_id is not None:
+            response["quality"] = "preview"
+            response["job_id"] = job_id
+        if stickers is not None:
+            response["seed"] = seed
+            response["stickers"] = stickers
+        return JSONResponse(response)
         
     except Exception as e:
         # 记录错误日志
         print(f"处理失败: {str(e)}")
+        metrics.inc("nopeek_request_errors_total", endpoint="/process_image")
         return {"error": f"处理失败: {str(e)}"}, 500
 
+# -------------------- 卡通化结果查询接口 --------------------
+@app.get("/process_result/{job_id}")
+async def process_result(job_id: str, request: Request):
+    job = CARTOON_JOBS.get(job_id)
+    if job is None:
+        return JSONResponse({"error": "未知的任务"}, status_code=404)
+    if job["status"] in ("queued", "running"):
+        return JSONResponse({"status": "pending"})
+
+    CARTOON_JOBS.pop(job_id, None)
+    if job["status"] == "failed":
+        return JSONResponse({"status": "failed", "error": "cartoon处理失败"}, status_code=500)
+
+    rendered, _ = job["result"]
+    processed_img = bytes_to_image(rendered)
+    return JSONResponse({
+        "status": "done",
+        "quality": "final",
+        "processed_image": await encode_data_url_async(
+            processed_img, response_encode_options(request.query_params, request.headers.get("accept", "")))
+    })
+
 # -------------------- 处理文档接口 --------------------
+# 请求中的类型名 -> 检测结果中的类型名
+DOC_DETECTION_TYPES = {"license_plate": "plate", "document_file": "document"}
+
 @app.post("/process_doc")
-async def process_doc(data: dict = Body(...)):
+async def process_doc(request: Request, data: dict = Body(...)):
     try:
         # 1. 获取参数
         image_base64 = data.get("image_data", "")
@@ -373,104 +810,61 @@ async def process_doc(data: dict = Body(...)):
         if not process_types:
             return {"error": "未指定处理类型"}, 400
 
+        encode_opts = response_encode_options(data, request.headers.get("accept", ""))
+        output_mode = data.get("output_mode", "")
+
         # 2. 将base64转换为图像并保存
-        img = base64_to_image(image_base64)
+        raw = base64_to_bytes(image_base64)
+        img = bytes_to_image(raw)
         if img is None:
             return {"error": "无效的图像数据"}, 400
 
-        filename = generate_unique_filename("process_doc.jpg")
-        local_input_path = os.path.join(UPLOAD_DIR, filename)
-        success = cv2.imwrite(local_input_path, img)
-
-        if not success:
-            return {"error": "保存图像失败"}, 500
-
-        # 3. 运行检测
+        local_input_path = store_input_image(raw, img)
+
+        # 每种类型的处理方式（blur / sticker / pixelate / inpaint），默认模糊
+        requested_modes = data.get("modes", {}) or {}
+        if not isinstance(requested_modes, dict):
+            return {"error": "modes 必须是对象"}, 400
+        modes = {DOC_DETECTION_TYPES.get(t, t): mode for t, mode in requested_modes.items()}
+        for t, mode in modes.items():
+            if (t, mode) not in SUPPORTED:
+                return {"error": f"不支持的处理方式: {t}={mode}"}, 400
+        # 车牌 inpaint 的后端: "auto"、"cpu"（合成假车牌文字）或 "flux_fill"
+        engine = data.get("engine", "auto")
+        if modes.get("plate") == "inpaint":
+            try:
+                engine = resolve_engine(engine, "plate")
+            except ValueError as e:
+                return {"error": str(e)}, 400
+
+        # 3. 运行检测（都在原始输入上进行，结果可缓存）
         detections = []
-        current_image_path = local_input_path
-
-        # 处理车牌
         if "license_plate" in process_types:
-            plate_detections = run_detection(current_image_path, "plate")
-            if plate_detections:
-                # 保存检测结果到JSON文件
-                plate_json_filename = os.path.splitext(filename)[0] + "_plate.json"
-                plate_json_path = os.path.join(UPLOAD_DIR, plate_json_filename)
-                with open(plate_json_path, 'w') as f:
-                    json.dump(plate_detections, f)
-
-                # 处理车牌
-                plate_output_filename = f"processed_plate_{filename}"
-                plate_output_path = os.path.join(UPLOAD_DIR, plate_output_filename)
-
-                success = process_image_with_script(current_image_path, plate_output_path, plate_json_path, "blur",
-                                                    "plate")
-
-                if success:
-                    # 如果之前已经处理过其他内容，删除中间文件
-                    if current_image_path != local_input_path:
-                        try:
-                            os.remove(current_image_path)
-                        except:
-                            pass
-                    current_image_path = plate_output_path
-                    detections.extend(plate_detections)
-                else:
-                    print("车牌处理失败，使用原始图像继续处理文档")
-
-                # 清理临时JSON文件
-                try:
-                    os.remove(plate_json_path)
-                except:
-                    pass
-
-        # 处理文档
+            detections.extend(await detect(local_input_path, "plate", img))
         if "document_file" in process_types:
-            doc_detections = run_document_detection(current_image_path)
-            if doc_detections:
-                # 处理文档
-                doc_output_filename = f"processed_doc_{filename}"
-                doc_output_path = os.path.join(UPLOAD_DIR, doc_output_filename)
-
-                success = blur_document_regions(current_image_path, doc_output_path, doc_detections)
-
-                if success:
-                    # 如果之前已经处理过其他内容，删除中间文件
-                    if current_image_path != local_input_path:
-                        try:
-                            os.remove(current_image_path)
-                        except:
-                            pass
-                    current_image_path = doc_output_path
-                    detections.extend(doc_detections)
-                else:
-                    print("文档处理失败，使用之前处理的图像")
-            else:
+            doc_detections = await detect(local_input_path, "document", img)
+            if not doc_detections:
                 print("未检测到文档，跳过文档处理")
+            detections.extend(doc_detections)
+
+        # 4. 在同一张已解码的图像上一次完成所有处理，只编码一次
+        processed_img = img
+        if detections:
+            # strength: 文档模糊的 sigma，或马赛克的格子边长（像素）
+            strength = data.get("strength")
+            doc_strength = float(strength) if strength not in (None, "") else None
+            if POOL.enabled:
+                processed_img = await POOL.run("composite", img, dets=detections, modes=modes, doc_strength=doc_strength,
+                                               inpaint_engine=engine)
+            else:
+                processed_img = await run_in_threadpool(composite, img, detections, modes, doc_strength=doc_strength,
+                                                        inpaint_engine=engine)
 
-        # 4. 读取处理后的图像并转换为base64
-        if not os.path.exists(current_image_path):
-            return {"error": "处理后的图像不存在"}, 500
-
-        processed_img = cv2.imread(current_image_path)
-        if processed_img is None:
-            return {"error": "无法读取处理后的图像"}, 500
-
-        result_base64 = image_to_base64(processed_img)
-
-        # 5. 清理临时文件
-        try:
-            # 删除原始输入文件
-            if os.path.exists(local_input_path):
-                os.remove(local_input_path)
-
-            # 删除中间处理文件（如果不是最终输出）
-            if current_image_path != local_input_path and current_image_path.endswith("_processed.jpg"):
-                os.remove(current_image_path)
-        except Exception as e:
-            print(f"清理临时文件时出错: {str(e)}")
+        regions = await changed_regions(img, processed_img) if output_mode == "patch" else None
+        result_base64 = to_data_url(*await encode_result(processed_img, encode_opts, output_mode, local_input_path,
+                                                         regions))
 
-        # 6. 返回结果
+        # 5. 返回结果
         return JSONResponse({
             "processed_image": result_base64
         })
@@ -478,6 +872,7 @@ async def process_doc(data: dict = Body(...)):
     except Exception as e:
         # 记录错误日志
         print(f"处理失败: {str(e)}")
+        metrics.inc("nopeek_request_errors_total", endpoint="/process_doc")
         return {"error": f"处理失败: {str(e)}"}, 500
 
 if __name__ == "__main__":
@@ -0,0 +1,326 @@
+// Copyright 2025 The NoPeek Authors. All rights reserved.
+// Licensed under the Apache License, Version 2.0 that can be found in the
+// LICENSE file in the root directory of this source tree.
+
+# video.py — streaming video / burst obfuscation with keyframe detection and box tracking
+import argparse, glob, os
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from blur import blur_faces, blur_plates, face_blur_masks
+from detect import detect_faces, detect_plates
+
+
+# =========================
+# Tracking
+# =========================
+@dataclass
+class Track:
+    box: np.ndarray                 # float32 [x1, y1, x2, y2] in pixels
+    attributes: Dict = field(default_factory=dict)
+    misses: int = 0                 # consecutive keyframes without a matching detection
+
+def _iou_matrix(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    if len(a) == 0 or len(b) == 0:
+        return np.zeros((len(a), len(b)), np.float32)
+    ix1 = np.maximum(a[:, None, 0], b[None, :, 0]); iy1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    ix2 = np.minimum(a[:, None, 2], b[None, :, 2]); iy2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(ix2 - ix1, 0, None) * np.clip(iy2 - iy1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return inter / (area_a[:, None] + area_b[None, :] - inter + 1e-6)
+
+class BoxTracker:
+    """
+    Keeps boxes alive between keyframes.
+      - On keyframes, detections are associated to tracks greedily by IoU; unmatched
+        detections start tracks, tracks unmatched for `max_misses` keyframes are dropped.
+      - Between keyframes, each track is shifted by the median sparse optical flow
+        (pyramidal Lucas–Kanade) of feature points inside it.
+    """
+
+    def __init__(self, iou_thr: float = 0.3, max_misses: int = 1, max_points: int = 24):
+        self.iou_thr = iou_thr
+        self.max_misses = max_misses
+        self.max_points = max_points
+        self.tracks: List[Track] = []
+        self._prev_gray: Optional[np.ndarray] = None
+
+    def update_detections(self, gray: np.ndarray, boxes: np.ndarray, attrs: List[Dict]) -> None:
+        prev = np.array([t.box for t in self.tracks], np.float32).reshape(-1, 4)
+        iou = _iou_matrix(prev, boxes)
+        matched_t, matched_d = set(), set()
+        for ti, di in sorted(np.argwhere(iou >= self.iou_thr).tolist(), key=lambda p: -iou[p[0], p[1]]):
+            if ti in matched_t or di in matched_d:
+                continue
+            self.tracks[ti].box = boxes[di].copy()
+            self.tracks[ti].attributes = attrs[di]
+            self.tracks[ti].misses = 0
+            matched_t.add(ti); matched_d.add(di)
+
+        kept = []
+        for ti, t in enumerate(self.tracks):
+            if ti not in matched_t:
+                t.misses += 1
+            if t.misses <= self.max_misses:
+                kept.append(t)
+        kept += [Track(boxes[di].copy(), attrs[di]) for di in range(len(boxes)) if di not in matched_d]
+        self.tracks = kept
+        self._prev_gray = gray
+
+    def propagate(self, gray: np.ndarray) -> None:
+        if self._prev_gray is None or not self.tracks:
+            self._prev_gray = gray
+            return
+        H, W = gray.shape[:2]
+        for t in self.tracks:
+            x1, y1, x2, y2 = np.round(t.box).astype(int)
+            x1, y1 = max(0, x1), max(0, y1)
+            x2, y2 = min(W, x2), min(H, y2)
+            if x2 - x1 < 4 or y2 - y1 < 4:
+                continue
+            pts = cv2.goodFeaturesToTrack(self._prev_gray[y1:y2, x1:x2], self.max_points, 0.01, 3)
+            if pts is None:
+                continue
+            pts = pts.reshape(-1, 2) + np.array([x1, y1], np.float32)
+            nxt, status, _ = cv2.calcOpticalFlowPyrLK(self._prev_gray, gray, pts.reshape(-1, 1, 2), None,
+                                                      winSize=(15, 15), maxLevel=2)
+            ok = status.reshape(-1) == 1
+            if not ok.any():
+                continue
+            dx, dy = np.median(nxt.reshape(-1, 2)[ok] - pts[ok], axis=0)
+            t.box = t.box + np.array([dx, dy, dx, dy], np.float32)
+        self._prev_gray = gray
+
+    def detections(self, W: int, H: int) -> List[Dict]:
+        """Current tracks in the detector JSON shape (normalized xyxy, clipped to the frame)."""
+        out = []
+        for t in self.tracks:
+            x1, y1, x2, y2 = t.box
+            x1, x2 = np.clip([x1, x2], 0, W); y1, y2 = np.clip([y1, y2], 0, H)
+            if x2 - x1 < 2 or y2 - y1 < 2:
+                continue
+            out.append({"bbox_xyxy": [x1 / W, y1 / H, x2 / W, y2 / H], "attributes": t.attributes})
+        return out
+
+
+# =========================
+# Frame sources / sinks
+# =========================
+def _iter_video(path: str) -> Iterator[np.ndarray]:
+    cap = cv2.VideoCapture(path)
+    if not cap.isOpened():
+        raise FileNotFoundError(path)
+    try:
+        while True:
+            ok, frame = cap.read()
+            if not ok:
+                break
+            yield frame
+    finally:
+        cap.release()
+
+def _iter_burst(directory: str) -> Iterator[np.ndarray]:
+    paths = sorted(glob.glob(os.path.join(directory, "*.jpg")) + glob.glob(os.path.join(directory, "*.jpeg"))
+                   + glob.glob(os.path.join(directory, "*.png")))
+    if not paths:
+        raise FileNotFoundError(f"No frames in {directory}")
+    for p in paths:
+        frame = cv2.imread(p)
+        if frame is not None:
+            yield frame
+
+def _video_fps(path: str, default: float = 30.0) -> float:
+    cap = cv2.VideoCapture(path)
+    fps = cap.get(cv2.CAP_PROP_FPS) if cap.isOpened() else 0.0
+    cap.release()
+    return float(fps) if fps and fps > 0 else default
+
+
+# =========================
+# Pipeline
+# =========================
+_DETECTORS = {"face": detect_faces, "plate": detect_plates}
+_OBFUSCATORS = {"face": blur_faces, "plate": blur_plates}
+
+def _boxes_px(dets: List[Dict], W: int, H: int) -> Tuple[np.ndarray, List[Dict]]:
+    boxes = np.array([d["bbox_xyxy"] for d in dets], np.float32).reshape(-1, 4) * np.array([W, H, W, H], np.float32)
+    return boxes, [d.get("attributes", {}) for d in dets]
+
+def obfuscate_stream(frames: Iterator[np.ndarray], targets: List[str], keyframe_interval: int = 10,
+                     detect_max_side: int = 960) -> Iterator[np.ndarray]:
+    """
+    Obfuscate a frame stream, yielding output frames one by one (constant memory).
+      - Detectors run only every `keyframe_interval` frames, on a copy downscaled to
+        `detect_max_side` (detections are normalized, so they map back 1:1).
+      - Boxes are carried across the frames in between by BoxTracker.
+      - The existing single-image obfuscators run per frame on the tracked boxes,
+        cropped to the region around them (see _apply_roi), with face masks reused
+        while the tracked boxes only translate (see MaskCache).
+    """
+    trackers = {t: BoxTracker() for t in targets}
+    mask_cache = MaskCache()
+    for idx, frame in enumerate(frames):
+        H, W = frame.shape[:2]
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+
+        if idx % keyframe_interval == 0:
+            scale = min(1.0, detect_max_side / float(max(H, W)))
+            small = frame if scale >= 1.0 else cv2.resize(frame, (int(W * scale), int(H * scale)),
+                                                          interpolation=cv2.INTER_AREA)
+            for t in targets:
+                try:
+                    dets = _DETECTORS[t](small)
+                except (RuntimeError, ValueError) as e:
+                    print(f"frame {idx}: {t} detection skipped ({e})")
+                    dets = []
+                boxes, attrs = _boxes_px(dets, W, H)
+                trackers[t].update_detections(gray, boxes, attrs)
+        else:
+            for t in targets:
+                trackers[t].propagate(gray)
+
+        out = frame
+        for t in targets:
+            dets = trackers[t].detections(W, H)
+            if dets:
+                out = _apply_roi(_OBFUSCATORS[t], out, dets, mask_cache)
+        yield out
+
+def _apply_roi(fn, frame: np.ndarray, dets: List[Dict], mask_cache: Optional["MaskCache"] = None,
+               margin_frac: float = 0.8, margin_px: int = 320) -> np.ndarray:
+    """
+    Run a single-image obfuscator on the padded union of the boxes only.
+    The obfuscators' blur kernels, feathering and halos scale with box size, so a
+    margin of ~box size plus the largest halo/kernel reach keeps the result the same
+    as a full-frame call while the cost follows the boxes instead of the frame.
+    """
+    H, W = frame.shape[:2]
+    # whole-pixel boxes keep crop-local coordinates stable while a track only translates
+    boxes = np.round(np.array([d["bbox_xyxy"] for d in dets], np.float32) * np.array([W, H, W, H], np.float32))
+    span = float(max((boxes[:, 2] - boxes[:, 0]).max(), (boxes[:, 3] - boxes[:, 1]).max()))
+    pad = int(span * margin_frac) + margin_px
+    x1 = max(0, int(boxes[:, 0].min()) - pad); y1 = max(0, int(boxes[:, 1].min()) - pad)
+    x2 = min(W, int(np.ceil(boxes[:, 2].max())) + pad); y2 = min(H, int(np.ceil(boxes[:, 3].max())) + pad)
+    cw, ch = x2 - x1, y2 - y1
+
+    local = []
+    for d, (bx1, by1, bx2, by2) in zip(dets, boxes):
+        local.append({**d, "bbox_xyxy": [(bx1 - x1) / cw, (by1 - y1) / ch, (bx2 - x1) / cw, (by2 - y1) / ch]})
+    roi = _apply_safe(fn, frame[y1:y2, x1:x2], local, mask_cache)
+    frame[y1:y2, x1:x2] = roi
+    return frame
+
+def _cover_box(img: np.ndarray, d: Dict, pct: float = 0.18) -> None:
+    # Last resort for a box an obfuscator rejects: strong rectangular blur of the box grown
+    # like a face, clipped to the frame (blur_plates clips), in place.
+    x1, y1, x2, y2 = (float(v) for v in d["bbox_xyxy"])
+    dx, dy = (x2 - x1) * pct, (y2 - y1) * pct
+    blur_plates(img, [{**d, "bbox_xyxy": [x1 - dx, y1 - dy, x2 + dx, y2 + dy]}], inplace=True)
+
+def _apply_safe(fn, frame: np.ndarray, dets: List[Dict], mask_cache: Optional["MaskCache"] = None) -> np.ndarray:
+    # Obfuscators may reject a box (e.g. a sticker that no longer fits near the border).
+    # Then apply the boxes one at a time and cover each rejected one with a rectangular
+    # blur instead: a box is never left unobfuscated.
+    def call(img, ds, **kw):
+        if fn is blur_faces and mask_cache is not None:
+            return fn(img, ds, masks=mask_cache.get(img.shape[:2], ds), **kw)
+        return fn(img, ds, **kw)
+
+    try:
+        return call(frame, dets)
+    except ValueError:
+        # A single box is rejected before anything is written, so one copy can take them all in place.
+        out = frame.copy()
+        for d in dets:
+            try:
+                call(out, [d], inplace=True)
+            except ValueError:
+                _cover_box(out, d)
+        return out
+
+class MaskCache:
+    """
+    Small LRU of face blur masks keyed by (crop size, crop-local boxes). Between
+    keyframes tracks only translate and _apply_roi crops relative to the boxes, so
+    the key repeats and the mask build (dilate + feathering) is skipped.
+    """
+
+    def __init__(self, capacity: int = 8):
+        self.capacity = capacity
+        self._items: "OrderedDict[tuple, tuple]" = OrderedDict()
+
+    def get(self, hw: Tuple[int, int], dets: List[Dict]):
+        H, W = hw
+        key = (H, W) + tuple(int(round(v * s)) for d in dets for v, s in zip(d["bbox_xyxy"], (W, H, W, H)))
+        masks = self._items.get(key)
+        if masks is None:
+            masks = face_blur_masks(H, W, dets)
+            self._items[key] = masks
+            if len(self._items) > self.capacity:
+                self._items.popitem(last=False)
+        else:
+            self._items.move_to_end(key)
+        return masks
+
+def check_edge_boxes() -> None:
+    """Every box touching or crossing the frame border must still change the pixels under it."""
+    frame = np.random.default_rng(0).integers(0, 256, (480, 640, 3), dtype=np.uint8)
+    boxes = [[0.0, 0.3, 0.15, 0.6], [0.9, 0.0, 1.0, 0.2], [-0.05, 0.8, 0.1, 1.05], [0.85, 0.85, 1.1, 1.1]]
+    for fn in (blur_faces, blur_plates):
+        for box in boxes:
+            out = _apply_roi(fn, frame.copy(), [{"bbox_xyxy": box}])
+            x1, y1, x2, y2 = (int(round(min(max(v, 0.0), 1.0) * s)) for v, s in zip(box, (640, 480, 640, 480)))
+            if np.array_equal(out[y1:y2, x1:x2], frame[y1:y2, x1:x2]):
+                raise AssertionError(f"{fn.__name__} left edge box {box} untouched")
+    print(f"Edge boxes OK ({len(boxes)} boxes x 2 obfuscators).")
+
+def main():
+    ap = argparse.ArgumentParser(description="Blur faces and/or plates in a video or a burst of frames.")
+    ap.add_argument("-i", "--input", help="Input video file, or a directory of burst frames")
+    ap.add_argument("-o", "--output", help="Output video file (.mp4), or a directory for burst frames")
+    ap.add_argument("-t", "--target", choices=["face", "plate", "both"], default="face")
+    ap.add_argument("-k", "--keyframe-interval", type=int, default=10, help="Run detectors every k frames")
+    ap.add_argument("--detect-max-side", type=int, default=960, help="Longest side fed to the detectors")
+    ap.add_argument("--fps", type=float, default=0.0, help="Output fps (default: input fps, or 30 for bursts)")
+    ap.add_argument("--check-edges", action="store_true", help="Only verify that boxes at the frame border get obfuscated")
+    args = ap.parse_args()
+    if args.check_edges:
+        check_edge_boxes()
+        return
+    if not args.input or not args.output:
+        ap.error("-i/--input and -o/--output are required")
+
+    targets = ["face", "plate"] if args.target == "both" else [args.target]
+    is_burst = os.path.isdir(args.input)
+    frames = _iter_burst(args.input) if is_burst else _iter_video(args.input)
+    out_frames = obfuscate_stream(frames, targets, keyframe_interval=max(1, args.keyframe_interval),
+                                  detect_max_side=args.detect_max_side)
+
+    n = 0
+    if is_burst and not os.path.splitext(args.output)[1]:
+        os.makedirs(args.output, exist_ok=True)
+        for n, frame in enumerate(out_frames, start=1):
+            cv2.imwrite(os.path.join(args.output, f"{n:05d}.jpg"), frame)
+    else:
+        fps = args.fps or (30.0 if is_burst else _video_fps(args.input))
+        writer = None
+        try:
+            for n, frame in enumerate(out_frames, start=1):
+                if writer is None:
+                    H, W = frame.shape[:2]
+                    writer = cv2.VideoWriter(args.output, cv2.VideoWriter_fourcc(*"mp4v"), fps, (W, H))
+                writer.write(frame)
+        finally:
+            if writer is not None:
+                writer.release()
+
+    print(f"Done. Wrote {n} frames to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
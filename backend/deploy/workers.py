@@ -0,0 +1,339 @@
+// Copyright 2025 The NoPeek Authors. All rights reserved.
+// Licensed under the Apache License, Version 2.0 that can be found in the
+// LICENSE file in the root directory of this source tree.
+
+# workers.py — model-holding worker processes, pinned to cores, with shared-memory image handoff
+import argparse, asyncio, itertools, multiprocessing as mp, os, queue, threading, time
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Ops whose result is an image the size of the input; they take out= and write into a
+# shared block the caller allocated, so neither direction pickles pixels.
+_IMAGE_OPS = {"composite"}
+
+
+# =========================
+# Shared memory
+# =========================
+def _attach(name: str) -> shared_memory.SharedMemory:
+    # Before 3.13 attaching registers the block with the resource tracker as if this process
+    # owned it; the creator unlinks it, so skip that registration.
+    register = resource_tracker.register
+    resource_tracker.register = lambda *a, **kw: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+def _shm_array(shm: shared_memory.SharedMemory, shape: Tuple[int, ...], dtype: str) -> np.ndarray:
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+# =========================
+# Worker side
+# =========================
+def _gated(detector: str, score_fn: Callable[[np.ndarray], float], img: np.ndarray, gate: bool) -> Optional[bool]:
+    # The decision is returned rather than counted here: metrics live in the API process.
+    from gating import gate_enabled, gate_threshold
+    if not (gate and gate_enabled(detector)):
+        return None
+    return score_fn(img) >= gate_threshold(detector)
+
+def _op_detect_faces(img: np.ndarray, **kw) -> Dict:
+    import detect
+    return {"dets": detect.detect_faces(img), "ran": None}
+
+def _op_detect_plates(img: np.ndarray, gate: bool = False, **kw) -> Dict:
+    import detect
+    ran = _gated("plate", detect.plate_gate_score, img, gate)
+    return {"dets": [] if ran is False else detect.detect_plates(img), "ran": ran}
+
+def _op_detect_documents(img: np.ndarray, gate: bool = False, **kw) -> Dict:
+    from blur_doc import detect_documents, document_gate_score
+    ran = _gated("document", document_gate_score, img, gate)
+    return {"dets": [] if ran is False else detect_documents(img), "ran": ran}
+
+def _op_composite(img: np.ndarray, dets: List[Dict] = (), modes: Optional[Dict] = None, **kw) -> np.ndarray:
+    from compositor import composite
+    return composite(img, list(dets), modes, **kw)
+
+_OPS: Dict[str, Callable[..., Any]] = {
+    "detect_faces": _op_detect_faces,
+    "detect_plates": _op_detect_plates,
+    "detect_documents": _op_detect_documents,
+    "composite": _op_composite,
+}
+
+def run_local(op: str, img: np.ndarray, **kwargs) -> Any:
+    """Run an op in the calling process, exactly as a worker would (no pool, no shared memory)."""
+    return _OPS[op](img, **kwargs)
+
+def _worker_main(index: int, cores: List[int], threads: int, tasks: "mp.Queue", results: "mp.Queue") -> None:
+    # Thread budgets must be set before the model stacks are imported.
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    os.environ["NOPEEK_FACE_THREADS"] = str(threads)
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    # Model weights are resolved relative to this directory, as for the detection scripts.
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    import cv2
+    cv2.setNumThreads(threads)
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        task_id, op, in_name, shape, dtype, out_name, kwargs = task
+        results.put(("start", task_id, index, None))
+        shm_in = shm_out = None
+        try:
+            shm_in = _attach(in_name)
+            img = _shm_array(shm_in, shape, dtype)
+            if out_name:
+                # Image ops paint straight into the caller's output block.
+                shm_out = _attach(out_name)
+                out = _shm_array(shm_out, shape, dtype)
+                result = _OPS[op](img, out=out, **kwargs)
+                if result is not out:
+                    if result.shape != out.shape:
+                        result = cv2.resize(result, (shape[1], shape[0]), interpolation=cv2.INTER_AREA)
+                    out[...] = result
+                result = None
+            else:
+                result = _OPS[op](img, **kwargs)
+            results.put(("ok", task_id, index, result))
+        except BaseException as e:
+            results.put(("error", task_id, index, f"{type(e).__name__}: {e}"))
+        finally:
+            # Drop our views before closing, or close() fails on the exported buffer.
+            img = out = None
+            for shm in (shm_in, shm_out):
+                if shm is not None:
+                    shm.close()
+
+
+# =========================
+# API side
+# =========================
+class WorkerPool:
+    """
+    n_workers processes, each pinned to its own slice of the allowed cores with
+    threads_per_worker threads for OpenCV / ONNX Runtime, and each keeping its models
+    loaded between tasks. Tasks go to whichever worker is idle. The caller's image is
+    copied once into a shared-memory block; image results come back the same way.
+    n_workers=0 disables the pool (enabled is False).
+    """
+
+    def __init__(self, n_workers: int = 0, threads_per_worker: int = 0, pin: bool = True):
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+        self.n_workers = n_workers
+        self.threads = threads_per_worker or max(1, len(cores) // max(1, n_workers))
+        self._cores = cores
+        self._pin = pin
+        self._ctx = mp.get_context("spawn")
+        self._tasks = None
+        self._results = None
+        self._procs: List[Any] = []
+        self._pending: Dict[int, Tuple[Callable[[str, Any], None], int]] = {}   # task_id -> (resolve, worker)
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._reader: Optional[threading.Thread] = None
+        self._closing = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.n_workers > 0
+
+    def _cores_for(self, i: int) -> List[int]:
+        if not self._pin:
+            return []
+        start = (i * self.threads) % len(self._cores)
+        return [self._cores[(start + k) % len(self._cores)] for k in range(self.threads)]
+
+    def _spawn(self, i: int):
+        p = self._ctx.Process(target=_worker_main, name=f"nopeek-worker-{i}", daemon=True,
+                              args=(i, self._cores_for(i), self.threads, self._tasks, self._results))
+        p.start()
+        return p
+
+    def start(self) -> "WorkerPool":
+        if not self.enabled or self._procs:
+            return self
+        self._tasks, self._results = self._ctx.Queue(), self._ctx.Queue()
+        self._procs = [self._spawn(i) for i in range(self.n_workers)]
+        self._reader = threading.Thread(target=self._read_results, name="nopeek-worker-results", daemon=True)
+        self._reader.start()
+        return self
+
+    def close(self) -> None:
+        if not self._procs:
+            return
+        self._closing = True
+        for _ in self._procs:
+            self._tasks.put(None)
+        for p in self._procs:
+            p.join(timeout=5)
+            if p.is_alive():
+                p.terminate()
+        self._procs = []
+        self._fail_all("worker pool closed")
+
+    def _fail_all(self, message: str) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for resolve, _ in pending.values():
+            resolve("error", message)
+
+    def _read_results(self) -> None:
+        # Liveness is checked on a timer, not only when the queue is idle: under steady load
+        # results from the healthy workers would otherwise hide a crashed one indefinitely.
+        next_check = time.monotonic() + 1.0
+        while self._procs:
+            if time.monotonic() >= next_check:
+                self._check_workers()
+                next_check = time.monotonic() + 1.0
+            try:
+                kind, task_id, worker, payload = self._results.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                return
+            with self._lock:
+                entry = self._pending.get(task_id)
+                if entry is None:
+                    continue
+                if kind == "start":
+                    self._pending[task_id] = (entry[0], worker)
+                    continue
+                del self._pending[task_id]
+            entry[0](kind, payload)
+
+    def _check_workers(self) -> None:
+        # A crashed worker (e.g. OOM-killed) takes its in-flight task with it: fail that task, respawn.
+        if self._closing:
+            return
+        for i, p in enumerate(self._procs):
+            if p.is_alive():
+                continue
+            with self._lock:
+                lost = [tid for tid, (_, w) in self._pending.items() if w == i]
+                entries = [self._pending.pop(tid) for tid in lost]
+            for resolve, _ in entries:
+                resolve("error", f"worker {i} exited with code {p.exitcode}")
+            self._procs[i] = self._spawn(i)
+
+    def _submit(self, op: str, img: np.ndarray, kwargs: Dict, resolve: Callable[[str, Any], None]):
+        """Copy img into shared memory, queue the task; returns the blocks to release and the output view."""
+        img = np.ascontiguousarray(img)
+        shm_in = shared_memory.SharedMemory(create=True, size=max(1, img.nbytes))
+        _shm_array(shm_in, img.shape, img.dtype.str)[...] = img
+        shm_out = shared_memory.SharedMemory(create=True, size=max(1, img.nbytes)) if op in _IMAGE_OPS else None
+        task_id = next(self._ids)
+        with self._lock:
+            self._pending[task_id] = (resolve, -1)
+        self._tasks.put((task_id, op, shm_in.name, img.shape, img.dtype.str,
+                         shm_out.name if shm_out is not None else "", kwargs))
+        return shm_in, shm_out, img.shape, img.dtype.str
+
+    @staticmethod
+    def _release(shm_in, shm_out, *_) -> None:
+        for shm in (shm_in, shm_out):
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+    @classmethod
+    def _finish(cls, kind: str, payload: Any, shm_in, shm_out, shape, dtype):
+        try:
+            if kind != "ok":
+                raise RuntimeError(payload)
+            if shm_out is not None:
+                # Copy out so the block can be released now.
+                return _shm_array(shm_out, shape, dtype).copy()
+            return payload
+        finally:
+            cls._release(shm_in, shm_out)
+
+    async def run(self, op: str, img: np.ndarray, **kwargs) -> Any:
+        """Run op on img in a worker without blocking the event loop."""
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        state = {"done": False, "abandoned": False}
+        state_lock = threading.Lock()
+        blocks: Tuple = ()
+
+        def resolve(kind: str, payload: Any) -> None:
+            with state_lock:
+                state["done"] = True
+                abandoned = state["abandoned"]
+            if abandoned:
+                # The caller was cancelled while the worker still held the blocks; release them now.
+                self._release(*blocks)
+                return
+            loop.call_soon_threadsafe(lambda: fut.done() or fut.set_result((kind, payload)))
+
+        blocks = self._submit(op, img, kwargs, resolve)
+        try:
+            kind, payload = await fut
+        except BaseException:
+            # Cancelled (client gone, request timeout): the worker may still be reading or writing
+            # the blocks, so they are released when its result arrives, or here if it already has.
+            with state_lock:
+                state["abandoned"] = True
+                done = state["done"]
+            if done:
+                self._release(*blocks)
+            raise
+        return self._finish(kind, payload, *blocks)
+
+    def run_sync(self, op: str, img: np.ndarray, **kwargs) -> Any:
+        done = threading.Event()
+        box: List[Any] = []
+
+        def resolve(kind: str, payload: Any) -> None:
+            box.append((kind, payload))
+            done.set()
+
+        blocks = self._submit(op, img, kwargs, resolve)
+        done.wait()
+        return self._finish(*box[0], *blocks)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Throughput of the worker pool: detect + composite over one image.")
+    ap.add_argument("-i", "--input", required=True, help="Input image path")
+    ap.add_argument("-w", "--workers", type=int, default=os.cpu_count() or 1)
+    ap.add_argument("--threads", type=int, default=0, help="Threads per worker (default: cores / workers)")
+    ap.add_argument("-n", "--requests", type=int, default=16)
+    args = ap.parse_args()
+
+    import cv2
+    img = cv2.imread(args.input)
+    if img is None:
+        raise FileNotFoundError(args.input)
+
+    async def one(pool: WorkerPool):
+        dets = (await pool.run("detect_faces", img))["dets"]
+        for d in dets:
+            d["type"] = "face"
+        return await pool.run("composite", img, dets=dets)
+
+    async def run(pool: WorkerPool):
+        await one(pool)                     # load models in at least one worker
+        t0 = time.perf_counter()
+        await asyncio.gather(*(one(pool) for _ in range(args.requests)))
+        return time.perf_counter() - t0
+
+    pool = WorkerPool(args.workers, args.threads).start()
+    try:
+        dt = asyncio.run(run(pool))
+    finally:
+        pool.close()
+    print(f"{args.requests} requests on {args.workers} workers x {pool.threads} threads: "
+          f"{dt:.2f}s ({args.requests / dt:.2f} req/s)")
+
+
+if __name__ == "__main__":
+    main()